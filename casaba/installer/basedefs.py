@@ -18,9 +18,9 @@ This module provides all the predefined variables.
 
 import datetime
 import os
-import pkg_resources
 import sys
 import tempfile
+import threading
 
 from .utils import get_current_user
 from casaba.modules.sorteddict import UnsortableOrderedDict
@@ -30,43 +30,11 @@ APP_NAME = "Casaba"
 
 FILE_YUM_VERSION_LOCK = "/etc/yum/pluginconf.d/versionlock.list"
 
-CASABA_SRC_DOC = pkg_resources.resource_filename(
-    pkg_resources.Requirement.parse('casaba'), 'docs/casaba.rst'
-)
-if os.path.exists(CASABA_SRC_DOC):
-    CASABA_DOC = CASABA_SRC_DOC
-elif os.path.exists(os.path.join(sys.prefix, 'share/casaba/casaba.rst')):
-    CASABA_DOC = os.path.join(sys.prefix, 'share/casaba/casaba.rst')
-else:
-    CASABA_DOC = '/usr/share/casaba/casaba.rst'
-
 CASABA_VAR_DIR = '/var/tmp/casaba'
-try:
-    os.mkdir(CASABA_VAR_DIR, 0o700)
-except OSError:
-    # directory is already created, check ownership
-    stat = os.stat(CASABA_VAR_DIR)
-    if stat.st_uid == 0 and os.getuid() != stat.st_uid:
-        print('%s is already created and owned by root. Please change '
-              'ownership and try again.' % CASABA_VAR_DIR)
-        sys.exit(1)
-finally:
-    uid, gid = get_current_user()
-
-    if uid != 0 and os.getuid() == 0:
-        try:
-            os.chown(CASABA_VAR_DIR, uid, gid)
-        except Exception as ex:
-            print('Unable to change owner of %s. Please fix ownership '
-                  'manually and try again.' % CASABA_VAR_DIR)
-            sys.exit(1)
-
-_tmpdirprefix = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-')
-VAR_DIR = tempfile.mkdtemp(prefix=_tmpdirprefix, dir=CASABA_VAR_DIR)
-DIR_LOG = VAR_DIR
+LATEST_LOG_DIR = '%s/latest' % CASABA_VAR_DIR
+
 FILE_LOG = 'casaba-setup.log'
 PUPPET_MANIFEST_RELATIVE = "manifests"
-PUPPET_MANIFEST_DIR = os.path.join(VAR_DIR, PUPPET_MANIFEST_RELATIVE)
 HIERADATA_DIR_RELATIVE = "hieradata"
 MODULE_DIR_RELATIVE = "modules"
 PUPPETDATA_DIR = "/etc/puppetlabs/code/environments/"
@@ -74,20 +42,133 @@ HIERA_DIR = "/etc/puppetlabs/puppet"
 
 API_GLOBAL_OPTIONS = UnsortableOrderedDict()
 
-LATEST_LOG_DIR = '%s/latest' % CASABA_VAR_DIR
-if os.path.exists(LATEST_LOG_DIR):
-    try:
-        os.unlink(LATEST_LOG_DIR)
-    except OSError:
-        print('Unable to delete symbol link for log dir %s.' % LATEST_LOG_DIR)
-
-try:
-    # Extract folder name at /var/tmp/casaba/<VAR_DIR> and do a relative
-    # symlink to /var/tmp/casaba/latest
-    os.symlink(os.path.basename(VAR_DIR),
-               os.path.join(CASABA_VAR_DIR, 'latest'))
-except OSError:
-    print('Unable to create symbol link for log dir %s.' % LATEST_LOG_DIR)
+
+class _lazy(object):
+    """
+    Property computed on first access and then stored in the instance.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with instance._lock:
+            if self.__name__ not in instance.__dict__:
+                instance.__dict__[self.__name__] = self.func(instance)
+        return instance.__dict__[self.__name__]
+
+
+class RuntimePaths(object):
+    """
+    Paths used by the installer at runtime. Directories are created
+    and documentation is looked up on first access, so that importing
+    this module does not touch the file system.
+    """
+    def __init__(self, base_dir=CASABA_VAR_DIR):
+        self.base_dir = base_dir
+        self._lock = threading.RLock()
+
+    def resolved(self, name):
+        """
+        Returns True if lazy path with given name has been already
+        resolved (and created).
+        """
+        return name in self.__dict__
+
+    @_lazy
+    def CASABA_DOC(self):
+        """
+        Documentation file providing usage of parameters.
+        """
+        # documentation of source checkout or of installed package
+        for path in (os.path.join(os.path.dirname(DIR_PROJECT_DIR),
+                                  'docs/casaba.rst'),
+                     os.path.join(sys.prefix, 'share/casaba/casaba.rst')):
+            if os.path.exists(path):
+                return path
+        # pkg_resources is expensive to import, so it is used only when
+        # documentation is not found on usual places
+        import pkg_resources
+        src_doc = pkg_resources.resource_filename(
+            pkg_resources.Requirement.parse('casaba'), 'docs/casaba.rst'
+        )
+        if os.path.exists(src_doc):
+            return src_doc
+        return '/usr/share/casaba/casaba.rst'
+
+    @_lazy
+    def CASABA_VAR_DIR(self):
+        """
+        Directory shared by all installer runs.
+        """
+        try:
+            os.mkdir(self.base_dir, 0o700)
+        except OSError:
+            # directory is already created, check ownership
+            stat = os.stat(self.base_dir)
+            if stat.st_uid == 0 and os.getuid() != stat.st_uid:
+                print('%s is already created and owned by root. Please change '
+                      'ownership and try again.' % self.base_dir)
+                sys.exit(1)
+        finally:
+            uid, gid = get_current_user()
+
+            if uid != 0 and os.getuid() == 0:
+                try:
+                    os.chown(self.base_dir, uid, gid)
+                except Exception as ex:
+                    print('Unable to change owner of %s. Please fix ownership '
+                          'manually and try again.' % self.base_dir)
+                    sys.exit(1)
+        return self.base_dir
+
+    @_lazy
+    def VAR_DIR(self):
+        """
+        Directory of current installer run, linked as latest.
+        """
+        tmpdirprefix = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-')
+        var_dir = tempfile.mkdtemp(prefix=tmpdirprefix,
+                                   dir=self.CASABA_VAR_DIR)
+        latest = os.path.join(self.CASABA_VAR_DIR, 'latest')
+        if os.path.lexists(latest):
+            try:
+                os.unlink(latest)
+            except OSError:
+                print('Unable to delete symbol link for log dir %s.' % latest)
+
+        try:
+            # Extract folder name at /var/tmp/casaba/<VAR_DIR> and do a relative
+            # symlink to /var/tmp/casaba/latest
+            os.symlink(os.path.basename(var_dir), latest)
+        except OSError:
+            print('Unable to create symbol link for log dir %s.' % latest)
+        return var_dir
+
+    @property
+    def DIR_LOG(self):
+        return self.VAR_DIR
+
+    @property
+    def PUPPET_MANIFEST_DIR(self):
+        return os.path.join(self.VAR_DIR, PUPPET_MANIFEST_RELATIVE)
+
+    @property
+    def PLUGIN_INDEX_FILE(self):
+        return os.path.join(self.CASABA_VAR_DIR, 'plugin-index.json')
+
+    @property
+    def FACTS_CACHE_DIR(self):
+        return os.path.join(self.CASABA_VAR_DIR, 'facts')
+
+
+runtime = RuntimePaths()
+
+# facts discovered on hosts are reused by subsequent runs for this many seconds
+FACTS_CACHE_TTL = int(os.environ.get('CASABA_FACTS_CACHE_TTL', 3600))
 
 PUPPET_DEPENDENCIES = ['puppet-agent', 'tar', 'nc']
 PUPPET_SERVER_DEPENDENCIES = ['puppetserver', 'puppet-agent', 'openssh-clients', 'tar', 'nc', 'rubygems', 'rubygem-json']
@@ -12,65 +12,365 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import os
 import stat
 import uuid
 import time
+import pipes
+import shutil
 import logging
 import tarfile
 import tempfile
+import threading
+import subprocess
+
+from distutils.spawn import find_executable
 
 from .. import utils
+from . import transfer
+from .journal import journal
+from ..exceptions import AbortedError
+from ..exceptions import ExecuteRuntimeError
+from ..exceptions import MultiHostError
 
 
 class SshTarballTransferMixin(object):
     """
     Transfers resources and recipes by packing them to tar.gz and
-    copying it via ssh.
+    copying it via ssh. If transfer_streaming is set tarballs are not
+    created locally at all, they are streamed directly to standard
+    input of tar running on node. If share_packs is set resources
+    are packed once and shared by all drones sending the same content.
     """
+    # stream tarballs to node instead of packing them to local files
+    transfer_streaming = False
+    # compression of streamed tarballs: none, gzip or zstd (zstd falls
+    # back to gzip if it is not installed locally and it has to be
+    # installed on node too)
+    transfer_codec = 'gzip'
+    # build tarballs with the same content only once for all drones
+    share_packs = False
+    # directory on node keeping copy of last transferred resources,
+    # resources are always transferred whole if it is not set
+    cache_dir = None
+    # (path, codec) of resource tarball already present on node,
+    # see DroneFleet
+    _resource_bundle = None
+
+    # tar options for decompression of given codec
+    _codec_options = {
+        'none': '',
+        'gzip': '-z',
+        'zstd': '--use-compress-program=zstd',
+    }
+    _codec_suffixes = {
+        'none': '.tar',
+        'gzip': '.tar.gz',
+        'zstd': '.tar.zst',
+    }
+    # links cached resources to resource directory if node already has
+    # resources with given digest, prints cache manifest otherwise
+    _cache_query_script = (
+        'mkdir -p %(cache)s/tree\n'
+        'exec 9> %(cache)s/lock\n'
+        'flock 9\n'
+        'if [ "$(cat %(cache)s/DIGEST 2> /dev/null)" = "%(digest)s" ]; then\n'
+        '    cp -al %(cache)s/tree/. %(res_dir)s/ 2> /dev/null || '
+        'cp -a %(cache)s/tree/. %(res_dir)s/\n'
+        '    echo %(digest)s\n'
+        'else\n'
+        '    cat %(cache)s/MANIFEST 2> /dev/null || true\n'
+        'fi\n'
+    )
+    # applies delta tarball to cache and links cached resources
+    # to resource directory, manifest is removed first so interrupted
+    # update results in full transfer next time
+    _cache_update_script = (
+        'mkdir -p %(cache)s/tree\n'
+        'exec 9> %(cache)s/lock\n'
+        'flock 9\n'
+        'cd %(cache)s/tree\n'
+        'rm -f ../DIGEST ../MANIFEST\n'
+        'tar -x %(codec)s -f %(pack)s -O --occurrence=1 .casaba-delete | '
+        'xargs -r -d "\\n" rm -rf --\n'
+        'tar -xp %(codec)s -f %(pack)s\n'
+        'rm -f .casaba-delete %(pack)s\n'
+        'mv .casaba-manifest ../MANIFEST\n'
+        'echo %(digest)s > ../DIGEST\n'
+        'cp -al . %(res_dir)s/ 2> /dev/null || cp -a . %(res_dir)s/\n'
+    )
+    # replaces cache content by resource bundle already present on node,
+    # unless cache holds resources with given digest, and links cached
+    # resources to resource directory
+    _cache_bundle_script = (
+        'mkdir -p %(cache)s/tree\n'
+        'exec 9> %(cache)s/lock\n'
+        'flock 9\n'
+        'if [ "$(cat %(cache)s/DIGEST 2> /dev/null)" != "%(digest)s" ]; then\n'
+        '    rm -rf %(cache)s/DIGEST %(cache)s/MANIFEST %(cache)s/tree\n'
+        '    mkdir %(cache)s/tree\n'
+        '    tar -C %(cache)s/tree -xp %(codec)s -f %(pack)s\n'
+        '    mv %(cache)s/tree/.casaba-manifest %(cache)s/MANIFEST\n'
+        '    echo %(digest)s > %(cache)s/DIGEST\n'
+        'fi\n'
+        'cp -al %(cache)s/tree/. %(res_dir)s/ 2> /dev/null || '
+        'cp -a %(cache)s/tree/. %(res_dir)s/\n'
+    )
+
+    def _codec(self):
+        codec = self.transfer_codec or 'none'
+        if codec not in self._codec_options:
+            raise ValueError('Unknown transfer codec: %s' % codec)
+        if codec == 'zstd' and not find_executable('zstd'):
+            codec = 'gzip'
+        return codec
+
+    def _build_pack(self, key, add_members, codec):
+        """
+        Packs tarball created by add_members to local file and returns its
+        path. If share_packs is set and key identifying content of the
+        tarball is given, tarball is built only once for all drones.
+        """
+        name = '%s%s' % (key or 'pack-%s' % uuid.uuid4().hex[:8],
+                         self._codec_suffixes[codec])
+
+        def build(path):
+            with open(path, 'wb') as fp:
+                os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+                transfer.pack(fp, add_members, codec)
+
+        with utils.profiler.span('pack', name, codec=codec) as span:
+            if key and self.share_packs:
+                path = transfer.pack_cache.get(name, build)
+            else:
+                path = os.path.join(self.local_tmpdir, name)
+                build(path)
+            span['bytes'] = os.path.getsize(path)
+        return path
+
     def _transfer(self, pack_path, pack_dest, res_dir):
         node = self.node
-        args = locals()
-        # copy and extract tarball
-        script = utils.ScriptRunner()
-        script.append("scp %(pack_path)s root@%(node)s:%(pack_dest)s"
-                      % args)
-        script.append("ssh -o StrictHostKeyChecking=no "
-                      "-o UserKnownHostsFile=/dev/null root@%(node)s "
-                      "tar -C %(res_dir)s -xpzf %(pack_dest)s" % args)
+        pool = utils.ssh_pool
+        # copy and extract tarball over pooled connection to node
+        copy = pool.scp_command(node, pack_path, pool.remote(node, pack_dest))
+        extract = pool.ssh_command(node, "tar -C %s -xpzf %s"
+                                   % (res_dir, pack_dest))
         try:
-            script.execute()
-        except ScriptRuntimeError as ex:
+            utils.execute(copy)
+            utils.execute(extract)
+        except ExecuteRuntimeError as ex:
             # TO-DO: change to appropriate exception
             raise RuntimeError('Failed to copy resources to node %s. '
                                'Reason: %s' % (node, ex))
 
-    def _pack_resources(self):
-        randpart = uuid.uuid4().hex[:8]
-        pack_path = os.path.join(self.local_tmpdir,
-                                 'res-%s.tar.gz' % randpart)
-        pack = tarfile.open(pack_path, mode='w:gz')
-        os.chmod(pack_path, stat.S_IRUSR | stat.S_IWUSR)
+    def _stream(self, command, add_members, key=None):
+        """
+        Streams tarball created by add_members to standard input of given
+        command ran on node over single ssh connection. Tarball is created
+        on the fly, unless it is shared by multiple drones (see method
+        _build_pack), in which case prebuilt tarball is streamed.
+        """
+        # TO-DO: complete logger name when logging will be setup correctly
+        logger = logging.getLogger()
+        codec = self._codec()
+        source, nbytes = subprocess.PIPE, None
+        if key and self.share_packs:
+            path = self._build_pack(key, add_members, codec)
+            source, nbytes = open(path, 'rb'), os.path.getsize(path)
+        cmd = utils.ssh_pool.ssh_command(self.node, command)
+        logger.info('Streaming %s tarball to command:\n%s'
+                    % (codec, ' '.join(pipes.quote(i) for i in cmd)))
+        with utils.profiler.span('transfer', 'stream', host=self.node,
+                                 remote=True, codec=codec) as span:
+            try:
+                ssh = subprocess.Popen(cmd, stdin=source,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       close_fds=True)
+            finally:
+                if source is not subprocess.PIPE:
+                    source.close()
+            if ssh.stdin:
+                try:
+                    nbytes = transfer.pack(ssh.stdin, add_members, codec)
+                    ssh.stdin.close()
+                except (IOError, OSError):
+                    # remote side has failed, reason will be in its stderr
+                    pass
+                # stdin is already closed, communicate must not touch it
+                ssh.stdin = None
+            out, err = ssh.communicate()
+            span['rc'] = ssh.returncode
+            span['bytes'] = nbytes
+        if ssh.returncode:
+            # TO-DO: change to appropriate exception
+            raise RuntimeError('Failed to copy resources to node %s. '
+                               'Reason: %s' % (self.node, err.strip()))
+
+    def _deliver(self, key, add_members, res_dir):
+        """
+        Delivers tarball created by add_members to node and extracts
+        it to res_dir. Key identifies content of the tarball, see method
+        _build_pack.
+        """
+        if self.transfer_streaming:
+            self._stream('mkdir -p %s && tar -C %s -xp %s -f -'
+                         % (res_dir, res_dir,
+                            self._codec_options[self._codec()]),
+                         add_members, key=key)
+            return
+        pack_path = self._build_pack(key, add_members, 'gzip')
+        pack_dest = os.path.join(self.remote_tmpdir,
+                                 os.path.basename(pack_path))
+        self._transfer(pack_path, pack_dest, res_dir)
+
+    def _resource_entries(self):
+        """
+        Returns list of (path, arcname) pairs of registered resources.
+        """
+        entries = []
         for path, dest in self._resources:
             if not dest:
                 dest = os.path.basename(path)
-            pack.add(path,
-                     arcname=os.path.join(dest, os.path.basename(path)))
-        pack.close()
-        return pack_path
+            entries.append((path, os.path.join(dest, os.path.basename(path))))
+        return entries
+
+    def _add_resources(self, pack):
+        for path, arcname in self._resource_entries():
+            pack.add(path, arcname=arcname)
+
+    def _add_delta(self, pack, manifest, text, changed, removed):
+        """
+        Adds only given changed resources together with list of removed
+        resources and new manifest to the tarball.
+        """
+        # list of removed resources has to be the first member, so that
+        # it can be read without decompressing whole tarball
+        _add_string(pack, '.casaba-delete',
+                    ''.join('%s\n' % i for i in removed))
+        for arcname in changed:
+            pack.add(manifest[arcname][0], arcname=arcname, recursive=False)
+        _add_string(pack, '.casaba-manifest', text)
+
+    def _resource_pack(self):
+        """
+        Builds tarball of all resources together with their manifest,
+        so that it can be used to fill node cache, and returns tuple
+        (path, codec).
+        """
+        codec = self.transfer_streaming and self._codec() or 'gzip'
+        manifest = transfer.build_manifest(self._resource_entries())
+        text = transfer.dump_manifest(manifest)
+
+        def add_members(pack):
+            self._add_resources(pack)
+            _add_string(pack, '.casaba-manifest', text)
+
+        key = 'bundle-%s' % transfer.text_digest(text)[:16]
+        return self._build_pack(key, add_members, codec), codec
+
+    def _cache_current(self):
+        """
+        Returns True if node cache holds current resources, so they don't
+        have to be sent to node at all.
+        """
+        if not self.cache_dir:
+            return False
+        text = transfer.dump_manifest(
+            transfer.build_manifest(self._resource_entries()))
+        server = utils.ScriptRunner(self.node)
+        server.append('cat %s/DIGEST 2> /dev/null || true' % self.cache_dir)
+        rc, stdout = server.execute(log=False)
+        return stdout.strip() == transfer.text_digest(text)
+
+    def set_resource_bundle(self, path, codec):
+        """
+        Registers tarball of all resources compressed by given codec,
+        which has been already delivered to path on node. Resources are
+        extracted from it instead of being sent from the installer host.
+        """
+        self._resource_bundle = (path, codec)
 
     def _copy_resources(self):
-        pack_path = self._pack_resources()
-        pack_dest = os.path.join(self.remote_tmpdir,
-                                 os.path.basename(pack_path))
-        self._transfer(pack_path, pack_dest, self.resource_dir)
-
-    def _pack_recipes(self):
-        randpart = uuid.uuid4().hex[:8]
-        pack_path = os.path.join(self.local_tmpdir,
-                                 'rec-%s.tar.gz' % randpart)
-        pack = tarfile.open(pack_path, mode='w:gz')
-        os.chmod(pack_path, stat.S_IRUSR | stat.S_IWUSR)
+        manifest = transfer.build_manifest(self._resource_entries())
+        text = transfer.dump_manifest(manifest)
+        digest = self._resource_digest = transfer.text_digest(text)
+
+        if self._resource_bundle:
+            path, codec = self._resource_bundle
+            server = utils.ScriptRunner(self.node)
+            if self.cache_dir:
+                server.append(self._cache_bundle_script % {
+                    'cache': self.cache_dir, 'digest': digest,
+                    'res_dir': self.resource_dir, 'pack': path,
+                    'codec': self._codec_options[codec]})
+            else:
+                server.append('tar -C %s -xp %s -f %s '
+                              '--exclude=.casaba-manifest'
+                              % (self.resource_dir,
+                                 self._codec_options[codec], path))
+            server.execute()
+            return
+
+        if not self.cache_dir:
+            key = self.share_packs and 'res-%s' % digest[:16] or None
+            self._deliver(key, self._add_resources, self.resource_dir)
+            return
+
+        values = {'cache': self.cache_dir, 'digest': digest,
+                  'res_dir': self.resource_dir}
+
+        # TO-DO: complete logger name when logging will be setup correctly
+        logger = logging.getLogger()
+        server = utils.ScriptRunner(self.node)
+        server.append(self._cache_query_script % values)
+        rc, stdout = server.execute(log=False)
+        if stdout.strip() == digest:
+            logger.debug('Resources on node %s are up to date.'
+                         % self.node)
+            return
+
+        changed, removed = transfer.diff_manifest(
+            manifest, transfer.load_manifest(stdout))
+        logger.debug('Sending %d changed and removing %d stale resources '
+                     'on node %s.' % (len(changed), len(removed), self.node))
+        # nodes in the same state get the same delta
+        key = 'delta-%s' % transfer.text_digest(
+            '\0'.join([text] + changed + removed))[:16]
+
+        def add_members(pack):
+            self._add_delta(pack, manifest, text, changed, removed)
+
+        if self.transfer_streaming:
+            # delta is stored to node and applied in the same ssh call
+            codec = self._codec()
+            values['pack'] = os.path.join(
+                self.remote_tmpdir, key + self._codec_suffixes[codec])
+            values['codec'] = self._codec_options[codec]
+            self._stream('set -e\ncat > %(pack)s\n' % values +
+                         self._cache_update_script % values,
+                         add_members, key=key)
+            return
+
+        pack_path = self._build_pack(key, add_members, 'gzip')
+        values['pack'] = os.path.join(self.remote_tmpdir,
+                                      os.path.basename(pack_path))
+        values['codec'] = self._codec_options['gzip']
+        pool = utils.ssh_pool
+        copy = pool.scp_command(self.node, pack_path,
+                                pool.remote(self.node, values['pack']))
+        try:
+            utils.execute(copy)
+        except ExecuteRuntimeError as ex:
+            # TO-DO: change to appropriate exception
+            raise RuntimeError('Failed to copy resources to node %s. '
+                               'Reason: %s' % (self.node, ex))
+        server.clear()
+        server.append(self._cache_update_script % values)
+        server.execute()
+
+    def _add_recipes(self, pack):
         if self.recipe_dir.startswith(self.resource_dir):
             dest = self.recipe_dir[len(self.resource_dir):].lstrip('/')
         else:
@@ -79,18 +379,25 @@ class SshTarballTransferMixin(object):
             for path in recipes:
                 _dest = os.path.join(dest, os.path.basename(path))
                 pack.add(path, arcname=_dest)
-        pack.close()
-        return pack_path
 
     def _copy_recipes(self):
-        pack_path = self._pack_recipes()
-        pack_dest = os.path.join(self.remote_tmpdir,
-                                 os.path.basename(pack_path))
         if self.recipe_dir.startswith(self.resource_dir):
             extr_dest = self.resource_dir
         else:
             extr_dest = self.recipe_dir
-        self._transfer(pack_path, pack_dest, extr_dest)
+        # recipes are node specific, so they are never shared
+        self._deliver(None, self._add_recipes, extr_dest)
+
+
+def _add_string(pack, name, data):
+    """
+    Adds file with given name and content to opened tarball.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = stat.S_IRUSR | stat.S_IWUSR
+    info.mtime = time.time()
+    pack.addfile(info, io.BytesIO(data))
 
 
 class DroneObserver(object):
@@ -100,6 +407,7 @@ class DroneObserver(object):
     def applying(self, drone, recipe):
         """
         Drone is calling this method when it starts applying recipe.
+        All methods get recipe as path to the recipe file on node.
         """
         # subclass must implement this method
         raise NotImplementedError()
@@ -120,18 +428,37 @@ class DroneObserver(object):
         # subclass must implement this method
         raise NotImplementedError()
 
+    def output(self, drone, recipe, line):
+        """
+        Drone is calling this method with every line of output of running
+        recipe if it is able to stream the output. Implementation
+        is optional.
+        """
+        pass
+
 
 class Drone(object):
     """
     Base class used to apply installation recipes to nodes.
     """
+    # maximal number of seconds between checks of running recipes
+    poll_interval = 3
+
     def __init__(self, node, resource_dir=None, recipe_dir=None,
                  local_tmpdir=None, remote_tmpdir=None):
         self._recipes = utils.SortedDict()
         self._resources = []
         self._applied = set()
         self._running = set()
+        self._started = {}
+        self._keys = {}
         self._observer = None
+        self._checked = set()
+        self._aborted = threading.Event()
+        # casaba_info notices reported by applied recipes
+        self.messages = []
+        # digest of transferred resources, part of recipe journal keys
+        self._resource_digest = None
 
         # remote host IP or hostname
         self.node = node
@@ -238,23 +565,114 @@ class Drone(object):
         # subclass must implement this method
         raise NotImplementedError()
 
-    def _wait(self):
+    def _recipe_log(self, recipe):
         """
-        Waits until all started applications of recipes will be finished
+        Returns path to local copy of the log of given recipe or None
+        if drone does not retrieve logs.
+        """
+        return None
+
+    def _validate(self, recipe):
         """
-        while self._running:
+        Checks if finished recipe has been applied successfully and raises
+        appropriate exception if not. Only successful recipes are
+        journaled.
+        """
+        pass
+
+    def _recipe_key(self, recipe):
+        """
+        Returns digest of given local recipe and resources used by it.
+        """
+        with open(recipe, 'rb') as fp:
+            content = fp.read()
+        return transfer.text_digest('%s\0%s' % (self._resource_digest or '',
+                                                 content))
+
+    def _poll_finished(self, recipes):
+        """
+        Checks given recipes without blocking. Returns tuple (finished,
+        fds), where finished is list of applied recipes and fds is list
+        of file descriptors, which become readable when there is
+        something new to check. If fds is empty recipes are checked again
+        after poll_interval. This implementation checks each recipe
+        via method _finished, subclass should override this method
+        if it is able to check all recipes at once.
+        """
+        return [i for i in recipes if self._finished(i)], []
+
+    def _stop_waiting(self):
+        """
+        Called when waiting for running recipes has been interrupted.
+        """
+        pass
+
+    def _check_running(self):
+        """
+        Checks running recipes without blocking and processes finished
+        ones. Returns list of file descriptors to wait for before the next
+        check (see _poll_finished) or None if no recipe is running.
+        """
+        if not self._running:
+            return None
+        try:
+            if self._aborted.is_set():
+                raise AbortedError('Application of recipes on node %s '
+                                   'has been aborted.' % self.node)
             _run = list(self._running)
-            for recipe in _run:
-                if self._observer:
+            if self._observer and set(_run) != self._checked:
+                for recipe in _run:
                     self._observer.checking(self, recipe)
-                if self._finished(recipe):
-                    self._applied.add(recipe)
-                    self._running.remove(recipe)
-                    if self._observer:
-                        self._observer.finished(self, recipe)
+            self._checked = set(_run)
+            finished, fds = self._poll_finished(_run)
+            for recipe in finished:
+                self._recipe_finished(recipe)
+        except Exception:
+            self._stop_waiting()
+            raise
+        if not self._running:
+            return None
+        return fds
+
+    def _recipe_finished(self, recipe):
+        self._applied.add(recipe)
+        self._running.remove(recipe)
+        # time from start of application until it has been
+        # noticed as finished
+        utils.profiler.record('recipe', os.path.basename(recipe),
+                              self._started.pop(recipe), time.time(),
+                              host=self.node, remote=True)
+        if self._observer:
+            self._observer.finished(self, recipe)
+        # fails on the first broken recipe without waiting
+        # for the rest of running recipes
+        reported = len(self.messages)
+        self._validate(recipe)
+        journal.record_recipe(self.node, self._keys.pop(recipe),
+                              self._recipe_log(recipe),
+                              messages=self.messages[reported:])
+
+    def _wait(self):
+        """
+        Waits until all started applications of recipes will be finished
+        """
+        with utils.profiler.span('drone', 'wait', host=self.node):
+            while True:
+                fds = self._check_running()
+                if fds is None:
+                    break
+                if fds:
+                    utils.wait_readable(fds, self.poll_interval)
                 else:
-                    time.sleep(3)
-                    continue
+                    time.sleep(self.poll_interval)
+
+    def abort(self):
+        """
+        Stops waiting for running recipes, method apply raises AbortedError
+        as soon as possible. Recipes already started on node are not
+        interrupted.
+        """
+        self._aborted.set()
 
     def set_observer(self, observer):
         """
@@ -274,6 +692,14 @@ class Drone(object):
         with given name is applied. Skips recipes with names given
         in list parameter skip.
         """
+        self.start(marker=marker, name=name, skip=skip)
+        self._wait()
+
+    def start(self, marker=None, name=None, skip=None):
+        """
+        Same as apply, but does not wait until the last started recipes
+        are finished.
+        """
         # TO-DO: complete logger name when logging will be setup correctly
         logger = logging.getLogger()
         skip = skip or []
@@ -290,6 +716,24 @@ class Drone(object):
                                  (recipe, self.node))
                     continue
 
+                rpath = os.path.join(self.recipe_dir, base)
+                key = self._recipe_key(recipe)
+                if journal.applied_recipe(self.node, key):
+                    logger.debug('Recipe %s has been already applied to '
+                                 'node %s, skipping.' % (base, self.node))
+                    log = self._recipe_log(rpath)
+                    if log:
+                        journal.restore_log(self.node, key, log)
+                    # notices reported by the recipe when it was applied
+                    self.messages.extend(
+                        journal.recipe_messages(self.node, key))
+                    if self._observer:
+                        self._observer.applying(self, rpath)
+                    self._applied.add(rpath)
+                    if self._observer:
+                        self._observer.finished(self, rpath)
+                    continue
+
                 # if the marker has changed then we don't want to
                 # proceed until all of the previous puppet runs have
                 # finished
@@ -299,12 +743,14 @@ class Drone(object):
 
                 logger.debug('Applying recipe %s to node %s.' %
                              (base, self.node))
-                rpath = os.path.join(self.recipe_dir, base)
                 if self._observer:
-                    self._observer.applying(self, recipe)
+                    self._observer.applying(self, rpath)
+                self._keys[rpath] = key
                 self._running.add(rpath)
-                self._apply(rpath)
-        self._wait()
+                self._started[rpath] = time.time()
+                with utils.profiler.span('drone', 'apply', host=self.node,
+                                         recipe=base):
+                    self._apply(rpath)
 
     def cleanup(self, resource_dir=True, recipe_dir=True):
         """
@@ -320,6 +766,247 @@ class Drone(object):
         server.execute()
 
 
+class DroneFleet(object):
+    """
+    Drives multiple drones at once. Recipes with the same marker are
+    applied on all nodes in parallel and fleet waits until the marker
+    is finished on every node before it continues with the next marker,
+    so the deployment takes about as long as on the slowest node.
+    """
+    # directory on nodes where distributed resource tarballs are stored
+    bundle_dir = '/var/tmp/casaba/bundles'
+
+    def __init__(self, drones=None, workers=None, fanout=None, send=None):
+        self._drones = []
+        self._observer = None
+        # maximal number of nodes operated concurrently
+        self.workers = workers
+        # if set, resources are not sent to every node from installer
+        # host, but relayed between nodes, see transfer.TreeDistributor
+        self.fanout = fanout
+        self.send = send
+        for drone in drones or []:
+            self.add_drone(drone)
+
+    @property
+    def drones(self):
+        for i in self._drones:
+            yield i
+
+    @property
+    def markers(self):
+        """
+        Returns markers of all drones in order of their first appearance.
+        """
+        result = []
+        for drone in self._drones:
+            for marker in drone._recipes.iterkeys():
+                if marker not in result:
+                    result.append(marker)
+        return result
+
+    def add_drone(self, drone):
+        """
+        Registers drone to fleet.
+        """
+        if self._observer:
+            drone.set_observer(self._observer)
+        self._drones.append(drone)
+
+    def set_observer(self, observer):
+        """
+        Registers an observer to all drones in fleet. Given object should
+        be subclass of class DroneObserver and it has to be thread-safe,
+        because drones are reporting from multiple threads.
+        """
+        for drone in self._drones:
+            drone.set_observer(observer)
+        self._observer = observer
+
+    def _run(self, method, *args, **kwargs):
+        """
+        Calls given method of all drones concurrently. Raises MultiHostError
+        if the call failed on any node.
+        """
+        def call(drone):
+            try:
+                return getattr(drone, method)(*args, **kwargs)
+            except Exception:
+                if method in ('start', '_wait'):
+                    # don't wait for the rest of nodes when deployment
+                    # is going to fail anyway
+                    for other in self._drones:
+                        if other is not drone:
+                            other.abort()
+                raise
+
+        errors = {}
+        results = utils.parallel_map(call, self._drones, workers=self.workers)
+        for drone, (result, exc_info) in zip(self._drones, results):
+            if exc_info:
+                errors[drone.node] = exc_info[1]
+        if errors:
+            self._raise_errors(method.replace('_', ' ').strip(), errors)
+
+    def _raise_errors(self, action, errors):
+        """
+        Raises MultiHostError for given errors of nodes. Nodes aborted
+        because of failure on another node are reported separately.
+        """
+        failed = dict((node, ex) for node, ex in errors.iteritems()
+                      if not isinstance(ex, AbortedError))
+        # all nodes can be aborted only from outside
+        failed = failed or errors
+        aborted = sorted(set(errors) - set(failed))
+        msg = ('Failed to %s on %d of %d nodes:\n%s' %
+               (action, len(failed), len(self._drones),
+                '\n'.join('[%s] %s' % (node, failed[node])
+                          for node in sorted(failed))))
+        if aborted:
+            msg += ('\nAborted on %d nodes because of the failure: %s' %
+                    (len(aborted), ', '.join(aborted)))
+        raise MultiHostError(msg, errors=failed, aborted=aborted)
+
+    def init_nodes(self):
+        """
+        Initializes all nodes for manipulation.
+        """
+        self._run('init_node')
+
+    def prepare_nodes(self):
+        """
+        Copies resources and recipes of all drones to their nodes.
+        Nodes are served concurrently and resources shared by drones are
+        packed only once if drones have share_packs set.
+        """
+        if not self.fanout:
+            self._run('prepare_node')
+            return
+        bundles = self._distribute_resources()
+        try:
+            self._run('prepare_node')
+        finally:
+            for dest, nodes in bundles.iteritems():
+                server = utils.ScriptRunner()
+                server.append('rm -f %s' % dest)
+                try:
+                    server.execute_on(nodes, can_fail=False, log=False,
+                                      workers=self.workers)
+                except Exception as ex:
+                    logging.getLogger().warning(
+                        'Failed to remove %s from nodes: %s' % (dest, ex))
+
+    def _distribute_resources(self):
+        """
+        Distributes resource tarballs to nodes in a tree, drones having
+        the same resources share the tarball. Nodes with up to date cache
+        are skipped. Returns dict mapping path of tarball on nodes to list
+        of nodes which received it.
+        """
+        results = utils.parallel_map(lambda i: i._cache_current(),
+                                     self._drones, workers=self.workers)
+        groups = utils.SortedDict()
+        for drone, (current, exc_info) in zip(self._drones, results):
+            drone._resource_bundle = None
+            # drones failing the check will get resources as usual
+            if not current:
+                groups.setdefault(drone._resource_pack(), []).append(drone)
+        distributor = transfer.TreeDistributor(fanout=self.fanout,
+                                               send=self.send,
+                                               workers=self.workers)
+        bundles = utils.SortedDict()
+        for (path, codec), drones in groups.iteritems():
+            dest = os.path.join(self.bundle_dir, os.path.basename(path))
+            nodes = bundles.setdefault(dest, [])
+            for drone in drones:
+                if drone.node not in nodes:
+                    nodes.append(drone.node)
+            try:
+                distributor.distribute(path, dest, nodes)
+            except MultiHostError as ex:
+                # nodes which failed to receive the tarball will get
+                # resources directly from the installer host
+                logging.getLogger().warning(str(ex))
+                nodes[:] = [i for i in nodes if i not in ex.errors]
+            for drone in drones:
+                if drone.node in nodes:
+                    drone.set_resource_bundle(dest, codec)
+        return bundles
+
+    def apply(self, name=None, skip=None):
+        """
+        Applies recipes on all nodes marker by marker. Parameters name
+        and skip have same meaning as in Drone.apply.
+        """
+        logger = logging.getLogger()
+        for drone in self._drones:
+            drone._aborted.clear()
+        for marker in self.markers:
+            logger.debug('Applying marker %s on nodes %s.' %
+                         (marker, ', '.join(i.node for i in self._drones)))
+            self._run('start', marker=marker, name=name, skip=skip)
+            # global barrier: marker has to be finished on all nodes
+            # before the next one is started
+            self._wait()
+
+    def _wait(self):
+        """
+        Waits until recipes started on all nodes are finished. All nodes
+        are watched from this thread, every drone is checked when any
+        of its file descriptors becomes readable or when its poll interval
+        elapses. Raises MultiHostError if application failed on any node,
+        the rest of nodes is not waited for in such case.
+        """
+        started = time.time()
+        waiting = [i for i in self._drones if i._running]
+        due = dict((drone, 0) for drone in waiting)
+        watched, ready, errors = {}, set(), {}
+        while waiting:
+            now = time.time()
+            for drone in list(waiting):
+                if drone not in ready and due[drone] > now:
+                    continue
+                try:
+                    fds = drone._check_running()
+                except Exception as ex:
+                    errors[drone.node] = ex
+                    fds = None
+                    # don't wait for the rest of nodes when deployment
+                    # is going to fail anyway
+                    for other in waiting:
+                        if other is not drone:
+                            other.abort()
+                            due[other] = 0
+                if fds is None:
+                    waiting.remove(drone)
+                    watched.pop(drone, None)
+                    utils.profiler.record('drone', 'wait', started,
+                                          time.time(), host=drone.node)
+                    continue
+                watched[drone] = fds
+                due[drone] = time.time() + drone.poll_interval
+            if not waiting:
+                break
+            owners = dict((fd, drone) for drone, fds in watched.iteritems()
+                          for fd in fds)
+            timeout = max(0, min(due[i] for i in waiting) - time.time())
+            ready = set(owners[fd]
+                        for fd in utils.wait_readable(owners, timeout))
+        if errors:
+            self._raise_errors('apply', errors)
+
+    def cleanup(self, resource_dir=True, recipe_dir=True):
+        """
+        Removes all directories created by drones in fleet and tarballs
+        shared by them.
+        """
+        try:
+            self._run('cleanup', resource_dir=resource_dir,
+                      recipe_dir=recipe_dir)
+        finally:
+            transfer.pack_cache.clear()
+
+
 class CasabaDrone(SshTarballTransferMixin, Drone):
     """
     This drone uses Puppet and it's manifests to manipulate node.
@@ -328,6 +1015,14 @@ class CasabaDrone(SshTarballTransferMixin, Drone):
     #      method), it should be moved out of installer when
     #      Controller and plugin system will be refactored and installer
     #      will support projects.
+    # maximal number of seconds between checks of abort request
+    poll_interval = 1
+    # resources are shared by all drones on the node, so only changed
+    # files are transferred on re-runs
+    cache_dir = '/var/tmp/casaba/cache'
+    transfer_streaming = True
+    share_packs = True
+
     def __init__(self, *args, **kwargs):
         kwargs['resource_dir'] = ('/var/tmp/casaba/drone%s'
                                   % uuid.uuid4().hex[:8])
@@ -338,17 +1033,20 @@ class CasabaDrone(SshTarballTransferMixin, Drone):
 
         self.module_dir = os.path.join(self.resource_dir, 'modules')
         self.fact_dir = os.path.join(self.resource_dir, 'facts')
+        self._log_stream = None
+        self._analyzers = {}
+        self._logs = {}
+        # number of output lines received per recipe
+        self._lines = {}
 
     def init_node(self):
         """
         Initializes node for manipulation.
         """
         super(CasabaDrone, self).init_node()
-        server = utils.ScriptRunner(self.node)
-        for pkg in ("puppet", "openssh-clients", "tar"):
-            server.append("rpm -q --whatprovides %(pkg)s || "
-                          "yum install -y %(pkg)s" % locals())
-        server.execute()
+        utils.package_manager.require(self.node,
+                                      ("puppet", "openssh-clients", "tar"))
+        utils.package_manager.ensure([self.node])
 
     def add_resource(self, path, resource_type=None):
         """
@@ -358,23 +1056,89 @@ class CasabaDrone(SshTarballTransferMixin, Drone):
         dest = '%ss' % resource_type
         super(CasabaDrone, self).add_resource(path, destination=dest)
 
-    def _finished(self, recipe):
-        recipe_base = os.path.basename(recipe)
-        log = os.path.join(self.recipe_dir,
-                           recipe_base.replace(".finished", ".log"))
-        local = utils.ScriptRunner()
-        local.append('scp -o StrictHostKeyChecking=no '
-                     '-o UserKnownHostsFile=/dev/null '
-                     'root@%s:%s %s' % (self.node, recipe, log))
+    def _recipe_log(self, recipe):
+        return os.path.join(self.local_tmpdir,
+                            '%s.log' % os.path.basename(recipe))
+
+    def _analyzer(self, recipe):
+        # XXX: drones should not depend on plugin modules, see above
+        from casaba.modules.puppet import LogAnalyzer
+        return LogAnalyzer(os.path.basename(recipe),
+                           logpath=self._recipe_log(recipe))
+
+    def _validate(self, recipe):
+        # output has been already checked while it was streamed
+        analyzer = self._analyzers.pop(recipe, None)
+        if analyzer:
+            self.messages.extend(analyzer.messages)
+
+    def _output(self, recipe, line):
+        """
+        Processes single line of output of running recipe.
+        """
+        self._lines[recipe] = self._lines.get(recipe, 0) + 1
+        if recipe not in self._logs:
+            self._logs[recipe] = open(self._recipe_log(recipe), 'a')
+        self._logs[recipe].write(line + '\n')
+        # output hook is optional for observers
+        output = getattr(self._observer, 'output', None)
+        if output:
+            output(self, recipe, line)
+        if recipe not in self._analyzers:
+            self._analyzers[recipe] = self._analyzer(recipe)
+        self._analyzers[recipe].feed(line)
+
+    def _close_stream(self):
+        if self._log_stream:
+            self._log_stream.close()
+            self._log_stream = None
+        for log in self._logs.itervalues():
+            log.close()
+        self._logs.clear()
+
+    def _poll_finished(self, recipes):
+        """
+        Reads output of all given recipes, which is streamed from node
+        in single ssh session. Output is stored in local logs and checked
+        for errors while Puppet is still running, so there is no log
+        to be copied back when the run ends.
+        """
+        finished = []
         try:
-            # once a remote puppet run has finished, we retrieve
-            # the log file and check it for errors
-            local.execute(log=False)
-            # if we got to this point the puppet apply has finished
-            return True
-        except utils.ScriptRuntimeError as e:
-            # the test raises an exception if the file doesn't exist yet
-            return False
+            stream = self._log_stream
+            if stream is None or not set(recipes) <= set(stream.recipes):
+                self._close_stream()
+                stream = self._log_stream = _LogStream(
+                    self.node, recipes, self._lines)
+            frames = stream.read(0)
+            if frames is None:
+                # session ended before all recipes finished, it is opened
+                # again on next check and continues from the last received
+                # line
+                self._close_stream()
+                frames = []
+            for recipe, line in frames:
+                if recipe not in recipes:
+                    continue
+                if line is None:
+                    finished.append(recipe)
+                    # log is created even for recipe without output
+                    log = (self._logs.pop(recipe, None) or
+                           open(self._recipe_log(recipe), 'a'))
+                    log.close()
+                else:
+                    self._output(recipe, line)
+        except Exception:
+            self._close_stream()
+            raise
+        if set(finished) == set(recipes):
+            self._close_stream()
+        if self._log_stream is None:
+            return finished, []
+        return finished, [self._log_stream.fileno()]
+
+    def _stop_waiting(self):
+        self._close_stream()
 
     def _apply(self, recipe):
         running = "%s.running" % recipe
@@ -399,11 +1163,91 @@ class CasabaDrone(SshTarballTransferMixin, Drone):
         logger = logging.getLogger()
         loglevel = logger.level <= logging.DEBUG and '--debug' or ''
         rdir = self.resource_dir
-        mdir = self._module_dir
+        mdir = self.module_dir
         server.append(
             "( flock %(rdir)s/ps.lock "
             "puppet apply %(loglevel)s --modulepath %(mdir)s "
             "%(recipe)s > %(running)s 2>&1 < /dev/null; "
             "mv %(running)s %(finished)s ) "
             "> /dev/null 2>&1 < /dev/null &" % locals())
+        # output of the run is followed until this process ends, pid file
+        # is renamed into place, so it is never read half written
+        server.append("echo $! > %(recipe)s.pid.tmp && "
+                      "mv %(recipe)s.pid.tmp %(recipe)s.pid" % locals())
         server.execute()
+
+
+class _LogStream(object):
+    """
+    Single ssh session streaming output of running recipes from node.
+    Every output line is sent as "L <index> <line>" frame, where index
+    is position of the recipe in list of streamed recipes, and end
+    of the recipe is sent as "F <index>" frame.
+    """
+    script = (
+        'follow() {\n'
+        # session can be opened before pid of the run is written
+        '    for i in $(seq 50); do\n'
+        '        [ -e $2.pid ] || [ -e $2.finished ] && break\n'
+        '        sleep 0.1\n'
+        '    done\n'
+        '    { tail -n +$3 -f --pid=$(cat $2.pid 2> /dev/null) $2.running '
+        '2> /dev/null || tail -n +$3 $2.finished 2> /dev/null; } '
+        '| sed -u "s/^/L $1 /"\n'
+        '    [ -e $2.finished ] && echo "F $1"\n'
+        '}\n'
+    )
+
+    def __init__(self, node, recipes, lines):
+        """
+        Parameter lines is dict mapping recipe to number of its output
+        lines which have been already received.
+        """
+        self.recipes = list(recipes)
+        script = self.script + ''.join(
+            'follow %d %s %d &\n' % (idx, recipe, lines.get(recipe, 0) + 1)
+            for idx, recipe in enumerate(self.recipes)) + 'wait\n'
+        cmd = utils.ssh_pool.ssh_command(node, 'bash')
+        with open(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=devnull, close_fds=True)
+        self.proc.stdin.write(script)
+        self.proc.stdin.close()
+        self._buffer = ''
+
+    def read(self, timeout):
+        """
+        Returns list of (recipe, line) pairs received within timeout,
+        line is None for finished recipe. Returns None when the session
+        has ended.
+        """
+        fd = self.fileno()
+        if not utils.wait_readable([fd], timeout):
+            return []
+        data = os.read(fd, 65536)
+        if not data:
+            return None
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        frames = []
+        for line in lines:
+            parts = line.split(' ', 2)
+            try:
+                recipe = self.recipes[int(parts[1])]
+            except (IndexError, ValueError):
+                continue
+            if parts[0] == 'F':
+                frames.append((recipe, None))
+            elif parts[0] == 'L':
+                frames.append((recipe, len(parts) > 2 and parts[2] or ''))
+        return frames
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
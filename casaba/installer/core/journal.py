@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Checkpoint journal allowing to resume failed deployments
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+
+
+JOURNAL_FILE = 'journal.json'
+LOG_DIR = 'logs'
+
+
+def _to_str(obj):
+    """
+    Converts unicode strings created by json module back to str.
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_to_str(i) for i in obj]
+    if isinstance(obj, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in obj.iteritems())
+    return obj
+
+
+def _snapshot(value):
+    """
+    Returns copy of given value created by JSON round-trip. Raises
+    ValueError if the copy would not be equal to the original value,
+    because for example it contains tuple or non-serializable object.
+    """
+    try:
+        copy = _to_str(json.loads(json.dumps(value)))
+    except (TypeError, ValueError):
+        raise ValueError('Value is not serializable.')
+    if copy != value or type(copy) is not type(value):
+        raise ValueError('Value does not survive serialization.')
+    return copy
+
+
+def _contains(value, words):
+    """
+    Returns True if any string in given value contains any of words.
+    """
+    if isinstance(value, basestring):
+        return any(word in value for word in words)
+    if isinstance(value, dict):
+        return any(_contains(k, words) or _contains(v, words)
+                   for k, v in value.iteritems())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return any(_contains(i, words) for i in value)
+    return False
+
+
+class Journal(object):
+    """
+    Persistent record of finished setup steps and applied recipes kept
+    in directory under CASABA_VAR_DIR. Every finished step is stored
+    together with fingerprint of config values it has read and changes
+    it has made to the config. When resuming, step with unchanged
+    fingerprint is skipped and its changes are applied to the config
+    instead. Steps changing secret config values (passwords) are not
+    journaled, so that secrets are not stored on disk, and they are run
+    again when resuming. Recipes are stored with digest of their inputs
+    together
+    with copy of their log and notices they reported. Temporary
+    directories on hosts kept for resumed run are recorded too, so that
+    they can be removed when the run is not resumed.
+    """
+    # config keys which differ on every run and are not step inputs
+    volatile_keys = frozenset(['DIR_LOG'])
+
+    def __init__(self):
+        self.directory = None
+        self.resume = False
+        # set when all steps have been finished
+        self.completed = False
+        # dict mapping host to list of temporary directories kept
+        # by previous run, which is not resumed
+        self.stale_dirs = {}
+        # config keys and values which must not be stored
+        self.secret_keys = frozenset()
+        self.secret_values = frozenset()
+        self._data = self._empty()
+        self._lock = threading.Lock()
+
+    def _empty(self):
+        return {'steps': {}, 'recipes': {}, 'kept_dirs': {}}
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def open(self, directory, resume=False, secret_keys=None,
+             secret_values=None):
+        """
+        Starts journaling to given directory. If resume is True, entries
+        recorded by previous run are used, otherwise they are dropped.
+        Steps changing config keys from secret_keys or values containing
+        any of secret_values are not journaled.
+        """
+        # TO-DO: complete logger name when logging will be setup correctly
+        logger = logging.getLogger()
+        self.directory = directory
+        self.resume = resume
+        self.stale_dirs = {}
+        self.secret_keys = frozenset(secret_keys or ())
+        self.secret_values = frozenset(i for i in secret_values or () if i)
+        self._data = self._empty()
+        path = os.path.join(directory, JOURNAL_FILE)
+        if resume and os.path.exists(path):
+            with open(path) as fp:
+                self._data.update(_to_str(json.load(fp)))
+            logger.debug('Loaded journal %s with %d steps and %d recipes.'
+                         % (path, len(self._data['steps']),
+                            len(self._data['recipes'])))
+        elif os.path.isdir(directory):
+            try:
+                with open(path) as fp:
+                    self.stale_dirs = _to_str(json.load(fp)).get(
+                        'kept_dirs', {})
+            except (IOError, ValueError):
+                pass
+            shutil.rmtree(directory, ignore_errors=True)
+        if not os.path.isdir(os.path.join(directory, LOG_DIR)):
+            os.makedirs(os.path.join(directory, LOG_DIR), 0o700)
+        os.chmod(directory, 0o700)
+        self.save()
+
+    def complete(self):
+        """
+        Marks the run as successfully completed.
+        """
+        self.completed = True
+
+    @property
+    def resumable(self):
+        """
+        True if anything has been journaled, so resumed run would skip
+        some work.
+        """
+        return bool(self._data['steps'] or self._data['recipes'])
+
+    def keep_dir(self, host, path):
+        """
+        Records temporary directory on host kept for resumed run.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            dirs = self._data['kept_dirs'].setdefault(host, [])
+            if path not in dirs:
+                dirs.append(path)
+        self.save()
+
+    def kept_dirs(self):
+        """
+        Returns dict mapping host to list of temporary directories kept
+        for resumed run.
+        """
+        with self._lock:
+            return dict((k, list(v))
+                        for k, v in self._data['kept_dirs'].iteritems())
+
+    def forget_dirs(self):
+        """
+        Drops records of kept temporary directories once they are removed.
+        """
+        self.stale_dirs = {}
+        if not self.enabled:
+            return
+        with self._lock:
+            self._data['kept_dirs'] = {}
+        self.save()
+
+    def save(self):
+        """
+        Atomically writes journal to disk.
+        """
+        if not self.enabled:
+            return
+        path = os.path.join(self.directory, JOURNAL_FILE)
+        with self._lock:
+            if os.path.exists(path + '.tmp'):
+                os.unlink(path + '.tmp')
+            fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(self._data, fp, indent=1)
+            os.rename(path + '.tmp', path)
+
+    def fingerprint(self, config, keys=None):
+        """
+        Returns digest of given config values. All values except volatile
+        ones are used if keys is not given.
+        """
+        if not keys:
+            keys = set(config) - self.volatile_keys
+        values = dict((k, config.get(k)) for k in keys)
+        data = json.dumps(values, sort_keys=True, default=repr)
+        return hashlib.sha1(data).hexdigest()
+
+    # steps
+    def finished_step(self, name, fingerprint):
+        """
+        Returns journal entry of given step if it has been finished with
+        the same fingerprint and it can be skipped, otherwise None.
+        """
+        if not self.resume:
+            return None
+        entry = self._data['steps'].get(name)
+        if entry and entry['fingerprint'] == fingerprint:
+            return entry
+        return None
+
+    def record_step(self, name, fingerprint, before, after, messages=None):
+        """
+        Records finished step. Parameters before and after are snapshots
+        of config created by method snapshot. Step is not recorded if its
+        changes cannot be stored.
+        """
+        if not self.enabled:
+            return
+        changed, removed = {}, []
+        try:
+            for key, value in after.iteritems():
+                if key not in before or before[key] != value:
+                    changed[key] = _snapshot(value)
+            removed = [i for i in before if i not in after]
+            messages = _snapshot(list(messages or []))
+        except ValueError:
+            logging.getLogger().debug('Changes made by step %s cannot be '
+                                      'journaled.' % name)
+            return
+        if (self.secret_keys.intersection(changed) or
+                _contains([changed, messages], self.secret_values)):
+            logging.getLogger().debug('Step %s changes secret values, it is '
+                                      'not journaled.' % name)
+            return
+        with self._lock:
+            self._data['steps'][name] = {'fingerprint': fingerprint,
+                                         'changed': changed,
+                                         'removed': removed,
+                                         'messages': messages}
+        self.save()
+
+    def snapshot(self, config, keys=None):
+        """
+        Returns copy of given config values (all values by default) used
+        for detection of config changes made by step.
+        """
+        if keys is None:
+            keys = config.keys()
+        return dict((k, _copy(config[k])) for k in keys if k in config)
+
+    # recipes
+    def applied_recipe(self, node, key):
+        """
+        Returns True if recipe identified by given key has been already
+        applied to the node.
+        """
+        if not self.resume:
+            return False
+        return '%s:%s' % (node, key) in self._data['recipes']
+
+    def record_recipe(self, node, key, log=None, messages=None):
+        """
+        Records applied recipe, stores copy of its log and list of notices
+        it has reported.
+        """
+        if not self.enabled:
+            return
+        name = '%s:%s' % (node, key)
+        stored = bool(log and os.path.exists(log))
+        if stored:
+            shutil.copyfile(log, self._log_path(name))
+            os.chmod(self._log_path(name), 0o600)
+        with self._lock:
+            self._data['recipes'][name] = {'log': stored,
+                                           'messages': list(messages or [])}
+        self.save()
+
+    def _recipe(self, node, key):
+        entry = self._data['recipes'].get('%s:%s' % (node, key))
+        if isinstance(entry, bool):
+            # entry recorded by older version of journal
+            entry = {'log': entry, 'messages': []}
+        return entry or {'log': False, 'messages': []}
+
+    def recipe_messages(self, node, key):
+        """
+        Returns list of notices reported by applied recipe.
+        """
+        return list(self._recipe(node, key)['messages'])
+
+    def restore_log(self, node, key, log):
+        """
+        Copies stored log of applied recipe to given path.
+        """
+        if self._recipe(node, key)['log']:
+            shutil.copy(self._log_path('%s:%s' % (node, key)), log)
+
+    def _log_path(self, name):
+        digest = hashlib.sha1(name).hexdigest()
+        return os.path.join(self.directory, LOG_DIR, '%s.log' % digest)
+
+
+def _copy(value):
+    # JSON round-trip makes deep copy of most config values, values
+    # which cannot survive it are compared by identity only
+    try:
+        return _snapshot(value)
+    except ValueError:
+        return value
+
+
+journal = Journal()
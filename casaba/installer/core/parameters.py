@@ -58,3 +58,95 @@ class Group(Parameter):
             if getattr(param, attr) == value:
                 result.append(param)
         return result
+
+
+class ParameterRegistry(object):
+    """
+    Ordered list of groups with indexes of their parameters, so that
+    parameters can be looked up without scanning all groups. Parameters
+    are indexed by attributes from indexed_keys, which are not changed
+    after plugins are initialized. Queries by other attributes scan all
+    parameters.
+    """
+    indexed_keys = ('CONF_NAME', 'CMD_OPTION', 'MASK_INPUT', 'USE_DEFAULT',
+                    'NEED_CONFIRM', 'CONDITION', 'LOOSE_VALIDATION')
+
+    def __init__(self):
+        self.groups = []
+        self._group_names = {}
+        # position of group (by id) in self.groups
+        self._ranks = {}
+        # id of parameter -> group owning it
+        self._owners = {}
+        # attribute -> value -> list of parameters in order of groups
+        self._indexes = dict((key, {}) for key in self.indexed_keys)
+
+    def add_group(self, group, index=None):
+        """
+        Registers group at given position (at the end by default) and
+        adds its parameters to indexes.
+        """
+        if index is None or index >= len(self.groups):
+            self._ranks[id(group)] = len(self.groups)
+            self.groups.append(group)
+            appended = True
+        else:
+            self.groups.insert(index, group)
+            self._ranks = dict((id(g), i) for i, g in enumerate(self.groups))
+            appended = False
+        self._group_names.setdefault(group.GROUP_NAME, group)
+
+        rank = self._ranks[id(group)]
+        for param in group.parameters.itervalues():
+            self._owners[id(param)] = group
+            for key, index in self._indexes.iteritems():
+                try:
+                    params = index.setdefault(getattr(param, key), [])
+                except TypeError:
+                    # unhashable values are not indexed
+                    continue
+                pos = len(params)
+                if not appended:
+                    # parameters of inserted group go before parameters
+                    # of the groups following it
+                    while pos and self._rank(params[pos - 1]) > rank:
+                        pos -= 1
+                params.insert(pos, param)
+
+    def _rank(self, param):
+        return self._ranks[id(self._owners[id(param)])]
+
+    def get_group(self, name):
+        """
+        Returns first registered group with given name or None.
+        """
+        return self._group_names.get(name)
+
+    def get(self, name):
+        """
+        Returns parameter with given CONF_NAME or None.
+        """
+        params = self._indexes['CONF_NAME'].get(name)
+        return params and params[0] or None
+
+    def query(self, **attrs):
+        """
+        Returns list of parameters which have all given attributes
+        of given values, in order of groups.
+        """
+        candidates = None
+        for key, value in attrs.iteritems():
+            if key not in self._indexes:
+                continue
+            try:
+                params = self._indexes[key].get(value, [])
+            except TypeError:
+                continue
+            if candidates is None or len(params) < len(candidates):
+                candidates = params
+        if candidates is None:
+            candidates = [param for group in self.groups
+                          for param in group.parameters.itervalues()]
+        return [param for param in candidates
+                if all(getattr(param, key) == value
+                       for key, value in attrs.iteritems())]
@@ -18,19 +18,36 @@ Base class for steps & sequences
 
 import sys
 import logging
+import threading
+import time
 import traceback
 
 from .. import utils
 from ..exceptions import SequenceError
+from .journal import journal
 
 
 class Step(object):
     """
-    Wrapper for function representing single setup step.
+    Wrapper for function representing single setup step. Step can
+    declare names of resources (usually CONF keys) it reads via requires
+    and names of resources it writes via provides. Steps declaring
+    neither of them are considered to depend on everything. Resumable
+    step is skipped when resuming failed run (see core.journal) if the
+    config values it reads have not changed since it has been finished.
+    Step with side effects outside of the config (for example on nodes)
+    should be given verify function, which is called with config
+    restored from the journal and returns False if the effects are gone
+    and the step has to be run again.
     """
-    def __init__(self, name, function, title=None):
+    def __init__(self, name, function, title=None, requires=None,
+                 provides=None, resumable=False, verify=None):
         self.name = name
         self.title = title or ('Step: %s' % name)
+        self.requires = frozenset(requires or [])
+        self.provides = frozenset(provides or [])
+        self.resumable = resumable
+        self.verify = verify
 
         # process step function
         if function and not callable(function):
@@ -45,9 +62,21 @@ class Step(object):
         logger = logging.getLogger()
         logger.debug('Running step %s.' % self.name)
 
+        journaled = self.resumable and journal.enabled
+        if journaled:
+            fingerprint = journal.fingerprint(config, self.requires)
+            entry = journal.finished_step(self.name, fingerprint)
+            if entry and self._verify(entry, config):
+                self._restore(entry, config, messages)
+                return
+            keys = self.provides or None
+            before = journal.snapshot(config, keys)
+            count = len(messages)
+
         # execute and report state
         try:
-            self.function(config, messages)
+            with utils.profiler.span('step', self.name):
+                self.function(config, messages)
         except Exception as ex:
             logger.debug(traceback.format_exc())
             state = utils.state_message(self.title, 'ERROR', 'red')
@@ -55,27 +84,74 @@ class Step(object):
             sys.stdout.flush()
             raise
         else:
+            if journaled:
+                journal.record_step(self.name, fingerprint, before,
+                                    journal.snapshot(config, keys),
+                                    messages[count:])
             state = utils.state_message(self.title, 'DONE', 'green')
             sys.stdout.write('%s\n' % state)
             sys.stdout.flush()
 
+    def _verify(self, entry, config):
+        """
+        Returns True if effects of journaled run of the step are still
+        in place.
+        """
+        if self.verify is None:
+            return True
+        restored = dict(config)
+        restored.update(entry['changed'])
+        for key in entry['removed']:
+            restored.pop(key, None)
+        try:
+            if self.verify(restored):
+                return True
+        except Exception:
+            logging.getLogger().debug(traceback.format_exc())
+        logging.getLogger().debug('Effects of step %s are gone, running it '
+                                  'again.' % self.name)
+        return False
+
+    def _restore(self, entry, config, messages):
+        """
+        Applies changes journaled by previous run of the step instead
+        of running it.
+        """
+        logger = logging.getLogger()
+        logger.debug('Step %s has been already finished, restoring its '
+                     'changes: %s' % (self.name, sorted(entry['changed'])))
+        config.update(entry['changed'])
+        for key in entry['removed']:
+            config.pop(key, None)
+        messages.extend(entry['messages'])
+        state = utils.state_message(self.title, 'SKIPPED', 'blue')
+        sys.stdout.write('%s\n' % state)
+        sys.stdout.flush()
+
 
 class Sequence(object):
     """
-    Wrapper for sequence of setup steps.
+    Wrapper for sequence of setup steps. Resources declared via requires
+    and provides are shared by all steps of the sequence.
     """
     def __init__(self, name, steps, title=None, condition=None,
-                 cond_match=None):
+                 cond_match=None, requires=None, provides=None):
         self.name = name
         self.title = title
         self.condition = condition
         self.cond_match = cond_match
+        self.requires = frozenset(requires or [])
+        self.provides = frozenset(provides or [])
 
         # process sequence steps
         self.steps = utils.SortedDict()
         for step in steps:
             name, func = step['name'], step['function']
-            self.steps[name] = Step(name, func, title=step.get('title'))
+            self.steps[name] = Step(name, func, title=step.get('title'),
+                                    requires=step.get('requires'),
+                                    provides=step.get('provides'),
+                                    resumable=step.get('resumable', False),
+                                    verify=step.get('verify'))
 
     def validate_condition(self, config):
         """
@@ -105,5 +181,131 @@ class Sequence(object):
         if self.title:
             sys.stdout.write('%s\n' % self.title)
             sys.stdout.flush()
-        for step in self.steps.itervalues():
-            step.run(config=config, messages=messages)
+        with utils.profiler.span('sequence', self.name):
+            for step in self.steps.itervalues():
+                step.run(config=config, messages=messages)
+
+
+class StepScheduler(object):
+    """
+    Runs steps of given sequences concurrently using at most workers
+    threads. Step is started as soon as all previous steps it depends on
+    are finished. Step depends on previous step if one of them requires
+    or provides resource provided by the other one. Steps which don't
+    declare any resources work as barriers, so sequences without
+    declarations run in the same order as when they are run one by one.
+    """
+    def __init__(self, sequences, workers=1):
+        self.workers = max(workers, 1)
+        self.units = []
+        for sequence in sequences:
+            for step in sequence.steps.itervalues():
+                requires = step.requires | sequence.requires
+                if sequence.condition:
+                    requires = requires | frozenset([sequence.condition])
+                provides = step.provides | sequence.provides
+                self.units.append((sequence, step, requires, provides))
+        self.dependencies = [self._dependencies(idx)
+                             for idx in range(len(self.units))]
+
+    def _dependencies(self, idx):
+        """
+        Returns set of indexes of units given unit has to wait for.
+        """
+        sequence, step, requires, provides = self.units[idx]
+        result = set()
+        for prev in range(idx):
+            prev_requires, prev_provides = self.units[prev][2:]
+            if (not (requires or provides) or
+                    not (prev_requires or prev_provides) or
+                    requires & prev_provides or
+                    provides & (prev_requires | prev_provides)):
+                result.add(prev)
+        return result
+
+    def run(self, config=None, messages=None):
+        """
+        Runs all steps. If any step fails, no other step is started and
+        error of the first failed step is raised once running steps
+        are finished.
+        """
+        config = config if config is not None else {}
+        messages = messages if messages is not None else []
+        lock = threading.Condition()
+        pending = list(range(len(self.units)))
+        running, finished, failed = set(), set(), []
+        # sequence -> result of its condition, evaluated before the first
+        # step of the sequence is started
+        started = {}
+        # sequence -> [start time, number of unfinished steps, error]
+        # of sequences running, for their profiler spans
+        spans = {}
+
+        def run_unit(idx):
+            sequence, step = self.units[idx][:2]
+            error = False
+            try:
+                if started[sequence]:
+                    step.run(config=config, messages=messages)
+            except Exception:
+                error = True
+                failed.append(sys.exc_info())
+            finally:
+                with lock:
+                    running.discard(idx)
+                    finished.add(idx)
+                    if sequence in spans:
+                        span = spans[sequence]
+                        span[1] -= 1
+                        span[2] = span[2] or error
+                        if not span[1]:
+                            self._record(sequence, spans.pop(sequence))
+                    lock.notify_all()
+
+        with lock:
+            while pending or running:
+                if failed and not running:
+                    break
+                ready = []
+                if not failed:
+                    ready = [i for i in pending
+                             if self.dependencies[i] <= finished]
+                for idx in ready[:self.workers - len(running)]:
+                    sequence = self.units[idx][0]
+                    if sequence not in started:
+                        started[sequence] = self._start(sequence, config)
+                        if started[sequence]:
+                            spans[sequence] = [time.time(),
+                                               len(sequence.steps), False]
+                    pending.remove(idx)
+                    running.add(idx)
+                    thread = threading.Thread(target=run_unit, args=(idx,))
+                    thread.daemon = True
+                    thread.start()
+                # wait with timeout keeps main thread responsive to Ctrl+C
+                lock.wait(1)
+        # sequences with steps left out because of failure
+        for sequence, span in spans.items():
+            span[2] = True
+            self._record(sequence, span)
+        if failed:
+            raise failed[0][1]
+
+    def _record(self, sequence, span):
+        """
+        Records profiler span of sequence, same as Sequence.run does.
+        """
+        start, unfinished, error = span
+        attrs = {'error': True} if error else {}
+        utils.profiler.record('sequence', sequence.name, start, time.time(),
+                              **attrs)
+
+    def _start(self, sequence, config):
+        if not sequence.validate_condition(config):
+            return False
+        logger = logging.getLogger()
+        logger.debug('Running sequence %s.' % sequence.name)
+        if sequence.title:
+            sys.stdout.write('%s\n' % sequence.title)
+            sys.stdout.flush()
+        return True
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers for content-addressed transfers of drone resources
+"""
+
+import os
+import pipes
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+import threading
+import subprocess
+
+from .. import utils
+from ..exceptions import MultiHostError
+from ..utils.datastructures import SortedDict
+from ..utils.ssh import SSH_OPTIONS
+
+
+DIRECTORY = 'dir'
+
+_digest_cache = {}
+_digest_lock = threading.Lock()
+
+
+def text_digest(text):
+    """
+    Returns SHA1 hex digest of given string.
+    """
+    return hashlib.sha1(text).hexdigest()
+
+
+def file_digest(path):
+    """
+    Returns SHA1 hex digest of content of given file. Digests are cached
+    as long as size and modification time of the file stay the same.
+    """
+    info = os.stat(path)
+    key = (path, info.st_size, info.st_mtime)
+    with _digest_lock:
+        if key in _digest_cache:
+            return _digest_cache[key]
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    with _digest_lock:
+        _digest_cache[key] = digest
+    return digest
+
+
+def entry_digest(path):
+    """
+    Returns digest of given file system entry. Directories does not have
+    any content digest and symbolic links are identified by their target.
+    """
+    if os.path.islink(path):
+        return 'link-%s' % text_digest(os.readlink(path))
+    if os.path.isdir(path):
+        return DIRECTORY
+    return file_digest(path)
+
+
+def build_manifest(entries):
+    """
+    Walks given list of (path, arcname) pairs and returns SortedDict
+    mapping arcname of every directory, file and symbolic link to tuple
+    (path, digest). Directories always precede their content.
+    """
+    manifest = SortedDict()
+    for path, arcname in entries:
+        manifest[arcname] = (path, entry_digest(path))
+        if os.path.islink(path) or not os.path.isdir(path):
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in dirs + sorted(files):
+                full = os.path.join(root, name)
+                arc = os.path.join(arcname, os.path.relpath(full, path))
+                manifest[arc] = (full, entry_digest(full))
+    return manifest
+
+
+def dump_manifest(manifest):
+    """
+    Returns text representation of given manifest with one
+    "<digest> <arcname>" line per entry.
+    """
+    return ''.join('%s %s\n' % (digest, arcname)
+                   for arcname, (path, digest) in manifest.iteritems())
+
+
+def load_manifest(text):
+    """
+    Parses text created by dump_manifest to dict mapping arcname
+    to digest.
+    """
+    result = {}
+    for line in text.splitlines():
+        digest, sep, arcname = line.partition(' ')
+        if sep:
+            result[arcname] = digest
+    return result
+
+
+def diff_manifest(manifest, remote):
+    """
+    Compares local manifest with remote one loaded by load_manifest.
+    Returns tuple (changed, removed) where changed is list of arcnames
+    which have to be sent and removed is list of arcnames which have
+    to be removed on remote side before changed entries are extracted.
+    """
+    changed, removed = [], []
+    for arcname, (path, digest) in manifest.iteritems():
+        remote_digest = remote.get(arcname)
+        if remote_digest == digest:
+            continue
+        changed.append(arcname)
+        if remote_digest is not None and DIRECTORY in (remote_digest,
+                                                       digest):
+            # type of the entry has changed, tar won't replace it
+            removed.append(arcname)
+    removed.extend(sorted(set(remote) - set(manifest)))
+    return changed, removed
+
+
+def pack(sink, add_members, codec):
+    """
+    Writes tarball created by calling add_members with opened tarball
+    object to given file object. Tarball is compressed by given codec,
+    which can be none, gzip or zstd. Returns number of written bytes
+    or None if it is unknown.
+    """
+    compressor = None
+    target = _CountingWriter(sink)
+    if codec == 'zstd':
+        compressor = subprocess.Popen(['zstd', '-q', '-c'],
+                                      stdin=subprocess.PIPE, stdout=sink,
+                                      close_fds=True)
+        target = compressor.stdin
+    tar = tarfile.open(fileobj=target,
+                       mode=codec == 'gzip' and 'w|gz' or 'w|')
+    try:
+        add_members(tar)
+        tar.close()
+    finally:
+        if compressor:
+            compressor.stdin.close()
+            if compressor.wait():
+                raise IOError('Failed to compress tarball by zstd.')
+    return compressor is None and target.count or None
+
+
+class _CountingWriter(object):
+    """
+    Write-only file object wrapper counting written bytes.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.fileobj.write(data)
+
+
+class PackCache(object):
+    """
+    Keeps tarballs identified by their content, so that the same content
+    sent to many nodes is packed only once and packing CPU and local disk
+    usage does not grow with number of nodes.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._packs = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, build):
+        """
+        Returns path to tarball with given name. Name has to identify
+        content of the tarball. Tarball is created by calling build with
+        its path on the first request, simultaneous requests for the same
+        tarball wait until it is built.
+        """
+        with self._lock:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix='casaba-packs-')
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._packs:
+                path = os.path.join(self.directory, name)
+                build(path)
+                self._packs[name] = path
+            return self._packs[name]
+
+    def clear(self):
+        """
+        Removes all cached tarballs.
+        """
+        with self._lock:
+            if self.directory is not None:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.directory = None
+            self._packs.clear()
+            self._locks.clear()
+
+
+pack_cache = PackCache()
+
+
+def ssh_send(source, target, path, dest):
+    """
+    Sends file to dest on target node. If source is None local file path
+    is sent, otherwise the file is relayed from dest on source node. Relay
+    logs in to target node with credentials of source node itself (no ssh
+    agent is forwarded to nodes), so it fails unless nodes are able
+    to log in to each other, see TreeDistributor.
+    """
+    pool = utils.ssh_pool
+    store = ('mkdir -p %(dir)s && cat > %(dest)s.part && '
+             'mv -f %(dest)s.part %(dest)s'
+             % {'dir': os.path.dirname(dest), 'dest': dest})
+    if source is None:
+        cmd = pool.ssh_command(target, store)
+        stdin = open(path, 'rb')
+    else:
+        # input redirection fails if source does not hold the file,
+        # while pipeline from cat would store empty file on target
+        # batch mode makes relay fail instead of prompting for password
+        relay = ('ssh %s -o BatchMode=yes %s@%s %s < %s'
+                 % (' '.join(SSH_OPTIONS), pool.user, target,
+                    pipes.quote(store), dest))
+        cmd = pool.ssh_command(source, relay)
+        stdin = open(os.devnull, 'rb')
+    try:
+        proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=True)
+        out, err = proc.communicate()
+    finally:
+        stdin.close()
+    if proc.returncode:
+        # TO-DO: change to appropriate exception
+        raise RuntimeError('Failed to send %s to node %s from %s. '
+                           'Reason: %s' % (os.path.basename(dest), target,
+                                           source or 'installer host',
+                                           err.strip()))
+
+
+class TreeDistributor(object):
+    """
+    Distributes file to many nodes in waves. In every wave each host
+    which already has the file (the installer host in the first wave)
+    sends it to up to fanout nodes which don't have it, so number
+    of nodes having the file grows geometrically and distribution takes
+    time proportional to log(N) instead of N single transfers from
+    the installer host. Nodes which failed to get the file from another
+    node (e.g. because nodes are not able to log in to each other) get
+    it directly from the installer host after the last wave.
+    """
+    def __init__(self, fanout=2, send=None, workers=None):
+        if fanout < 1:
+            raise ValueError('Fan-out degree has to be positive number.')
+        self.fanout = fanout
+        # callable(source, target, path, dest) sending the file, source
+        # is None for the installer host, see ssh_send
+        self.send = send or ssh_send
+        # maximal number of transfers running at once
+        self.workers = workers
+
+    def schedule(self, holders, pending):
+        """
+        Returns next wave as list of (source, target) pairs. Targets are
+        popped from given list of pending nodes.
+        """
+        wave = []
+        for source in holders:
+            for i in range(self.fanout):
+                if not pending:
+                    return wave
+                wave.append((source, pending.pop(0)))
+        return wave
+
+    def distribute(self, path, dest, nodes):
+        """
+        Sends local file path to dest on all given nodes. Nodes which
+        failed to receive the file are not used as relays, MultiHostError
+        is raised for them when distribution is finished.
+        """
+        # TO-DO: complete logger name when logging will be setup correctly
+        logger = logging.getLogger()
+        holders, errors, direct = [None], {}, []
+        pending = list(nodes)
+
+        def send(pair):
+            self.send(pair[0], pair[1], path, dest)
+
+        while pending:
+            wave = self.schedule(holders, pending)
+            logger.debug('Distributing %s: %s' % (
+                os.path.basename(dest),
+                ', '.join('%s -> %s' % (source or 'local', target)
+                          for source, target in wave)))
+            results = utils.parallel_map(send, wave, workers=self.workers)
+            for (source, target), (result, exc_info) in zip(wave, results):
+                if exc_info and source is not None:
+                    logger.debug('Failed to relay %s from %s to %s: %s' % (
+                        os.path.basename(dest), source, target, exc_info[1]))
+                    direct.append((None, target))
+                elif exc_info:
+                    errors[target] = exc_info[1]
+                else:
+                    holders.append(target)
+        if direct:
+            logger.debug('Distributing %s directly to %s' % (
+                os.path.basename(dest), ', '.join(t for s, t in direct)))
+            results = utils.parallel_map(send, direct, workers=self.workers)
+            for (source, target), (result, exc_info) in zip(direct, results):
+                if exc_info:
+                    errors[target] = exc_info[1]
+        if errors:
+            msg = ('Failed to distribute %s to %d of %d nodes:\n%s' %
+                   (os.path.basename(dest), len(errors), len(nodes),
+                    '\n'.join('[%s] %s' % (node, errors[node])
+                              for node in sorted(errors))))
+            raise MultiHostError(msg, errors=errors)
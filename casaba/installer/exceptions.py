@@ -25,15 +25,23 @@ __all__ = (
 
     'NetworkError',
     'ScriptRuntimeError',
+    'MultiHostError',
 )
 
 
 class CasabaError(Exception):
-    """Default Exception class for casaba installer."""
+    """
+    Default Exception class for casaba installer. Attributes stdout
+    and stderr hold end of output of failed command, whole output
+    is available from OutputBuffer objects in attributes stdout_buffer
+    and stderr_buffer (see utils.streams) if it has been kept.
+    """
     def __init__(self, *args, **kwargs):
         super(CasabaError, self).__init__(*args)
         self.stdout = kwargs.get('stdout', None)
         self.stderr = kwargs.get('stderr', None)
+        self.stdout_buffer = kwargs.get('stdout_buffer', None)
+        self.stderr_buffer = kwargs.get('stderr_buffer', None)
 
 
 class PuppetError(Exception):
@@ -50,6 +58,11 @@ class InstallError(CasabaError):
     pass
 
 
+class AbortedError(InstallError):
+    """Raised when drone stops waiting for recipes applied on node."""
+    pass
+
+
 class FlagValidationError(InstallError):
     """Raised when single flag validation fails."""
     pass
@@ -80,6 +93,19 @@ class ScriptRuntimeError(CasabaError):
     pass
 
 
+class MultiHostError(ScriptRuntimeError):
+    """
+    Raised when utils.ScriptRunner.execute_on or drone fleet operation
+    fails on some of the hosts. Attribute errors maps failed hosts
+    to appropriate exceptions, attribute aborted lists hosts where
+    operation was aborted because of the failure.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MultiHostError, self).__init__(*args, **kwargs)
+        self.errors = kwargs.get('errors', {})
+        self.aborted = kwargs.get('aborted', [])
+
+
 class ExecuteRuntimeError(CasabaError):
     """Raised when utils.execute does not end successfully."""
 
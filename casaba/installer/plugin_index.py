@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cached index of plugins and their parameters, which allows to build
+command line parser and documentation without importing plugins
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+
+from .core.parameters import Group
+from .core.parameters import ParameterRegistry
+
+
+INDEX_VERSION = 2
+# attributes of groups and parameters needed by command line parser and
+# documentation, other attributes (for example default values computed
+# from environment of the installer host) are not indexed
+GROUP_KEYS = ('GROUP_NAME', 'DESCRIPTION')
+PARAMETER_KEYS = ('CONF_NAME', 'CMD_OPTION', 'USAGE', 'USE_DEFAULT')
+# Looking for files that end with ###.py, example: a_plugin_100.py
+PLUGIN_RE = re.compile(r'^(.+\_(\d\d\d))\.py$')
+
+
+def plugin_key(filename):
+    """
+    Used to sort the plugin file list according to the number at the end
+    of the plugin module.
+    """
+    return int(PLUGIN_RE.match(filename).group(2))
+
+
+def list_plugins(directory):
+    """
+    Returns sorted list of (module name, file path) of plugins
+    in given directory.
+    """
+    files = sorted((f for f in os.listdir(directory)
+                    if f[0] != '_' and PLUGIN_RE.match(f)), key=plugin_key)
+    return [(PLUGIN_RE.match(f).group(1), os.path.join(directory, f))
+            for f in files]
+
+
+def _file_digest(path):
+    with open(path, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def _stat(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return [info.st_mtime, info.st_size]
+
+
+def _tree_stat(directories):
+    """
+    Returns digest of modification times and sizes of all python files
+    in given directories.
+    """
+    items = []
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.py'):
+                    path = os.path.join(root, name)
+                    items.append([path, _stat(path)])
+    return hashlib.sha1(json.dumps(items)).hexdigest()
+
+
+def _serializable(attributes, keys):
+    result = {}
+    for key in keys:
+        if key not in attributes:
+            continue
+        try:
+            json.dumps(attributes[key])
+        except (TypeError, ValueError):
+            continue
+        result[key] = attributes[key]
+    return result
+
+
+class _Recorder(object):
+    """
+    Controller replacement recording groups registered by initConfig
+    of a plugin.
+    """
+    def __init__(self):
+        self.calls = []
+        self.CONF = {}
+
+    def addGroup(self, group, params):
+        self.calls.append(['add', None, _serializable(group, GROUP_KEYS),
+                           [_serializable(i, PARAMETER_KEYS)
+                            for i in params]])
+
+    def insertGroupBeforeGroup(self, groupName, group, params):
+        self.calls.append(['insert', groupName,
+                           _serializable(group, GROUP_KEYS),
+                           [_serializable(i, PARAMETER_KEYS)
+                            for i in params]])
+
+
+class PluginIndex(object):
+    """
+    Manifest of plugins in their order with groups and parameters they
+    register, stored in JSON file. Entry of a plugin is reused as long
+    as modification time or content of the plugin file and of the
+    documentation file, which provides usage of parameters, does not
+    change. Otherwise the plugin is imported and its initConfig is called
+    to refresh the entry. Whole index is dropped when any python file
+    in dependencies, directories of modules imported by plugins, changes.
+    """
+    def __init__(self, directory, path, doc=None, dependencies=None):
+        self.directory = directory
+        self.path = path
+        self.doc = doc
+        self.dependencies = dependencies or []
+        self.plugins = []
+        self._entries = {}
+
+    def load(self, importer=None):
+        """
+        Loads manifest and refreshes outdated entries. Parameter importer
+        is callable returning plugin module for given module name and file
+        path (__import__ by default). Returns self.
+        """
+        # TO-DO: complete logger name when logging will be setup correctly
+        logger = logging.getLogger()
+        importer = importer or (lambda name, path: __import__(name))
+        try:
+            with open(self.path) as fp:
+                cached = json.load(fp)
+        except (IOError, ValueError):
+            cached = {}
+        doc = self.doc and _stat(self.doc)
+        deps = _tree_stat(self.dependencies)
+        if (cached.get('version') != INDEX_VERSION or
+                cached.get('doc') != doc or cached.get('deps') != deps):
+            cached = {}
+        entries = cached.get('plugins', {})
+
+        changed = False
+        self.plugins = list_plugins(self.directory)
+        self._entries = {}
+        for name, path in self.plugins:
+            entry = entries.get(name)
+            stat = _stat(path)
+            if entry and entry['stat'] != stat:
+                # file has been touched, but it might be the same
+                if entry['sha1'] == _file_digest(path):
+                    entry['stat'] = stat
+                    changed = True
+                else:
+                    entry = None
+            if not entry:
+                logger.debug('Indexing plugin %s' % name)
+                recorder = _Recorder()
+                importer(name, path).initConfig(recorder)
+                entry = {'stat': stat, 'sha1': _file_digest(path),
+                         'calls': recorder.calls}
+                changed = True
+            self._entries[name] = entry
+
+        if changed or set(entries) != set(self._entries):
+            self.save(doc, deps)
+        return self
+
+    def save(self, doc=None, deps=None):
+        """
+        Atomically writes manifest to disk. Failures are not fatal,
+        the index will be built again next time.
+        """
+        data = {'version': INDEX_VERSION, 'doc': doc, 'deps': deps,
+                'plugins': self._entries}
+        try:
+            with open(self.path + '.tmp', 'w') as fp:
+                json.dump(data, fp)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as ex:
+            logging.getLogger().debug('Failed to save plugin index %s: %s'
+                                      % (self.path, ex))
+
+    def registry(self):
+        """
+        Returns ParameterRegistry with groups and parameters of all plugins
+        in order they would be registered to Controller.
+        """
+        registry = ParameterRegistry()
+        for name, path in self.plugins:
+            for action, before, group, params in self._entries[name]['calls']:
+                index = None
+                if action == 'insert':
+                    target = registry.get_group(before)
+                    if target is not None:
+                        index = registry.groups.index(target)
+                registry.add_group(Group(group, params), index=index)
+        return registry
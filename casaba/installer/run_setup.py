@@ -19,7 +19,6 @@ import datetime
 import getpass
 import logging
 import os
-import re
 import sys
 from StringIO import StringIO
 import traceback
@@ -32,13 +31,16 @@ from optparse import OptionParser
 import basedefs
 import validators
 from . import utils
+from .core.journal import journal
+from .core.transfer import pack_cache
 import processors
 import output_messages
 from .exceptions import FlagValidationError
 from .exceptions import ParamValidationError
+from .plugin_index import list_plugins
+from .plugin_index import PluginIndex
 
 from casaba.modules.common import filtered_hosts
-from casaba.version import version_info
 from setup_controller import Controller
 
 controller = Controller()
@@ -52,7 +54,7 @@ tmpfiles = []
 
 def initLogging(debug):
     try:
-        logFile = os.path.join(basedefs.DIR_LOG, basedefs.FILE_LOG)
+        logFile = os.path.join(basedefs.runtime.DIR_LOG, basedefs.FILE_LOG)
 
         # Create the log file with specific permissions, puppet has a habbit of putting
         # passwords in logs
@@ -212,11 +214,10 @@ def _addDefaultsToMaskedValueSet():
     in the 'masked_value_set'
     """
     global masked_value_set
-    for group in controller.getAllGroups():
-        for param in group.parameters.itervalues():
-            # Keep default password values masked, but ignore default empty values
-            if ((param.MASK_INPUT is True) and param.DEFAULT_VALUE != ""):
-                masked_value_set.add(param.DEFAULT_VALUE)
+    for param in controller.queryParams(MASK_INPUT=True):
+        # Keep default password values masked, but ignore default empty values
+        if param.DEFAULT_VALUE != "":
+            masked_value_set.add(param.DEFAULT_VALUE)
 
 
 def _updateMaskedValueSet():
@@ -226,10 +227,10 @@ def _updateMaskedValueSet():
     in the 'masked_value_set'
     """
     global masked_value_set
-    for confName in controller.CONF:
+    for param in controller.queryParams(MASK_INPUT=True):
         # Add all needed values to masked_value_set
-        if (controller.getParamKeyValue(confName, "MASK_INPUT") is True):
-            masked_value_set.add(controller.CONF[confName])
+        if param.CONF_NAME in controller.CONF:
+            masked_value_set.add(controller.CONF[param.CONF_NAME])
 
 
 def mask(input):
@@ -239,21 +240,17 @@ def mask(input):
     via the user input
     If it finds, it replaces them with '********'
     """
-    output = copy.deepcopy(input)
+    # only string values are masked, so shallow copy is enough
+    output = input
     if isinstance(input, types.DictType):
-        for key in input:
-            if isinstance(input[key], types.StringType):
-                output[key] = utils.mask_string(input[key],
-                                                masked_value_set)
+        output = copy.copy(input)
+        for key, value in input.iteritems():
+            if isinstance(value, types.StringType):
+                output[key] = utils.mask_string(value, masked_value_set)
     if isinstance(input, types.ListType):
-        for item in input:
-            org = item
-            orgIndex = input.index(org)
-            if isinstance(item, types.StringType):
-                item = utils.mask_string(item, masked_value_set)
-            if item != org:
-                output.remove(org)
-                output.insert(orgIndex, item)
+        output = [utils.mask_string(item, masked_value_set)
+                  if isinstance(item, types.StringType) else item
+                  for item in input]
     if isinstance(input, types.StringType):
             output = utils.mask_string(input, masked_value_set)
 
@@ -279,13 +276,20 @@ def removeMaskString(maskedString):
         masked_value_set.remove(maskedString)
 
 
-def validate_param_value(param, value):
+def validate_param_value(param, value, deferred=None):
+    """
+    Validates value of given parameter. If deferred (DeferredValidation)
+    is given, network bound validators are only registered to it.
+    """
     cname = param.CONF_NAME
     logging.debug("Validating parameter %s." % cname)
 
     val_list = param.VALIDATORS or []
     opt_list = param.OPTION_LIST
     for val_func in val_list:
+        if deferred is not None and getattr(val_func, 'network_bound', False):
+            deferred.add(cname, val_func, value, opt_list)
+            continue
         try:
             val_func(value, opt_list)
         except ParamValidationError as ex:
@@ -317,7 +321,7 @@ def process_param_value(param, value):
     return _value
 
 
-def _handleGroupCondition(config, conditionName, conditionValue):
+def _handleGroupCondition(answers, conditionName, conditionValue, deferred=None):
     """
     handle params group pre/post condition
     checks if a group has a pre/post condition
@@ -332,62 +336,90 @@ def _handleGroupCondition(config, conditionName, conditionValue):
     # If the condition is a string - just read it to global conf
     # We assume that if we get a string as a member it is the name of a member of conf_params
     elif isinstance(conditionName, types.StringType):
-        conditionValue = _loadParamFromFile(config, "general", conditionName)
+        conditionValue = _loadParamFromFile(answers, conditionName, deferred)
     else:
         # Any other type is invalid
         raise TypeError("%s type (%s) is not supported" % (conditionName, type(conditionName)))
     return conditionValue
 
 
-def _loadParamFromFile(config, section, param_name):
+def _parseAnswerFile(answerFile, section="general"):
+    """
+    Parses answer file once and returns flat dict of its options
+    in given section. Values of parameters missing in answer file are
+    resolved from parameters they deprecate, conflicting deprecated values
+    are returned as ValueError instances.
     """
-    read param from file
+    fconf = ConfigParser.ConfigParser()
+    fconf.read(answerFile)
+    # option names are case insensitive
+    answers = dict(fconf.items(section))
+
+    deprecations = {}
+    for group in controller.getAllGroups():
+        for param in group.parameters.itervalues():
+            param_name = param.CONF_NAME
+            deprecated = param.DEPRECATES or []
+            if not deprecated or param_name.lower() in answers:
+                continue
+            value = None
+            for old_name in deprecated:
+                val = answers.get(old_name.lower())
+                if not val:
+                    # option is missing or value is empty string
+                    continue
+                if value is None:
+                    value = val
+                if value != val:
+                    value = ValueError(
+                        'Parameter %(param_name)s deprecates following '
+                        'parameters:\n%(deprecated)s.\nPlease either use '
+                        'parameter %(param_name)s or use same value for all '
+                        'deprecated parameters.' % locals())
+                    break
+            if value is not None:
+                deprecations[param_name.lower()] = value
+    answers.update(deprecations)
+    return answers, set(deprecations)
+
+
+def _loadParamFromFile(answers, param_name, deferred=None):
+    """
+    read param from parsed answer file
     validate it
     and load to to global conf dict
     """
 
     param = controller.getParamByName(param_name)
+    values, deprecations = answers
 
     # Get value from answer file
-    try:
-        value = config.get(section, param_name)
-    except ConfigParser.NoOptionError:
-        value = None
-        # Check for deprecated parameters
-        deprecated = param.DEPRECATES if param.DEPRECATES is not None else []
-        for old_name in deprecated:
-            try:
-                val = config.get(section, old_name)
-            except ConfigParser.NoOptionError:
-                continue
-            if not val:
-                # value is empty string
-                continue
-            if value is None:
-                value = val
-            if value != val:
-                raise ValueError('Parameter %(param_name)s deprecates '
-                                 'following parameters:\n%(deprecated)s.\n'
-                                 'Please either use parameter %(param_name)s '
-                                 'or use same value for all deprecated '
-                                 'parameters.' % locals())
-        if deprecated and value is not None:
-            controller.MESSAGES.append('Deprecated parameter has been used '
-                                       'in answer file. Please use parameter '
-                                       '%(param_name)s next time. This '
-                                       'parameter deprecates following '
-                                       'parameters: %(deprecated)s.'
-                                       % locals())
-        if value is None:
-            # Let's use default value if we have one
-            value = getattr(param, 'DEFAULT_VALUE', None)
-        if value is None:
-            raise KeyError('Parser cannot find option %s in answer file.'
-                           % param_name)
+    value = values.get(param_name.lower())
+    if isinstance(value, ValueError):
+        raise value
+    if param_name.lower() in deprecations:
+        deprecated = param.DEPRECATES
+        controller.MESSAGES.append('Deprecated parameter has been used '
+                                   'in answer file. Please use parameter '
+                                   '%(param_name)s next time. This '
+                                   'parameter deprecates following '
+                                   'parameters: %(deprecated)s.'
+                                   % locals())
+    if value is None:
+        # Let's use default value if we have one
+        value = getattr(param, 'DEFAULT_VALUE', None)
+    if value is None:
+        raise KeyError('Parser cannot find option %s in answer file.'
+                       % param_name)
 
     # Validate param value using its validation func
     value = process_param_value(param, value)
-    validate_param_value(param, value)
+    try:
+        validate_param_value(param, value, deferred)
+    except ParamValidationError as ex:
+        if deferred is None:
+            raise
+        deferred.fail(param.CONF_NAME, ex)
 
     # Keep param value in our never ending global conf
     controller.CONF[param.CONF_NAME] = value
@@ -407,9 +439,10 @@ def _handleAnswerFileParams(answerFile):
     try:
         logging.debug("Starting to handle config file")
 
-        # Read answer file
-        fconf = ConfigParser.ConfigParser()
-        fconf.read(answerFile)
+        # Read answer file, network bound validation of all parameters
+        # is done at once after all parameters are loaded
+        answers = _parseAnswerFile(answerFile)
+        deferred = validators.DeferredValidation()
 
         # Iterate all the groups and check the pre/post conditions
         for group in controller.getAllGroups():
@@ -418,17 +451,17 @@ def _handleAnswerFileParams(answerFile):
             # Handle pre conditions for group
             preConditionValue = True
             if group.PRE_CONDITION:
-                preConditionValue = _handleGroupCondition(fconf, group.PRE_CONDITION, preConditionValue)
+                preConditionValue = _handleGroupCondition(answers, group.PRE_CONDITION, preConditionValue, deferred)
 
             # Handle pre condition match with case insensitive values
             if preConditionValue == group.PRE_CONDITION_MATCH:
                 for param in group.parameters.itervalues():
-                    _loadParamFromFile(fconf, "general", param.CONF_NAME)
+                    _loadParamFromFile(answers, param.CONF_NAME, deferred)
 
                 # Handle post conditions for group only if pre condition passed
                 postConditionValue = True
                 if group.POST_CONDITION:
-                    postConditionValue = _handleGroupCondition(fconf, group.POST_CONDITION, postConditionValue)
+                    postConditionValue = _handleGroupCondition(answers, group.POST_CONDITION, postConditionValue, deferred)
 
                     # Handle post condition match for group
                     if postConditionValue != group.POST_CONDITION_MATCH:
@@ -443,6 +476,16 @@ def _handleAnswerFileParams(answerFile):
             else:
                 logging.debug("skipping params group %s since value of group validation is %s" % (group.GROUP_NAME, preConditionValue))
 
+        reported = len(deferred.errors)
+        errors = deferred.run()
+        for name, ex in errors[reported:]:
+            print('Parameter %s failed validation: %s' % (name, ex))
+        if errors:
+            raise ParamValidationError(
+                'Validation failed for %d parameters:\n%s' % (
+                    len(set(name for name, ex in errors)),
+                    '\n'.join('[%s] %s' % (name, ex) for name, ex in errors)))
+
     except Exception as e:
         logging.error(traceback.format_exc())
         raise Exception(output_messages.ERR_EXP_HANDLE_ANSWER_FILE % (e))
@@ -615,7 +658,7 @@ def _addFinalInfoMsg(logFile):
     """
     controller.MESSAGES.append(output_messages.INFO_LOG_FILE_PATH % (logFile))
     controller.MESSAGES.append(
-        output_messages.INFO_MANIFEST_PATH % (basedefs.PUPPET_MANIFEST_DIR))
+        output_messages.INFO_MANIFEST_PATH % (basedefs.runtime.PUPPET_MANIFEST_DIR))
 
 
 def _summaryParamsToLog():
@@ -643,8 +686,8 @@ def _handleParamMessage(param, value):
             controller.MESSAGES.append(message)
 
 
-def runSequences():
-    controller.runAllSequences()
+def runSequences(workers=4):
+    controller.runAllSequences(workers=workers)
 
 
 def _main(options, configFile=None, logFile=None):
@@ -676,8 +719,17 @@ def _main(options, configFile=None, logFile=None):
     # Initialize Sequences
     initPluginsSequences()
 
+    # Record finished steps and applied recipes, so that failed run
+    # can be resumed
+    journal.open(os.path.join(basedefs.runtime.CASABA_VAR_DIR, 'journal'),
+                 resume=options.resume,
+                 secret_keys=[param.CONF_NAME for param in
+                              controller.queryParams(MASK_INPUT=True)],
+                 secret_values=masked_value_set)
+
     # Run main setup logic
-    runSequences()
+    runSequences(workers=options.step_workers)
+    journal.complete()
 
     # Lock rhevm version
     # _lockRpmVersion()
@@ -692,6 +744,10 @@ def remove_remote_var_dirs(options, config, messages):
     Removes the temp directories on remote hosts,
     doesn't remove data on localhost
     """
+    host_dirs = {}
+    # journaled steps refer to temporary directories, so they are kept
+    # if the run failed after something has been journaled
+    keep = journal.enabled and not journal.completed and journal.resumable
     for host in filtered_hosts(config):
         try:
             host_dir = config['HOST_DETAILS'][host]['tmpdir']
@@ -705,16 +761,60 @@ def remove_remote_var_dirs(options, config, messages):
                 'not deleted for debugging purposes.'.format(**locals())
             )
             continue
-        logging.debug(output_messages.INFO_REMOVE_REMOTE_VAR % (host_dir, host))
+        if keep:
+            journal.keep_dir(host, host_dir)
+            messages.append(
+                'Note temporary directory {host_dir} on host {host} was '
+                'not deleted, so that the run can be resumed.'
+                .format(**locals())
+            )
+            continue
+        host_dirs[host] = [host_dir]
+    # directories kept for previous run, which has not been resumed, and
+    # directories kept for this run when it cannot be resumed anymore
+    stale = [journal.stale_dirs]
+    if not keep:
+        stale.append(journal.kept_dirs())
+    for dirs in stale:
+        for host, paths in dirs.iteritems():
+            current = host_dirs.setdefault(host, [])
+            current.extend(i for i in paths if i not in current)
+
+    def remove(host):
+        logging.debug(output_messages.INFO_REMOVE_REMOTE_VAR %
+                      (', '.join(host_dirs[host]), host))
         server = utils.ScriptRunner(host)
-        server.append('rm -rf %s' % host_dir)
-        try:
-            server.execute()
-        except Exception as e:
-            msg = output_messages.ERR_REMOVE_REMOTE_VAR % (host_dir, host)
+        server.append('rm -rf %s' % ' '.join(host_dirs[host]))
+        server.execute()
+
+    hosts = sorted(host_dirs)
+    failed = False
+    for host, (result, exc_info) in zip(hosts,
+                                        utils.parallel_map(remove, hosts)):
+        if exc_info:
+            failed = True
+            msg = output_messages.ERR_REMOVE_REMOTE_VAR % (
+                ', '.join(host_dirs[host]), host)
             logging.error(msg)
-            logging.exception(e)
+            logging.error(''.join(traceback.format_exception(*exc_info)))
             messages.append(utils.color_text(msg, 'red'))
+    if not keep and not failed:
+        journal.forget_dirs()
+
+
+def _saveProfile():
+    """
+    Saves timing report of the run next to the log file. Nothing is saved
+    if the run has not started, so --help and --options don't create
+    directory of the run.
+    """
+    if not basedefs.runtime.resolved('VAR_DIR'):
+        return
+    try:
+        for path in utils.profiler.save(basedefs.runtime.VAR_DIR):
+            logging.debug('Timing report saved to %s' % path)
+    except Exception:
+        logging.error(traceback.format_exc())
 
 
 def remove_temp_files():
@@ -802,15 +902,20 @@ def single_step_install(options, logFile):
     _main(options, answerfilepath, logFile)
 
 
-def initCmdLineParser():
+def initCmdLineParser(groups=None):
     """
     Initiate the optparse object, add all the groups and general command line flags
-    and returns the optparse object
+    and returns the optparse object. Groups of the controller are used if groups
+    are not given.
     """
+    if groups is None:
+        groups = controller.getAllGroups()
 
     # Init parser and all general flags
     usage = "usage: %prog [options] [--help]"
-    parser = OptionParser(usage=usage, version="%prog {0}".format(version_info.version_string()))
+    parser = OptionParser(usage=usage)
+    parser.add_option("--version", action="callback", callback=_printVersion,
+                      help="show program's version number and exit")
     parser.add_option("--gen-answer-file", help="Generate a template of an answer file.")
     parser.add_option("--answer-file", help="Runs the configuration in non-interactive mode, extracting all information from the"
                                             "configuration file. using this option excludes all other options")
@@ -826,9 +931,12 @@ def initCmdLineParser():
     parser.add_option("-o", "--options", action="store_true", dest="options", help="Print details on options available in answer file(rst format)")
     parser.add_option("-d", "--debug", action="store_true", default=False, help="Enable debug in logging")
     parser.add_option("-y", "--dry-run", action="store_true", default=False, help="Don't execute, just generate manifests")
+    parser.add_option("-j", "--jobs", type="int", default=16, help="Maximum number of hosts to operate on concurrently")
+    parser.add_option("--resume", action="store_true", default=False, help="Skip steps and Puppet runs finished by previous failed run whose inputs have not changed")
+    parser.add_option("--step-workers", type="int", default=4, help="Maximum number of setup steps without mutual dependencies (declared by their requires and provides) to run concurrently, use 1 to run steps one by one")
 
     # For each group, create a group option
-    for group in controller.getAllGroups():
+    for group in groups:
         groupParser = OptionGroup(parser, group.DESCRIPTION)
 
         for param in group.parameters.itervalues():
@@ -846,13 +954,23 @@ def initCmdLineParser():
     return parser
 
 
-def printOptions():
+def _printVersion(option, opt_str, value, parser):
+    # pbr resolves version using pkg_resources, which is expensive to import,
+    # so version is resolved only when it is requested
+    from casaba.version import version_info
+    print("%s %s" % (parser.get_prog_name(), version_info.version_string()))
+    parser.exit()
+
+
+def printOptions(groups=None):
     """
     print and document the available options to the answer file (rst format)
     """
+    if groups is None:
+        groups = controller.getAllGroups()
 
     # For each group, create a group option
-    for group in controller.getAllGroups():
+    for group in groups:
         print("%s" % group.DESCRIPTION)
         print("-" * len(group.DESCRIPTION) + "\n")
 
@@ -864,43 +982,45 @@ def printOptions():
             print("    %s" % paramUsage + "\n")
 
 
-def plugin_compare(x, y):
+def _importPlugin(moduleToLoad, path):
+    if basedefs.DIR_PLUGINS not in sys.path:
+        sys.path.append(basedefs.DIR_PLUGINS)
+        sys.path.append(basedefs.DIR_MODULES)
+    try:
+        logging.debug("importing module %s, from file %s", moduleToLoad, path)
+        moduleobj = __import__(moduleToLoad)
+        moduleobj.__file__ = path
+        checkPlugin(moduleobj)
+        return moduleobj
+    except:
+        logging.error("Failed to load plugin from file %s", path)
+        logging.error(traceback.format_exc())
+        raise Exception("Failed to load plugin from file %s" % path)
+
+
+def loadPluginIndex():
     """
-    Used to sort the plugin file list
-    according to the number at the end of the plugin module
+    Returns index of plugins from ./plugins, only new or changed plugins
+    are imported
     """
-    x_match = re.search(".+\_(\d\d\d)", x)
-    x_cmp = x_match.group(1)
-    y_match = re.search(".+\_(\d\d\d)", y)
-    y_cmp = y_match.group(1)
-    return int(x_cmp) - int(y_cmp)
+    # plugins are indexed again when installer or helper modules change
+    dependencies = [basedefs.DIR_MODULES,
+                    os.path.dirname(os.path.abspath(__file__))]
+    index = PluginIndex(basedefs.DIR_PLUGINS, basedefs.runtime.PLUGIN_INDEX_FILE,
+                        doc=basedefs.runtime.CASABA_DOC,
+                        dependencies=dependencies)
+    return index.load(importer=_importPlugin)
 
 
-def loadPlugins():
+def loadPlugins(index=None):
     """
     Load All plugins from ./plugins
     """
-    sys.path.append(basedefs.DIR_PLUGINS)
-    sys.path.append(basedefs.DIR_MODULES)
-
-    fileList = [f for f in os.listdir(basedefs.DIR_PLUGINS) if f[0] != "_"]
-    fileList = sorted(fileList, cmp=plugin_compare)
-    for item in fileList:
-        # Looking for files that end with ###.py, example: a_plugin_100.py
-        match = re.search("^(.+\_\d\d\d)\.py$", item)
-        if match:
-            try:
-                moduleToLoad = match.group(1)
-                logging.debug("importing module %s, from file %s", moduleToLoad, item)
-                moduleobj = __import__(moduleToLoad)
-                moduleobj.__file__ = os.path.join(basedefs.DIR_PLUGINS, item)
-                globals()[moduleToLoad] = moduleobj
-                checkPlugin(moduleobj)
-                controller.addPlugin(moduleobj)
-            except:
-                logging.error("Failed to load plugin from file %s", item)
-                logging.error(traceback.format_exc())
-                raise Exception("Failed to load plugin from file %s" % item)
+    plugins = index and index.plugins or list_plugins(basedefs.DIR_PLUGINS)
+    for moduleToLoad, path in plugins:
+        moduleobj = _importPlugin(moduleToLoad, path)
+        globals()[moduleToLoad] = moduleobj
+        controller.addPlugin(moduleobj)
 
 
 def checkPlugin(plugin):
@@ -916,7 +1036,7 @@ def countCmdLineFlags(options, flag):
     counter = 0
     # make sure only flag was supplied
     for key, value in options.__dict__.items():
-        if key in (flag, 'debug', 'timeout', 'dry_run', 'default_password'):
+        if key in (flag, 'debug', 'timeout', 'dry_run', 'jobs', 'step_workers', 'resume', 'default_password'):
             next
         # If anything but flag was called, increment
         elif value:
@@ -946,30 +1066,34 @@ def initPluginsSequences():
 def _set_command_line_values(options):
     for key, value in options.__dict__.items():
         # Replace the _ with - in the string since optparse replace _ with -
-        for group in controller.getAllGroups():
-            param = group.search("CMD_OPTION", key.replace("_", "-"))
-            if len(param) > 0 and value:
-                commandLineValues[param[0].CONF_NAME] = value
+        if not value:
+            continue
+        for param in controller.queryParams(CMD_OPTION=key.replace("_", "-")):
+            commandLineValues[param.CONF_NAME] = value
 
 
 def main():
     options = ""
 
     try:
-        # Load Plugins
-        loadPlugins()
-        initPluginsConfig()
-
-        optParser = initCmdLineParser()
+        # Options are read from plugin index, so plugins don't have to be
+        # imported for --help and --options
+        index = loadPluginIndex()
+        groups = index.registry().groups
+        optParser = initCmdLineParser(groups)
 
         # Do the actual command line parsing
         # Try/Except are here to catch the silly sys.exit(0) when calling rhevm-setup --help
         (options, args) = optParser.parse_args()
 
         if options.options:
-            printOptions()
+            printOptions(groups)
             raise SystemExit
 
+        # Load Plugins
+        loadPlugins(index)
+        initPluginsConfig()
+
         # Initialize logging
         logFile = initLogging(options.debug)
 
@@ -979,7 +1103,8 @@ def main():
 
         controller.CONF['DEFAULT_EXEC_TIMEOUT'] = options.timeout
         controller.CONF['DRY_RUN'] = options.dry_run
-        controller.CONF['DIR_LOG'] = basedefs.DIR_LOG
+        controller.CONF['DIR_LOG'] = basedefs.runtime.DIR_LOG
+        utils.set_default_workers(options.jobs)
 
         # If --gen-answer-file was supplied, do not run main
         if options.gen_answer_file:
@@ -1037,6 +1162,11 @@ def main():
     finally:
         remove_remote_var_dirs(options, controller.CONF, controller.MESSAGES)
         remove_temp_files()
+        # tear down multiplexed ssh connections to all hosts
+        utils.ssh_pool.close_all()
+        # remove tarballs shared by drones
+        pack_cache.clear()
+        _saveProfile()
 
         # Always print user params to log
         _printAdditionalMessages()
@@ -16,19 +16,26 @@ Controller class is a SINGLETON which handles all groups, params, sequences,
 steps and replaces the CONF dictionary.
 """
 from .core.parameters import Group
+from .core.parameters import ParameterRegistry
 from .core.sequences import Sequence
+from .core.sequences import StepScheduler
 
 
 def steps_new_format(steplist):
     # we have to duplicate title to name parameter and also only sigle
     # function is allowed in new step
     return [{'name': i['title'], 'title': i['title'],
-             'function': i['functions'][0]} for i in steplist]
+             'function': i['functions'][0],
+             'requires': i.get('requires'),
+             'provides': i.get('provides'),
+             'resumable': i.get('resumable', False),
+             'verify': i.get('verify')} for i in steplist]
 
 
 class Controller(object):
 
-    __GROUPS = []
+    __PARAMS = ParameterRegistry()
+    __GROUPS = __PARAMS.groups
     __SEQUENCES = []
     __PLUGINS = []
     MESSAGES = []
@@ -62,23 +69,35 @@ class Controller(object):
         return self.__PLUGINS
 
     # Sequences and steps
-    def addSequence(self, desc, cond, cond_match, steps):
+    def addSequence(self, desc, cond, cond_match, steps, requires=None,
+                    provides=None):
         self.__SEQUENCES.append(Sequence(desc, steps_new_format(steps),
                                          condition=cond,
-                                         cond_match=cond_match))
+                                         cond_match=cond_match,
+                                         requires=requires,
+                                         provides=provides))
 
-    def insertSequence(self, desc, cond, cond_match, steps, index=0):
+    def insertSequence(self, desc, cond, cond_match, steps, index=0,
+                       requires=None, provides=None):
         self.__SEQUENCES.insert(index, Sequence(desc,
                                                 steps_new_format(steps),
                                                 condition=cond,
-                                                cond_match=cond_match))
+                                                cond_match=cond_match,
+                                                requires=requires,
+                                                provides=provides))
 
     def getAllSequences(self):
         return self.__SEQUENCES
 
-    def runAllSequences(self):
-        for sequence in self.__SEQUENCES:
-            sequence.run(config=self.CONF, messages=self.MESSAGES)
+    def runAllSequences(self, workers=4):
+        """
+        Runs all sequences. Steps declaring requires and provides which
+        don't depend on each other are run concurrently by at most
+        workers threads, other steps run one by one in order, see
+        core.sequences.StepScheduler.
+        """
+        scheduler = StepScheduler(self.__SEQUENCES, workers=workers)
+        scheduler.run(config=self.CONF, messages=self.MESSAGES)
 
     def getSequenceByDesc(self, desc):
         for sequence in self.getAllSequences():
@@ -92,7 +111,8 @@ class Controller(object):
                 return self.__SEQUENCES.index(sequence)
         return None
 
-    def insertSequenceBeforeSequence(self, sequenceName, desc, cond, cond_match, steps):
+    def insertSequenceBeforeSequence(self, sequenceName, desc, cond, cond_match, steps,
+                                     requires=None, provides=None):
         """
         Insert a sequence before a named sequence.
         i.e. if the specified sequence name is "update x", the new
@@ -104,26 +124,25 @@ class Controller(object):
         self.__SEQUENCES.insert(index, Sequence(desc,
                                                 steps_new_format(steps),
                                                 condition=cond,
-                                                cond_match=cond_match))
+                                                cond_match=cond_match,
+                                                requires=requires,
+                                                provides=provides))
 
     # Groups and params
     def addGroup(self, group, params):
-        self.__GROUPS.append(Group(group, params))
+        self.__PARAMS.add_group(Group(group, params))
 
     def getGroupByName(self, groupName):
-        for group in self.getAllGroups():
-            if group.GROUP_NAME == groupName:
-                return group
-        return None
+        return self.__PARAMS.get_group(groupName)
 
     def getAllGroups(self):
         return self.__GROUPS
 
     def __getGroupIndexByDesc(self, name):
-        for group in self.getAllGroups():
-            if group.GROUP_NAME == name:
-                return self.__GROUPS.index(group)
-        return None
+        group = self.getGroupByName(name)
+        if group is None:
+            return None
+        return self.__GROUPS.index(group)
 
     def insertGroupBeforeGroup(self, groupName, group, params):
         """
@@ -132,15 +151,18 @@ class Controller(object):
         group will be inserted BEFORE "update x"
         """
         index = self.__getGroupIndexByDesc(groupName)
-        if index is None:
-            index = len(self.getAllGroups())
-        self.__GROUPS.insert(index, Group(group, params))
+        self.__PARAMS.add_group(Group(group, params), index=index)
 
     def getParamByName(self, paramName):
-        for group in self.getAllGroups():
-            if paramName in group.parameters:
-                return group.parameters[paramName]
-        return None
+        return self.__PARAMS.get(paramName)
+
+    def queryParams(self, **attrs):
+        """
+        Returns list of parameters of all groups which have all given
+        attributes of given values, for example
+        queryParams(CMD_OPTION='os-glance-install').
+        """
+        return self.__PARAMS.query(**attrs)
 
     def getParamKeyValue(self, paramName, keyName):
         param = self.getParamByName(paramName)
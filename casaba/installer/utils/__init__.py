@@ -12,14 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from .concurrency import parallel_map
+from .concurrency import set_default_workers
 from .datastructures import SortedDict
 from .decorators import retry
 from .network import get_localhost_ip
 from .network import host2ip
+from .network import local_addresses
 from .network import force_ip
 from .network import device_from_ip
+from .packages import package_manager
+from .packages import PackageManager
+from .profiler import profiler
+from .profiler import Profiler
+from .reactor import Reactor
+from .reactor import wait_readable
 from .shell import execute
+from .shell import execute_all
 from .shell import ScriptRunner
+from .ssh import ssh_pool
+from .ssh import SshConnectionPool
+from .streams import OutputBuffer
 from .shortcuts import host_iter
 from .shortcuts import hosts
 from .shortcuts import get_current_user
@@ -27,15 +40,24 @@ from .shortcuts import get_current_username
 from .shortcuts import split_hosts
 from .strings import COLORS
 from .strings import color_text
+from .strings import Masker
 from .strings import mask_string
 from .strings import state_format
 from .strings import state_message
 
 
-__all__ = ('SortedDict',
+__all__ = ('parallel_map', 'set_default_workers',
+           'SortedDict',
            'retry',
-           'get_localhost_ip', 'host2ip', 'force_ip', 'device_from_ip',
-           'ScriptRunner', 'execute',
+           'get_localhost_ip', 'host2ip', 'local_addresses', 'force_ip',
+           'device_from_ip',
+           'package_manager', 'PackageManager',
+           'profiler', 'Profiler',
+           'Reactor', 'wait_readable',
+           'ScriptRunner', 'execute', 'execute_all',
+           'ssh_pool', 'SshConnectionPool',
+           'OutputBuffer',
            'host_iter', 'hosts', 'get_current_user', 'get_current_username',
-           'split_hosts', 'COLORS', 'color_text', 'mask_string',
+           'split_hosts', 'COLORS', 'color_text', 'Masker',
+           'mask_string',
            'state_format', 'state_message')
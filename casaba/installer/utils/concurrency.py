@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+
+
+# maximal number of hosts operated on concurrently, can be changed
+# via set_default_workers (casaba --jobs)
+default_workers = 16
+
+
+def set_default_workers(count):
+    """
+    Sets default concurrency limit used by parallel_map.
+    """
+    global default_workers
+    count = int(count)
+    if count < 1:
+        raise ValueError('Concurrency limit has to be positive number.')
+    default_workers = count
+
+
+def parallel_map(func, items, workers=None):
+    """
+    Calls func for every item from items using bounded pool of threads.
+    Returns list of (result, exc_info) tuples in the same order as given
+    items. Exception raised by func does not stop processing of other
+    items, exc_info of such call is set to value of sys.exc_info(),
+    otherwise it is None.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    workers = min(workers or default_workers, len(items))
+    if workers <= 1:
+        for idx, item in enumerate(items):
+            results[idx] = _call(func, item)
+        return results
+
+    pending = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                idx = next(pending, None)
+            if idx is None:
+                return
+            results[idx] = _call(func, items[idx])
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with timeout keeps main thread responsive to Ctrl+C
+        while thread.is_alive():
+            thread.join(1)
+    return results
+
+
+def _call(func, item):
+    try:
+        return func(item), None
+    except Exception:
+        return None, sys.exc_info()
@@ -14,6 +14,8 @@
 
 import time
 
+from .profiler import profiler
+
 
 def retry(count=1, delay=0, retry_on=Exception):
     """
@@ -33,6 +35,8 @@ def retry(count=1, delay=0, retry_on=Exception):
                 except retry_on:
                     if tried >= count:
                         raise
+                    profiler.count('retries')
+                    profiler.count('retries:%s' % func.func_name)
                     if delay:
                         time.sleep(delay)
                     tried += 1
@@ -55,6 +55,22 @@ def get_localhost_ip():
     return loc_ip
 
 
+def local_addresses():
+    """
+    Returns set of all addresses of the installer host, including
+    loopback ones.
+    """
+    result = set(['localhost', '127.0.0.1', '::1', socket.gethostname()])
+    for iface in netifaces.interfaces():
+        for family, addresses in netifaces.ifaddresses(iface).items():
+            if family not in (netifaces.AF_INET, netifaces.AF_INET6):
+                continue
+            for address in addresses:
+                # removes scope id of IPv6 link-local addresses
+                result.add(address['addr'].split('%')[0])
+    return result
+
+
 _host_cache = {}
 
 
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pipes
+import logging
+import threading
+
+from contextlib import closing
+
+from ..exceptions import MultiHostError
+from .concurrency import parallel_map
+from .network import local_addresses
+from .shell import ScriptRunner
+
+
+MISSING_MARKER = 'casaba-missing:'
+
+
+class PackageManager(object):
+    """
+    Collects package requirements of plugins and drones and makes sure
+    required packages are installed on their hosts. Every host is checked
+    by single rpm query and missing packages are installed by single yum
+    transaction, hosts are processed concurrently. Host None stands for
+    the installer host.
+    """
+    def __init__(self):
+        self._required = {}
+        self._ensured = {}
+        self._locks = {}
+        self._warmers = []
+        self._lock = threading.Lock()
+
+    def require(self, hosts, packages):
+        """
+        Registers packages required on given hosts. Packages are installed
+        by next call of ensure.
+        """
+        if hosts is None or isinstance(hosts, basestring):
+            hosts = [hosts]
+        with self._lock:
+            for host in hosts:
+                required = self._required.setdefault(host, [])
+                for pkg in packages:
+                    if pkg not in required:
+                        required.append(pkg)
+
+    def ensure(self, hosts=None, timeout=None, workers=None):
+        """
+        Installs missing packages required on given hosts (on all hosts
+        with registered requirements by default). Returns dict mapping
+        host to list of installed packages. Raises MultiHostError if
+        packages could not be installed on any host.
+        """
+        with self._lock:
+            if hosts is None:
+                hosts = self._required.keys()
+            hosts = sorted(set(hosts))
+        self._wait_warmers(hosts)
+
+        def run(host):
+            with self._lock:
+                lock = self._locks.setdefault(host, threading.Lock())
+            with lock:
+                ensured = self._ensured.setdefault(host, set())
+                with self._lock:
+                    pkgs = [i for i in self._required.get(host, [])
+                            if i not in ensured]
+                if not pkgs:
+                    return []
+                installed = self._install(host, pkgs, timeout)
+                ensured.update(pkgs)
+                return installed
+
+        output, errors = {}, {}
+        results = parallel_map(run, hosts, workers=workers)
+        for host, (result, exc_info) in zip(hosts, results):
+            if exc_info:
+                errors[host] = exc_info[1]
+            else:
+                output[host] = result
+        if errors:
+            msg = ('Failed to install packages on %d of %d hosts:\n%s' %
+                   (len(errors), len(hosts),
+                    '\n'.join('[%s] %s' % (host or 'localhost', errors[host])
+                              for host in hosts if host in errors)))
+            raise MultiHostError(msg, errors=errors)
+        return output
+
+    def _wait_warmers(self, hosts):
+        """
+        Waits for background cache refreshes holding yum lock on any
+        of given hosts. Warmed hosts are addressed by IP, so installer
+        host (None) is matched by its local addresses.
+        """
+        hosts = set(hosts)
+        if None in hosts:
+            hosts.update(local_addresses())
+        with self._lock:
+            warmers = list(self._warmers)
+        for warmed, warmer in warmers:
+            if warmed & hosts:
+                warmer.join()
+        with self._lock:
+            self._warmers = [i for i in self._warmers if i[1].is_alive()]
+
+    def _install(self, host, packages, timeout=None):
+        # TO-DO: complete logger name when logging will be setup correctly
+        logger = logging.getLogger()
+        pkgs = ' '.join(pipes.quote(i) for i in packages)
+        server = ScriptRunner(host)
+        server.append("missing=$(rpm -q --whatprovides %s | "
+                      "sed -n 's/^no package provides //p')" % pkgs)
+        server.append('echo "%s $missing"' % MISSING_MARKER)
+        server.append('if [ -n "$missing" ]; then')
+        server.append('%syum install -y $missing'
+                      % (timeout and 'timeout %d ' % timeout or ''))
+        # yum does not fail if one of the packages is missing
+        server.append('rpm -q --whatprovides $missing')
+        server.append('fi')
+        # yum output is not needed, so it's not kept in memory
+        rc, stdout = server.execute(lazy_output=True)
+        with closing(stdout.open()) as fp:
+            for line in fp:
+                if line.startswith(MISSING_MARKER):
+                    missing = line[len(MISSING_MARKER):].split()
+                    break
+            else:
+                missing = []
+        stdout.close()
+        if missing:
+            logger.debug('Installed packages on %s: %s'
+                         % (host or 'localhost', ', '.join(missing)))
+        return missing
+
+    def warm_cache(self, hosts, background=False, workers=None):
+        """
+        Refreshes yum metadata cache on given hosts, so that following
+        transactions don't have to wait for repository metadata. Failures
+        are ignored. If background is True, cache is refreshed in separate
+        thread and calls of ensure for these hosts wait for it.
+        """
+        hosts = list(hosts)
+
+        def warm():
+            server = ScriptRunner()
+            server.append('yum makecache fast || yum makecache')
+            try:
+                server.execute_on(hosts, can_fail=False, log=False,
+                                  workers=workers)
+            except Exception as ex:
+                logging.getLogger().debug('Failed to refresh yum cache: %s'
+                                          % ex)
+
+        if not background:
+            warm()
+            return
+        warmer = threading.Thread(target=warm, name='yum-makecache')
+        warmer.daemon = True
+        warmer.start()
+        self._warmers.append((frozenset(hosts), warmer))
+
+
+package_manager = PackageManager()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import datetime
+import threading
+import contextlib
+
+
+PROFILE_FILE = 'casaba-profile.json'
+TRACE_FILE = 'casaba-trace.json'
+
+
+class Profiler(object):
+    """
+    Collects wall time of installer operations (steps, scripts, commands,
+    puppet runs, ...) together with their attributes like host, remote
+    or local execution and number of transferred bytes. Collected data
+    can be saved as JSON report and as Chrome trace (chrome://tracing,
+    Perfetto or speedscope), which can be viewed as flame graph.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.time()
+        self._spans = []
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, category, name, **attrs):
+        """
+        Records wall time of the with block. Yields dict of attributes
+        of the span, which can be updated inside of the block.
+        """
+        attrs = dict(attrs)
+        start = time.time()
+        try:
+            yield attrs
+        except Exception:
+            attrs['error'] = True
+            raise
+        finally:
+            self.record(category, name, start, time.time(), **attrs)
+
+    def record(self, category, name, start, end, **attrs):
+        """
+        Records span which started and ended at given times.
+        """
+        if not self.enabled:
+            return
+        span = {'category': category, 'name': name,
+                'start': start, 'duration': end - start,
+                'thread': threading.current_thread().name,
+                'attrs': attrs}
+        with self._lock:
+            self._spans.append(span)
+
+    def count(self, name, value=1):
+        """
+        Increments counter with given name (for example number of retries).
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @property
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def report(self):
+        """
+        Returns dict with summary of time spent per category, per host
+        and per operation, counters and all recorded spans.
+        """
+        spans = self.spans
+        by_category, by_host, by_name = {}, {}, {}
+        for span in spans:
+            cat = span['category']
+            host = span['attrs'].get('host')
+            _add(by_category.setdefault(cat, {}), span)
+            _add(by_name.setdefault((cat, span['name']), {}), span)
+            if host:
+                _add(by_host.setdefault(host, {}).setdefault(cat, {}), span)
+        top = sorted(by_name.iteritems(), key=lambda i: i[1]['total'],
+                     reverse=True)
+        started = datetime.datetime.fromtimestamp(self.started)
+        return {
+            'started': started.isoformat(),
+            'wall_time': time.time() - self.started,
+            'by_category': by_category,
+            'by_host': by_host,
+            'by_operation': [dict(category=cat, name=name, **stats)
+                             for (cat, name), stats in top[:100]],
+            'counters': dict(self._counters),
+            'spans': [dict(span, start=span['start'] - self.started)
+                      for span in spans],
+        }
+
+    def trace(self):
+        """
+        Returns spans in Chrome trace event format. Spans of every host
+        are shown in separate lane, operations of installer host are
+        shown in lane of the thread which ran them.
+        """
+        lanes, events = {}, []
+        for span in self.spans:
+            lane = span['attrs'].get('host') or span['thread']
+            if lane not in lanes:
+                lanes[lane] = len(lanes) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                               'tid': lanes[lane], 'args': {'name': lane}})
+            events.append({'name': span['name'], 'cat': span['category'],
+                           'ph': 'X', 'pid': 1, 'tid': lanes[lane],
+                           'ts': int((span['start'] - self.started) * 1e6),
+                           'dur': int(span['duration'] * 1e6),
+                           'args': span['attrs']})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, directory):
+        """
+        Saves JSON report and Chrome trace to given directory. Returns
+        paths of created files.
+        """
+        paths = []
+        for filename, data in ((PROFILE_FILE, self.report()),
+                               (TRACE_FILE, self.trace())):
+            path = os.path.join(directory, filename)
+            with open(path, 'w') as fp:
+                json.dump(data, fp, indent=1, default=str)
+            paths.append(path)
+        return paths
+
+
+def _add(stats, span):
+    stats['count'] = stats.get('count', 0) + 1
+    stats['total'] = stats.get('total', 0) + span['duration']
+    stats['max'] = max(stats.get('max', 0), span['duration'])
+    stats['bytes'] = stats.get('bytes', 0) + (span['attrs'].get('bytes') or 0)
+
+
+profiler = Profiler()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import errno
+import heapq
+import select
+import subprocess
+import collections
+
+from .streams import CHUNK_SIZE
+from .streams import OutputBuffer
+from .streams import READ_EVENTS as _READ_EVENTS
+from .streams import WRITE_EVENTS as _WRITE_EVENTS
+
+
+# interval of checks whether process, which already closed its output,
+# has ended
+REAP_INTERVAL = 0.01
+
+
+def wait_readable(fds, timeout=None):
+    """
+    Waits until any of given file descriptors is readable (or closed)
+    at most timeout seconds. Returns list of ready file descriptors.
+    Unlike select.select it works with any number of descriptors.
+    """
+    poller = select.poll()
+    for fd in fds:
+        poller.register(fd, _READ_EVENTS)
+    ms = None if timeout is None else int(timeout * 1000)
+    while True:
+        try:
+            return [fd for fd, event in poller.poll(ms)]
+        except select.error as ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+
+
+class Job(object):
+    """
+    Command ran by Reactor. Output of the command is collected
+    in OutputBuffers stdout and stderr and passed to given sinks. Return
+    code is set to rc when the command ends.
+    """
+    def __init__(self, cmd, input=None, stdout=(), stderr=(), callback=None,
+                 env=None):
+        self.cmd = cmd
+        self.input = input or ''
+        self.env = env
+        self.callback = callback
+        self.stdout = OutputBuffer()
+        self.stderr = OutputBuffer()
+        self.rc = None
+        self.started = None
+        self.ended = None
+        self.proc = None
+        self._sinks = ([self.stdout] + list(stdout),
+                       [self.stderr] + list(stderr))
+        self._open = 0
+        self._offset = 0
+
+    @property
+    def done(self):
+        return self.ended is not None
+
+
+class Reactor(object):
+    """
+    Single threaded event loop running many commands concurrently.
+    Processes are multiplexed with poll, so that the number of commands
+    in flight (for example ssh sessions to nodes) is not bound to number
+    of threads. At most limit commands run at the same time, the rest
+    is queued.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._poller = select.poll()
+        self._handlers = {}
+        self._queue = collections.deque()
+        self._running = set()
+        self._timers = []
+        self._seq = 0
+
+    def spawn(self, cmd, input=None, stdout=(), stderr=(), callback=None,
+              env=None):
+        """
+        Schedules command cmd. Given input is written to stdin of
+        the process, chunks of output are passed to write methods of sinks
+        in stdout and stderr lists. Callback is called with the Job when
+        the command ends. Returns the Job.
+        """
+        job = Job(cmd, input=input, stdout=stdout, stderr=stderr,
+                  callback=callback, env=env)
+        self._queue.append(job)
+        return job
+
+    def watch(self, fd, callback, events=_READ_EVENTS):
+        """
+        Calls callback(fd, event) whenever given events occur on file
+        descriptor fd until unwatch(fd) is called.
+        """
+        self._handlers[fd] = callback
+        self._poller.register(fd, events)
+
+    def unwatch(self, fd):
+        if self._handlers.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def call_later(self, delay, callback):
+        """
+        Calls callback after given number of seconds.
+        """
+        self._seq += 1
+        heapq.heappush(self._timers, (time.time() + delay, self._seq,
+                                      callback))
+
+    def run(self, timeout=None):
+        """
+        Runs the loop until all commands are finished and there is
+        nothing to watch. Returns False if timeout expired before that,
+        unfinished processes are killed in that case, otherwise returns
+        True.
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+        try:
+            while self._queue or self._running or self._handlers or \
+                    self._timers:
+                self._start_queued()
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    return False
+                wait = [i for i in (deadline, self._timers and
+                                    self._timers[0][0]) if i]
+                ms = None
+                if wait:
+                    ms = max(0, int((min(wait) - now) * 1000))
+                if self._handlers:
+                    try:
+                        events = self._poller.poll(ms)
+                    except select.error as ex:
+                        if ex.args[0] != errno.EINTR:
+                            raise
+                        events = []
+                    for fd, event in events:
+                        handler = self._handlers.get(fd)
+                        if handler:
+                            handler(fd, event)
+                elif ms:
+                    time.sleep(ms / 1000.0)
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    heapq.heappop(self._timers)[2]()
+            return True
+        finally:
+            self._cleanup()
+
+    def _start_queued(self):
+        while self._queue and (not self.limit or
+                               len(self._running) < self.limit):
+            self._start(self._queue.popleft())
+
+    def _start(self, job):
+        stdin = job.input and subprocess.PIPE or open(os.devnull)
+        try:
+            job.proc = subprocess.Popen(job.cmd, stdin=stdin,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        close_fds=True, env=job.env)
+        finally:
+            if not job.input:
+                stdin.close()
+        job.started = time.time()
+        self._running.add(job)
+        if job.input:
+            self.watch(job.proc.stdin.fileno(),
+                       lambda fd, event: self._write(job, fd),
+                       _WRITE_EVENTS)
+        for pipe, sinks in ((job.proc.stdout, job._sinks[0]),
+                            (job.proc.stderr, job._sinks[1])):
+            job._open += 1
+            self.watch(pipe.fileno(),
+                       lambda fd, event, pipe=pipe, sinks=sinks:
+                       self._read(job, pipe, sinks))
+
+    def _write(self, job, fd):
+        try:
+            job._offset += os.write(
+                fd, job.input[job._offset:job._offset + select.PIPE_BUF])
+        except OSError as ex:
+            if ex.errno != errno.EPIPE:
+                raise
+            # process does not read its input any more
+            job._offset = len(job.input)
+        if job._offset >= len(job.input):
+            self.unwatch(fd)
+            job.proc.stdin.close()
+
+    def _read(self, job, pipe, sinks):
+        data = os.read(pipe.fileno(), CHUNK_SIZE)
+        if data:
+            for sink in sinks:
+                sink.write(data)
+            return
+        self.unwatch(pipe.fileno())
+        pipe.close()
+        job._open -= 1
+        if not job._open:
+            self._reap(job)
+
+    def _reap(self, job):
+        if job.proc.poll() is None:
+            # output is closed, but process has not ended yet
+            self.call_later(REAP_INTERVAL, lambda: self._reap(job))
+            return
+        if job.proc.stdin and not job.proc.stdin.closed:
+            self.unwatch(job.proc.stdin.fileno())
+            job.proc.stdin.close()
+        job.rc = job.proc.returncode
+        job.ended = time.time()
+        self._running.discard(job)
+        if job.callback:
+            job.callback(job)
+
+    def _cleanup(self):
+        # loop has been interrupted, don't leave processes behind
+        for job in list(self._running):
+            if job.proc.poll() is None:
+                job.proc.kill()
+            job.proc.wait()
+            for pipe in (job.proc.stdin, job.proc.stdout, job.proc.stderr):
+                if pipe and not pipe.closed:
+                    pipe.close()
+        for fd in list(self._handlers):
+            self.unwatch(fd)
+        self._running.clear()
+        self._queue.clear()
+        self._timers = []
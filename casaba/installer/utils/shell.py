@@ -14,60 +14,188 @@
 
 import re
 import os
+import pipes
 import types
 import logging
 import subprocess
 
 from ..exceptions import ExecuteRuntimeError
+from ..exceptions import MultiHostError
 from ..exceptions import NetworkError
 from ..exceptions import ScriptRuntimeError
+from . import concurrency
+from .reactor import Reactor
+from .profiler import profiler
+from .ssh import ssh_pool
+from .streams import log_output
+from .streams import pump
+from .streams import LogWriter
+from .streams import OutputBuffer
 from .strings import mask_string
 
 
-block_fmt = ("\n============= %(title)s ==========\n%(content)s\n"
-             "======== END OF %(title)s ========")
-
-
 def execute(cmd, workdir=None, can_fail=True, mask_list=None,
-            use_shell=False, log=True):
+            use_shell=False, log=True, lazy_output=False):
     """
     Runs shell command cmd. If can_fail is set to False
     ExecuteRuntimeError is raised if command returned non-zero return
-    code. Otherwise
+    code. Otherwise tuple (rc, stdout) is returned. Output is logged
+    as it comes, if lazy_output is set to True stdout is returned
+    as OutputBuffer instead of string.
     """
     mask_list = mask_list or []
     repl_list = [("'", "'\\''")]
 
     if not isinstance(cmd, types.StringType):
-        import pipes
         masked = ' '.join((pipes.quote(i) for i in cmd))
     else:
         masked = cmd
     masked = mask_string(masked, mask_list, repl_list)
     if log:
         logging.info("Executing command:\n%s" % masked)
-    environ = os.environ
-    environ['LANG'] = 'zh_CN.UTF8'
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE, cwd=workdir,
-                            shell=use_shell, close_fds=True,
-                            env=environ)
-    out, err = proc.communicate()
-    masked_out = mask_string(out, mask_list, repl_list)
-    masked_err = mask_string(err, mask_list, repl_list)
-    if log:
-        logging.debug(block_fmt % {'title': 'STDOUT', 'content': masked_out})
+    environ = _environ('zh_CN.UTF8')
+    name, host = _command_info(cmd)
+    with profiler.span('command', name, host=host,
+                       remote=host is not None) as span:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=workdir,
+                                shell=use_shell, close_fds=True,
+                                env=environ)
+        out, err = OutputBuffer(), OutputBuffer()
+        sinks = [out]
+        if log:
+            sinks.append(LogWriter('STDOUT', mask_list, repl_list))
+        pump(proc, stdout=sinks, stderr=[err])
+        if log:
+            sinks[1].close()
+        span['rc'] = proc.returncode
+        span['bytes'] = out.size + err.size
+        if name == 'scp' and isinstance(cmd, (list, tuple)):
+            # scp output is empty, count size of copied local files
+            span['bytes'] += sum(os.path.getsize(i) for i in cmd[1:]
+                                 if os.path.isfile(i))
+
+    # buffers may be backed by temporary files, the returned one
+    # is closed by caller, the ones given to error are kept with it
+    kept = ()
+    try:
+        if proc.returncode:
+            if log:
+                log_output('STDERR', err, mask_list, repl_list)
+            if can_fail:
+                masked_out = mask_string(out.tail(), mask_list, repl_list)
+                masked_err = mask_string(err.tail(), mask_list, repl_list)
+                msg = ('Failed to execute command, '
+                       'stdout: %s\nstderr: %s' %
+                       (masked_out, masked_err))
+                kept = (out, err)
+                raise ExecuteRuntimeError(msg, stdout=out.tail(),
+                                          stderr=err.tail(),
+                                          stdout_buffer=out,
+                                          stderr_buffer=err)
+        if lazy_output:
+            kept = (out,)
+            return proc.returncode, out
+        return proc.returncode, out.getvalue()
+    finally:
+        for buf in (out, err):
+            if buf not in kept:
+                buf.close()
+
+
+def execute_all(cmds, can_fail=True, mask_list=None, log=True, workers=None,
+                lazy_output=False):
+    """
+    Runs all given commands concurrently in single thread, at most workers
+    commands at the same time. Returns list of tuples (rc, stdout)
+    in order of given commands. If can_fail is set to True
+    ExecuteRuntimeError describing all failed commands is raised after
+    all commands have ended.
+    """
+    mask_list = mask_list or []
+    repl_list = [("'", "'\\''")]
+    reactor = Reactor(limit=workers or concurrency.default_workers)
 
-    if proc.returncode:
+    def spawn(cmd):
+        masked = ' '.join((pipes.quote(i) for i in cmd))
+        masked = mask_string(masked, mask_list, repl_list)
+        sinks = []
         if log:
-            logging.debug(block_fmt % {'title': 'STDERR',
-                                       'content': masked_err})
-        if can_fail:
-            msg = ('Failed to execute command, '
-                   'stdout: %s\nstderr: %s' %
-                   (masked_out, masked_err))
-            raise ExecuteRuntimeError(msg, stdout=out, stderr=err)
-    return proc.returncode, out
+            logging.info("Executing command:\n%s" % masked)
+            sinks.append(LogWriter('STDOUT', mask_list, repl_list))
+        name, host = _command_info(cmd)
+
+        def finished(job):
+            for sink in sinks:
+                sink.close()
+            profiler.record('command', name, job.started, job.ended,
+                            host=host, remote=host is not None, rc=job.rc,
+                            bytes=job.stdout.size + job.stderr.size)
+            if log and job.rc:
+                log_output('STDERR', job.stderr, mask_list, repl_list)
+
+        job = reactor.spawn(cmd, stdout=sinks, callback=finished,
+                            env=_environ('zh_CN.UTF8'))
+        return masked, job
+
+    jobs = [spawn(cmd) for cmd in cmds]
+    reactor.run()
+
+    failed = ['%s\nstdout: %s\nstderr: %s' % (
+              masked, mask_string(job.stdout.tail(), mask_list, repl_list),
+              mask_string(job.stderr.tail(), mask_list, repl_list))
+              for masked, job in jobs if job.rc]
+    jobs = [job for masked, job in jobs]
+    returned = False
+    try:
+        if failed and can_fail:
+            msg = ('Failed to execute %d of %d commands:\n%s' %
+                   (len(failed), len(jobs), '\n'.join(failed)))
+            raise ExecuteRuntimeError(msg)
+        if lazy_output:
+            returned = True
+            return [(job.rc, job.stdout) for job in jobs]
+        return [(job.rc, job.stdout.getvalue()) for job in jobs]
+    finally:
+        # buffers may be backed by temporary files
+        for job in jobs:
+            job.stderr.close()
+            if not returned:
+                job.stdout.close()
+
+
+def _environ(lang):
+    """
+    Returns copy of the environment with given LANG for single command,
+    os.environ itself is not changed as commands may run in threads.
+    """
+    return dict(os.environ, LANG=lang)
+
+
+def _command_info(cmd):
+    """
+    Returns tuple (name, host) for given command. Host is None for
+    commands which are not ran over ssh.
+    """
+    if isinstance(cmd, types.StringType):
+        cmd = cmd.split()
+    if not cmd:
+        return '', None
+    name = os.path.basename(cmd[0])
+    if name not in ('ssh', 'scp'):
+        return name, None
+    for arg in cmd[1:]:
+        if not arg.startswith('-') and '@' in arg:
+            return name, arg.split('@', 1)[1].split(':', 1)[0]
+    return name, None
+
+
+def _script_name(script):
+    for line in script:
+        line = line.strip()
+        if line:
+            return line.splitlines()[0][:60]
+    return ''
 
 
 class ScriptRunner(object):
@@ -83,7 +211,114 @@ class ScriptRunner(object):
     def clear(self):
         self.script = []
 
-    def execute(self, can_fail=True, mask_list=None, log=True):
+    def execute(self, can_fail=True, mask_list=None, log=True,
+                lazy_output=False):
+        """
+        Runs the script and returns tuple (rc, stdout). If lazy_output
+        is set to True stdout is returned as OutputBuffer instead
+        of string.
+        """
+        rc, out, err = self._execute(self.ip, mask_list=mask_list, log=log)
+        # buffers may be backed by temporary files, the returned one
+        # is closed by caller, the ones given to error are kept with it
+        kept = ()
+        try:
+            if rc and can_fail:
+                kept = (out, err)
+                raise self._error(out, err, mask_list=mask_list)
+            if lazy_output:
+                kept = (out,)
+                return rc, out
+            return rc, out.getvalue()
+        finally:
+            for buf in (out, err):
+                if buf not in kept:
+                    buf.close()
+
+    def execute_on(self, hosts, can_fail=True, mask_list=None, log=True,
+                   workers=None, lazy_output=False):
+        """
+        Runs the script on all given hosts concurrently, at most workers
+        hosts at the same time. Returns dict mapping host to tuple
+        (rc, stdout, stderr), output is returned as OutputBuffer if
+        lazy_output is set to True. If can_fail is set to True and the
+        script failed on any host MultiHostError, aggregating errors from
+        all failed hosts, is raised after all hosts have been processed.
+        """
+        hosts = list(hosts)
+        mask_list = mask_list or []
+        repl_list = [("'", "'\\''")]
+        script = self._input()
+        name = _script_name(self.script)
+        reactor = Reactor(limit=workers or concurrency.default_workers)
+
+        def spawn(host):
+            sinks = []
+            if log:
+                masked = mask_string("\n".join(self.script), mask_list,
+                                     repl_list)
+                logging.info("[%s] Executing script:\n%s" %
+                             (host or 'localhost', masked))
+                sinks.append(LogWriter('STDOUT', mask_list, repl_list))
+
+            def finished(job):
+                for sink in sinks:
+                    sink.close()
+                profiler.record('script', name, job.started, job.ended,
+                                host=host or 'localhost', remote=bool(host),
+                                rc=job.rc, bytes=len(script) +
+                                job.stdout.size + job.stderr.size)
+                if log and job.rc:
+                    log_output('STDERR', job.stderr, mask_list, repl_list)
+
+            return reactor.spawn(self._command(host), input=script,
+                                 stdout=sinks, callback=finished,
+                                 env=_environ('en_US.UTF8'))
+
+        # ssh handshakes to all hosts are done concurrently before the
+        # sessions are started
+        ssh_pool.open_all(hosts, workers=workers)
+        # failure to even start the script is not a failure of the script
+        # itself, so there is no reason to hide it
+        jobs = [spawn(host) for host in hosts]
+        reactor.run()
+
+        output, errors = {}, {}
+        for host, job in zip(hosts, jobs):
+            if job.rc:
+                errors[host] = self._error(job.stdout, job.stderr,
+                                           mask_list=mask_list)
+            output[host] = job.rc, job.stdout, job.stderr
+
+        if errors and can_fail:
+            # buffers may be backed by temporary files, the ones given
+            # to errors are kept with them
+            for host, (rc, out, err) in output.items():
+                if host not in errors:
+                    out.close()
+                    err.close()
+            msg = ('Failed to run remote script on %d of %d hosts:\n%s' %
+                   (len(errors), len(hosts),
+                    '\n'.join('[%s] %s' % (host, errors[host])
+                              for host in hosts if host in errors)))
+            raise MultiHostError(msg, errors=errors)
+        if not lazy_output:
+            for host, (rc, out, err) in output.items():
+                output[host] = rc, out.getvalue(), err.getvalue()
+                out.close()
+                err.close()
+        return output
+
+    def _command(self, ip):
+        if ip:
+            return ssh_pool.ssh_command(ip, "bash -x")
+        return ["bash", "-x"]
+
+    def _input(self):
+        script = "\n".join(self.script)
+        return "function t(){ exit $? ; } \n trap t ERR \n" + script
+
+    def _execute(self, ip, mask_list=None, log=True):
         mask_list = mask_list or []
         repl_list = [("'", "'\\''")]
         script = "\n".join(self.script)
@@ -91,42 +326,53 @@ class ScriptRunner(object):
         masked = mask_string(script, mask_list, repl_list)
         if log:
             logging.info("[%s] Executing script:\n%s" %
-                         (self.ip or 'localhost', masked))
+                         (ip or 'localhost', masked))
 
         _PIPE = subprocess.PIPE  # pylint: disable=E1101
-        if self.ip:
-            cmd = ["ssh", "-o", "StrictHostKeyChecking=no",
-                          "-o", "UserKnownHostsFile=/dev/null",
-                          "root@%s" % self.ip, "bash -x"]
-        else:
-            cmd = ["bash", "-x"]
-        environ = os.environ
-        environ['LANG'] = 'en_US.UTF8'
-        obj = subprocess.Popen(cmd, stdin=_PIPE, stdout=_PIPE, stderr=_PIPE,
-                               close_fds=True, shell=False, env=environ)
-
-        script = "function t(){ exit $? ; } \n trap t ERR \n" + script
-        out, err = obj.communicate(script)
+        obj = subprocess.Popen(self._command(ip), stdin=_PIPE, stdout=_PIPE,
+                               stderr=_PIPE, close_fds=True, shell=False,
+                               env=_environ('en_US.UTF8'))
+
+        script = self._input()
+        with profiler.span('script', _script_name(self.script),
+                           host=ip or 'localhost', remote=bool(ip)) as span:
+            out, err = OutputBuffer(), OutputBuffer()
+            sinks = [out]
+            if log:
+                sinks.append(LogWriter('STDOUT', mask_list, repl_list))
+            pump(obj, input=script, stdout=sinks, stderr=[err])
+            if log:
+                sinks[1].close()
+            span['rc'] = obj.returncode
+            span['bytes'] = len(script) + out.size + err.size
+        if log and obj.returncode:
+            log_output('STDERR', err, mask_list, repl_list)
+        return obj.returncode, out, err
+
+    def _error(self, out, err, mask_list=None):
+        """
+        Returns exception describing failed run of the script. Only ends
+        of given output buffers are used in message, buffers themselves
+        are given to the exception.
+        """
+        mask_list = mask_list or []
+        repl_list = [("'", "'\\''")]
+        buffers = out, err
+        out, err = out.tail(), err.tail()
         masked_out = mask_string(out, mask_list, repl_list)
         masked_err = mask_string(err, mask_list, repl_list)
-        if log:
-            logging.debug(block_fmt % {'title': 'STDOUT',
-                                       'content': masked_out})
 
-        if obj.returncode:
-            if log:
-                logging.debug(block_fmt % {'title': 'STDERR',
-                                           'content': masked_err})
-            if can_fail:
-                pattern = (r'^ssh\:')
-                if re.search(pattern, err):
-                    raise NetworkError(masked_err, stdout=out, stderr=err)
-                else:
-                    msg = ('Failed to run remote script, '
-                           'stdout: %s\nstderr: %s' %
-                           (masked_out, masked_err))
-                    raise ScriptRuntimeError(msg, stdout=out, stderr=err)
-        return obj.returncode, out
+        pattern = (r'^ssh\:')
+        if re.search(pattern, err):
+            return NetworkError(masked_err, stdout=out, stderr=err,
+                                stdout_buffer=buffers[0],
+                                stderr_buffer=buffers[1])
+        msg = ('Failed to run remote script, '
+               'stdout: %s\nstderr: %s' %
+               (masked_out, masked_err))
+        return ScriptRuntimeError(msg, stdout=out, stderr=err,
+                                  stdout_buffer=buffers[0],
+                                  stderr_buffer=buffers[1])
 
     def template(self, src, dst, varsdict):
         with open(src) as fp:
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+
+from .concurrency import parallel_map
+
+
+SSH_OPTIONS = ('-o', 'StrictHostKeyChecking=no',
+               '-o', 'UserKnownHostsFile=/dev/null')
+
+
+class SshConnectionPool(object):
+    """
+    Keeps one multiplexed master connection (OpenSSH ControlMaster) per
+    host. Every ssh or scp call built by this pool is sent through
+    already authenticated master connection, so only the first call to
+    the host pays for TCP connection, key exchange and authentication.
+    If the master connection cannot be established, ssh silently falls
+    back to standalone connection.
+    """
+    def __init__(self, user='root', persist=600, enabled=True):
+        self.user = user
+        # seconds an idle master connection is kept alive, this makes
+        # sure orphaned masters go away if installer gets killed
+        self.persist = persist
+        self.enabled = enabled
+
+        self._control_dir = None
+        self._masters = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def control_dir(self):
+        """
+        Directory holding control sockets. Path has to stay short, because
+        unix sockets are limited to ~100 characters.
+        """
+        with self._lock:
+            if self._control_dir is None:
+                self._control_dir = tempfile.mkdtemp(prefix='casaba-ssh-')
+        return self._control_dir
+
+    def _control_path(self):
+        return ['-o', 'ControlPath=%s'
+                % os.path.join(self.control_dir, '%r@%h:%p')]
+
+    def options(self):
+        """
+        Returns list of options which should be passed to ssh or scp.
+        """
+        opts = list(SSH_OPTIONS)
+        if self.enabled:
+            opts.extend(['-o', 'ControlMaster=no'] + self._control_path())
+        return opts
+
+    def open(self, host):
+        """
+        Starts master connection to given host unless it is already
+        running. Returns True if master connection is available.
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            lock = self._host_locks.setdefault(host, threading.Lock())
+        # masters to different hosts can be started simultaneously
+        with lock:
+            if host not in self._masters:
+                self._masters[host] = self._start_master(host)
+            return self._masters[host]
+
+    def open_all(self, hosts, workers=None):
+        """
+        Starts master connections to all given hosts concurrently, at most
+        workers at the same time. Returns dict mapping host to True
+        if master connection is available.
+        """
+        hosts = [i for i in hosts if i]
+        if not self.enabled or not hosts:
+            return dict((host, False) for host in hosts)
+        results = parallel_map(self.open, hosts, workers=workers)
+        # failure to start master is not fatal, ssh falls back
+        # to standalone connection
+        return dict((host, bool(result)) for host, (result, exc_info)
+                    in zip(hosts, results))
+
+    def _start_master(self, host):
+        cmd = ['ssh'] + list(SSH_OPTIONS) + self._control_path()
+        cmd.extend(['-M', '-N', '-f',
+                    '-o', 'ControlPersist=%d' % self.persist,
+                    '%s@%s' % (self.user, host)])
+        with open(os.devnull, 'r+') as devnull:
+            # stdout/stderr of daemonized master must not be a pipe,
+            # otherwise reading them would block until master exits
+            rc = subprocess.call(cmd, stdin=devnull, stdout=devnull,
+                                 stderr=devnull, close_fds=True)
+        if rc:
+            logging.debug('Failed to open master ssh connection to %s, '
+                          'falling back to standalone connections.' % host)
+        return rc == 0
+
+    def ssh_command(self, host, *command):
+        """
+        Returns ssh command list for running given command on host.
+        """
+        self.open(host)
+        cmd = ['ssh'] + self.options() + ['%s@%s' % (self.user, host)]
+        cmd.extend(command)
+        return cmd
+
+    def scp_command(self, host, *paths):
+        """
+        Returns scp command list. Remote paths in given paths have
+        to be in format user@host:path.
+        """
+        self.open(host)
+        return ['scp'] + self.options() + list(paths)
+
+    def remote(self, host, path):
+        """
+        Returns remote path in format usable by scp.
+        """
+        return '%s@%s:%s' % (self.user, host, path)
+
+    def close(self, host):
+        """
+        Closes master connection to given host.
+        """
+        with self._lock:
+            opened = self._masters.pop(host, False)
+        if not opened:
+            return
+        cmd = ['ssh'] + self.options()
+        cmd.extend(['-O', 'exit', '%s@%s' % (self.user, host)])
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.call(cmd, stdin=devnull, stdout=devnull,
+                            stderr=devnull, close_fds=True)
+
+    def close_all(self):
+        """
+        Closes all master connections and removes control sockets.
+        """
+        for host in list(self._masters):
+            self.close(host)
+        with self._lock:
+            if self._control_dir is not None:
+                shutil.rmtree(self._control_dir, ignore_errors=True)
+                self._control_dir = None
+
+
+ssh_pool = SshConnectionPool()
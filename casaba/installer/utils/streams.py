@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+import select
+import logging
+import tempfile
+
+from StringIO import StringIO
+
+from .strings import get_masker
+
+
+CHUNK_SIZE = 64 * 1024
+# output bigger than this is spilled to temporary file
+SPILL_LIMIT = 1024 * 1024
+# size of the end of output kept in memory for error messages
+TAIL_SIZE = 16 * 1024
+# maximal size of single log record
+LOG_BATCH_SIZE = 256 * 1024
+
+READ_EVENTS = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+WRITE_EVENTS = select.POLLOUT | select.POLLHUP | select.POLLERR
+
+
+block_fmt = ("\n============= %(title)s ==========\n%(content)s\n"
+             "======== END OF %(title)s ========")
+
+
+class OutputBuffer(object):
+    """
+    Collects output of a command. Output is kept in memory until it
+    exceeds spill_limit bytes, then it is moved to temporary file, so
+    memory usage does not depend on the size of the output. Last tail_size
+    bytes are always available in memory.
+    """
+    def __init__(self, spill_limit=SPILL_LIMIT, tail_size=TAIL_SIZE):
+        self.spill_limit = spill_limit
+        self.tail_size = tail_size
+        self.size = 0
+        self._chunks = []
+        self._tail = ''
+        self._file = None
+
+    def write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        self._tail = (self._tail + data)[-self.tail_size:]
+        if self._file is None and self.size > self.spill_limit:
+            self._file = tempfile.NamedTemporaryFile(prefix='casaba-output-')
+            self._file.writelines(self._chunks)
+            self._chunks = []
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._chunks.append(data)
+
+    def tail(self):
+        """
+        Returns end of the output, skipped part is marked.
+        """
+        if self.size <= self.tail_size:
+            return self._tail
+        return ('[... %d bytes skipped ...]\n%s'
+                % (self.size - self.tail_size, self._tail))
+
+    def open(self):
+        """
+        Returns file object for reading of whole output from beginning.
+        """
+        if self._file is None:
+            return StringIO(''.join(self._chunks))
+        self._file.flush()
+        return open(self._file.name, 'rb')
+
+    def chunks(self, size=CHUNK_SIZE):
+        """
+        Iterates over whole output in chunks of given size.
+        """
+        fp = self.open()
+        try:
+            for chunk in iter(lambda: fp.read(size), ''):
+                yield chunk
+        finally:
+            fp.close()
+
+    def getvalue(self):
+        """
+        Returns whole output as string.
+        """
+        if self._file is None:
+            return ''.join(self._chunks)
+        return ''.join(self.chunks())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._chunks = []
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.getvalue()
+
+
+class LogWriter(object):
+    """
+    Writes output to log as it comes, masked by mask_string. Output is
+    masked and logged by whole lines in records of about LOG_BATCH_SIZE
+    bytes. Output fitting into single record is logged as block
+    the same way it was logged before streaming. Long lines are split,
+    but never inside of masked word.
+    """
+    def __init__(self, title, mask_list=None, repl_list=None,
+                 level=logging.DEBUG):
+        self.title = title
+        self.mask_list = mask_list or []
+        self.repl_list = repl_list or []
+        self.level = level
+        self._masker = get_masker(self.mask_list, self.repl_list)
+        self._pending = []
+        self._size = 0
+        self._started = False
+
+    def write(self, data):
+        self._pending.append(data)
+        self._size += len(data)
+        if self._size >= LOG_BATCH_SIZE:
+            text = ''.join(self._pending)
+            idx = text.rfind('\n') + 1
+            if not idx:
+                # end of the batch can be beginning of masked word
+                idx = len(text) - max(self._masker.longest - 1, 0)
+            idx = self._masker.split_point(text, idx)
+            if not idx:
+                # whole batch is part of single masked word
+                return
+            self._pending = [text[idx:]]
+            self._size = len(self._pending[0])
+            self._log(text[:idx], last=False)
+
+    def close(self):
+        text = ''.join(self._pending)
+        self._pending, self._size = [], 0
+        self._log(text, last=True)
+
+    def _log(self, text, last):
+        content = self._masker.mask(text.rstrip('\n') if last else text)
+        title = self.title
+        if not self._started and last:
+            logging.log(self.level, block_fmt % {'title': title,
+                                                 'content': content})
+            return
+        if not self._started:
+            content = '\n============= %s ==========\n%s' % (title, content)
+            self._started = True
+        if last:
+            content = '%s\n======== END OF %s ========' % (content, title)
+        logging.log(self.level, content)
+
+
+def log_output(title, output, mask_list=None, repl_list=None):
+    """
+    Logs whole content of given OutputBuffer in chunks.
+    """
+    writer = LogWriter(title, mask_list=mask_list, repl_list=repl_list)
+    for chunk in output.chunks():
+        writer.write(chunk)
+    writer.close()
+
+
+def pump(proc, input=None, stdout=(), stderr=()):
+    """
+    Replacement of Popen.communicate, which does not collect output
+    of the process. Given input is written to stdin of the process and
+    chunks of its output are passed to write methods of all objects in
+    stdout and stderr lists as they are read. Returns return code of the
+    process.
+    """
+    poller = select.poll()
+    readers = {}
+    for pipe, sinks in ((proc.stdout, stdout), (proc.stderr, stderr)):
+        if pipe is not None:
+            readers[pipe.fileno()] = (pipe, sinks)
+            poller.register(pipe.fileno(), READ_EVENTS)
+    writer = None
+    if proc.stdin is not None:
+        if input:
+            writer = proc.stdin.fileno()
+            poller.register(writer, WRITE_EVENTS)
+        else:
+            proc.stdin.close()
+    offset = 0
+
+    while readers or writer is not None:
+        try:
+            events = poller.poll()
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd, event in events:
+            if fd == writer:
+                try:
+                    offset += os.write(
+                        fd, input[offset:offset + select.PIPE_BUF])
+                except OSError as ex:
+                    if ex.errno != errno.EPIPE:
+                        raise
+                    # process does not read its input any more
+                    offset = len(input)
+                if offset >= len(input):
+                    poller.unregister(fd)
+                    proc.stdin.close()
+                    writer = None
+                continue
+
+            data = os.read(fd, CHUNK_SIZE)
+            pipe, sinks = readers[fd]
+            if not data:
+                poller.unregister(fd)
+                pipe.close()
+                del readers[fd]
+                continue
+            for sink in sinks:
+                sink.write(data)
+    return proc.wait()
@@ -29,6 +29,104 @@ def color_text(text, color):
     return '%s%s%s' % (COLORS[color], text, COLORS['nocolor'])
 
 
+class Masker(object):
+    """
+    Replaces words from given list with MASK in strings. Words are compiled
+    to single alternation regex, so every string is masked in single pass
+    regardless of number of words. Longer words take precedence. Words
+    can be transformed before masking, see mask_string.
+    """
+    def __init__(self, words=None, replace_list=None):
+        self.replace_list = tuple(replace_list or ())
+        self.words = frozenset()
+        # length of the longest word after transformation
+        self.longest = 0
+        self._regex = None
+        self.update(words or ())
+
+    def update(self, words):
+        """
+        Sets words to be masked. Regex is compiled again only if the words
+        have changed.
+        """
+        words = frozenset(i for i in words if i)
+        if words == self.words:
+            return
+        variants = set()
+        for word in words:
+            for before, after in self.replace_list:
+                word = word.replace(before, after)
+            variants.add(word)
+        self.words = words
+        self.longest = max([len(i) for i in variants] or [0])
+        self._regex = variants and re.compile(_trie_pattern(variants)) or None
+
+    def mask(self, unmasked):
+        """
+        Returns given string with all words masked.
+        """
+        if self._regex is None or not unmasked:
+            return unmasked
+        return self._regex.sub(STR_MASK, unmasked)
+
+    def split_point(self, text, idx):
+        """
+        Returns the highest position not greater than idx, at which given
+        string can be split without splitting any masked word, so that
+        both parts are masked the same way as the whole string.
+        """
+        if self._regex is None:
+            return idx
+        for match in self._regex.finditer(text, max(0, idx - self.longest)):
+            if match.start() >= idx:
+                break
+            if match.end() > idx:
+                return match.start()
+        return idx
+
+    def mask_lines(self, lines):
+        """
+        Masks lines of a stream (for example file object) one by one.
+        """
+        for line in lines:
+            yield self.mask(line)
+
+
+def _trie_pattern(words):
+    """
+    Returns regex pattern matching any of given words. Words are stored
+    in prefix tree, so common prefixes are matched only once, and longer
+    words take precedence.
+    """
+    tree = {}
+    for word in words:
+        node = tree
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def build(node):
+        if len(node) == 1 and '' in node:
+            return ''
+        alternatives = [re.escape(char) + build(node[char])
+                        for char in sorted(node) if char]
+        if len(alternatives) == 1:
+            pattern = alternatives[0]
+        else:
+            pattern = '(?:%s)' % '|'.join(alternatives)
+        if '' in node:
+            # word ends here, but longer match is preferred
+            pattern = '(?:%s)?' % pattern
+        return pattern
+
+    return build(tree)
+
+
+# compiled maskers for recently used mask lists
+_maskers = {}
+_MASKERS_LIMIT = 32
+
+
 def mask_string(unmasked, mask_list=None, replace_list=None):
     """
     Replaces words from mask_list with MASK in unmasked string.
@@ -36,17 +134,20 @@ def mask_string(unmasked, mask_list=None, replace_list=None):
     could be describe in replace list. For example [("'","'\\''")]
     replaces all ' characters with '\\''.
     """
-    mask_list = mask_list or []
-    replace_list = replace_list or []
-
-    masked = unmasked
-    for word in sorted(mask_list, lambda x, y: len(y) - len(x)):
-        if not word:
-            continue
-        for before, after in replace_list:
-            word = word.replace(before, after)
-        masked = masked.replace(word, STR_MASK)
-    return masked
+    return get_masker(mask_list, replace_list).mask(unmasked)
+
+
+def get_masker(mask_list=None, replace_list=None):
+    """
+    Returns cached Masker for given words and transformations.
+    """
+    key = (frozenset(mask_list or ()), tuple(replace_list or ()))
+    masker = _maskers.get(key)
+    if masker is None:
+        if len(_maskers) >= _MASKERS_LIMIT:
+            _maskers.clear()
+        masker = _maskers[key] = Masker(*key)
+    return masker
 
 
 def state_format(msg, state, color):
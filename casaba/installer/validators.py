@@ -18,6 +18,8 @@ Contains all core validation functions.
 
 import os
 import re
+import errno
+import select
 import socket
 import logging
 
@@ -33,7 +35,94 @@ __all__ = ('ParamValidationError', 'validate_integer', 'validate_float',
            'validate_multi_ping', 'validate_ssh', 'validate_multi_ssh',
            'validate_sshkey', 'validate_ldap_url', 'validate_ldap_dn',
            'validate_export', 'validate_multi_export',
-           'validate_writeable_directory')
+           'validate_writeable_directory', 'DeferredValidation')
+
+
+class DeferredValidation(object):
+    """
+    Collects validation of parameter values. Validators marked as
+    network_bound are not called immediately, but concurrently by run.
+    Same check requested by multiple parameters (or by multiple values
+    of comma separated parameter) is done only once.
+    """
+    def __init__(self):
+        self.errors = []
+        self._checks = []
+        self._index = {}
+
+    def add(self, name, validator, value, options=None):
+        """
+        Defers validation of value of parameter name.
+        """
+        options = tuple(options or ())
+        each = getattr(validator, 'each', None)
+        if each and isinstance(value, basestring):
+            checks = [(each, i.strip(), options) for i in value.split(',')]
+        else:
+            checks = [(validator, value, options)]
+        for check in checks:
+            try:
+                owners = self._index.get(check)
+            except TypeError:
+                # unhashable value can't be deduplicated
+                owners = None
+            if owners is None:
+                owners = []
+                self._checks.append((check, owners))
+                try:
+                    self._index[check] = owners
+                except TypeError:
+                    pass
+            if name not in owners:
+                owners.append(name)
+
+    def fail(self, name, error):
+        """
+        Records validation failure of parameter name.
+        """
+        self.errors.append((name, error))
+
+    def run(self, workers=None):
+        """
+        Runs deferred checks concurrently and returns list of (parameter
+        name, ParamValidationError) of all validation failures. Values
+        of validators having batch variant are checked by single call
+        of the batch function, the rest is checked in threads.
+        """
+        def check(args):
+            validator, value, options = args
+            validator(value, list(options))
+
+        checks, self._checks, self._index = self._checks, [], {}
+        failures = {}
+        batches, single = utils.SortedDict(), []
+        for idx, (args, owners) in enumerate(checks):
+            batch = getattr(args[0], 'batch', None)
+            if batch:
+                batches.setdefault(batch, []).append(idx)
+            else:
+                single.append(idx)
+        for batch, indexes in batches.iteritems():
+            errors = batch([checks[i][0][1] for i in indexes],
+                           workers=workers)
+            for idx in indexes:
+                value = checks[idx][0][1]
+                if value in errors:
+                    failures[idx] = errors[value]
+        results = utils.parallel_map(check, [checks[i][0] for i in single],
+                                     workers=workers)
+        for idx, (result, exc_info) in zip(single, results):
+            if not exc_info:
+                continue
+            if not isinstance(exc_info[1], ParamValidationError):
+                raise exc_info[1]
+            failures[idx] = exc_info[1]
+
+        for idx, (args, owners) in enumerate(checks):
+            if idx in failures:
+                for name in owners:
+                    self.fail(name, failures[idx])
+        return self.errors
 
 
 def validate_integer(param, options=None):
@@ -234,14 +323,32 @@ def validate_ping(param, options=None):
         raise ParamValidationError(msg % param)
 
 
+def ping_all(hosts, workers=None):
+    """
+    Batch variant of validate_ping. All hosts are pinged concurrently
+    from single thread. Returns dict mapping unreachable hosts
+    to ParamValidationError.
+    """
+    hosts = [i for i in hosts if i]
+    cmds = [['/bin/ping', '-c', '1', str(i)] for i in hosts]
+    errors = {}
+    results = utils.execute_all(cmds, can_fail=False, workers=workers)
+    for host, (rc, out) in zip(hosts, results):
+        if rc != 0:
+            logging.debug('validate_ping(%s) failed.' % host)
+            msg = 'Given host is unreachable: %s'
+            errors[host] = ParamValidationError(msg % host)
+    return errors
+
+
 def validate_multi_ping(param, options=None):
     """
     Raises ParamValidationError if comma separated host given in param
     do not answer to ICMP echo request.
     """
     options = options or []
-    for host in param.split(","):
-        validate_ping(host.strip())
+    hosts = [host.strip() for host in param.split(",")]
+    _raise_host_errors(hosts, ping_all(hosts))
 
 
 _tested_ports = []
@@ -260,6 +367,63 @@ def touch_port(host, port):
     _tested_ports.append(key)
 
 
+def touch_ports(addresses, timeout=None):
+    """
+    Checks that hosts are listening on ports, addresses are given as list
+    of (host, port) tuples. All connections are opened concurrently from
+    single thread. Returns dict mapping failed addresses to socket.error.
+    """
+    reactor = utils.Reactor()
+    sockets, errors = {}, {}
+
+    def connect(address, infos):
+        family, socktype, proto, canonname, sockaddr = infos.pop(0)
+        sock = sockets[address] = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+        rc = sock.connect_ex(sockaddr)
+        if rc != errno.EINPROGRESS:
+            connected(address, infos, rc)
+            return
+
+        def ready(fd, event):
+            reactor.unwatch(fd)
+            rc = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            connected(address, infos, rc)
+        reactor.watch(sock.fileno(), ready, select.POLLOUT)
+
+    def connected(address, infos, rc):
+        sock = sockets.pop(address)
+        if not rc:
+            sock.shutdown(socket.SHUT_RDWR)
+        sock.close()
+        if not rc:
+            _tested_ports.append("%s:%d" % address)
+        elif infos:
+            # try next address of the host
+            connect(address, infos)
+        else:
+            errors[address] = socket.error(rc, os.strerror(rc))
+
+    for address in addresses:
+        if "%s:%d" % address in _tested_ports:
+            continue
+        try:
+            infos = socket.getaddrinfo(address[0], address[1], 0,
+                                       socket.SOCK_STREAM)
+        except socket.error as ex:
+            errors[address] = ex
+            continue
+        connect(address, infos)
+    try:
+        if not reactor.run(timeout):
+            for address in sockets:
+                errors[address] = socket.timeout('timed out')
+    finally:
+        for sock in sockets.values():
+            sock.close()
+    return errors
+
+
 def validate_ssh(param, options=None):
     """
     Raises ParamValidationError if provided host does not listen
@@ -277,14 +441,60 @@ def validate_ssh(param, options=None):
         raise ParamValidationError(msg % param)
 
 
+def ssh_all(hosts, workers=None):
+    """
+    Batch variant of validate_ssh. Returns dict mapping hosts, which
+    do not listen on port 22, to ParamValidationError.
+    """
+    hosts = [i for i in hosts if i]
+    failed = touch_ports([(i.strip(), 22) for i in hosts])
+    errors = {}
+    for host in hosts:
+        if (host.strip(), 22) in failed:
+            logging.debug('validate_ssh(%s) failed.' % host)
+            msg = 'Given host does not listen on port 22: %s'
+            errors[host] = ParamValidationError(msg % host)
+    return errors
+
+
 def validate_multi_ssh(param, options=None):
     """
     Raises ParamValidationError if comma separated host provided
     in param do not listen on port 22.
     """
     options = options or []
-    for host in param.split(","):
-        validate_ssh(host)
+    hosts = param.split(",")
+    _raise_host_errors(hosts, ssh_all(hosts))
+
+
+def _raise_host_errors(hosts, errors):
+    """
+    Raises ParamValidationError describing validation failures of all
+    given hosts, errors is dict mapping failed hosts to exceptions.
+    """
+    failed = []
+    for host in hosts:
+        if host in errors and host not in failed:
+            failed.append(host)
+    if len(failed) == 1:
+        raise errors[failed[0]]
+    if failed:
+        msg = ('Validation failed on %d of %d hosts:\n%s' %
+               (len(failed), len(hosts),
+                '\n'.join('[%s] %s' % (host.strip(), errors[host])
+                          for host in failed)))
+        raise ParamValidationError(msg)
+
+
+# Define network bound validators, validation of multiple values is split
+# to validation of single values
+for val_func in (validate_ping, validate_multi_ping,
+                 validate_ssh, validate_multi_ssh):
+    val_func.network_bound = True
+validate_multi_ping.each = validate_ping
+validate_multi_ssh.each = validate_ssh
+validate_ping.batch = ping_all
+validate_ssh.batch = ssh_all
 
 
 def validate_sshkey(param, options=None):
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Issuing of SSL certificates signed by installer CA for services on hosts.
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import logging
+import multiprocessing
+
+from OpenSSL import crypto
+
+from ..installer import utils
+from ..installer.exceptions import MultiHostError
+
+
+KEY_BITS = 4096
+PEM_MARKER = 'CASABA_PEM_EOF'
+
+# TO-DO: complete logger name when logging will be setup correctly
+logger = logging.getLogger()
+
+
+def _generate_key(bits):
+    # runs in worker process, PKey instances can't be pickled
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, bits)
+    return crypto.dump_privatekey(crypto.FILETYPE_PEM, key)
+
+
+def generate_keys(count, bits=KEY_BITS, processes=None):
+    """
+    Generates count RSA keys in a pool of processes (one per CPU
+    by default). Returns list of keys in PEM format.
+    """
+    if count <= 1 or processes == 1:
+        return [_generate_key(bits) for i in range(count)]
+    pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(),
+                                    count))
+    try:
+        return pool.map(_generate_key, [bits] * count)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class CertificateStore(object):
+    """
+    On-disk store of issued keys and certificates. Entries are keyed
+    by host, service and subject of the certificate (including CA which
+    signed it), so reruns of installer reuse certificates unless any
+    of these changes.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, host, service, subject):
+        data = json.dumps([host, service, subject], sort_keys=True)
+        return '%s-%s' % (self._prefix(host, service),
+                          hashlib.sha1(data).hexdigest()[:16])
+
+    def _prefix(self, host, service):
+        return '%s-%s' % (host, service.replace('/', '_'))
+
+    def issued(self, host, service):
+        """
+        Returns True if any certificate of given service on given host
+        is stored.
+        """
+        if not os.path.isdir(self.directory):
+            return False
+        prefix = self._prefix(host, service) + '-'
+        return any(i.startswith(prefix) and i.endswith('.json')
+                   for i in os.listdir(self.directory))
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.json' % key)
+
+    def get(self, key):
+        """
+        Returns tuple (key PEM, certificate PEM) or None if there is
+        no such entry.
+        """
+        try:
+            with open(self._path(key)) as fp:
+                entry = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        return str(entry['key']), str(entry['cert'])
+
+    def put(self, key, key_pem, cert_pem):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        path = self._path(key)
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'key': key_pem, 'cert': cert_pem}, fp)
+        os.rename(path + '.tmp', path)
+
+
+class CertificateIssuer(object):
+    """
+    Collects requests for certificates of services on hosts and issues
+    them at once. Missing keys are generated in a pool of processes,
+    issued certificates are stored in CertificateStore and all files
+    of a host are delivered to it by single ssh session.
+    """
+    def __init__(self, config, processes=None, workers=None):
+        self.config = config
+        self.processes = processes
+        self.workers = workers
+        self.cert_dir = os.path.join(config['CONFIG_SSL_CERT_DIR'], 'certs')
+        self.store = CertificateStore(os.path.join(self.cert_dir, 'store'))
+        self._requests = []
+
+    def request(self, host, service, ssl_key_file, ssl_cert_file):
+        """
+        Registers request for certificate of service on host, key and
+        certificate are delivered to given paths on the host.
+        """
+        self._requests.append((host, service, ssl_key_file, ssl_cert_file))
+
+    def _subject(self, host, service, ca_cert):
+        config = self.config
+        fqdn = config['HOST_DETAILS'][host]['fqdn']
+        return {
+            'C': config['CONFIG_SSL_CERT_SUBJECT_C'],
+            'ST': config['CONFIG_SSL_CERT_SUBJECT_ST'],
+            'L': config['CONFIG_SSL_CERT_SUBJECT_L'],
+            'O': config['CONFIG_SSL_CERT_SUBJECT_O'],
+            'OU': config['CONFIG_SSL_CERT_SUBJECT_OU'],
+            'CN': "%s/%s" % (service, fqdn),
+            'emailAddress': config['CONFIG_SSL_CERT_SUBJECT_MAIL'],
+            'issuer': hashlib.sha1(ca_cert).hexdigest(),
+        }
+
+    def _sign(self, key_pem, subject, ca, ca_key):
+        key = crypto.load_privatekey(crypto.FILETYPE_PEM, key_pem)
+        cert = crypto.X509()
+        cert_subject = cert.get_subject()
+        for attr in ('C', 'ST', 'L', 'O', 'OU', 'CN', 'emailAddress'):
+            setattr(cert_subject, attr, subject[attr])
+
+        cert.add_extensions([
+            crypto.X509Extension(
+                "keyUsage".encode('ascii'),
+                False,
+                "nonRepudiation,digitalSignature,keyEncipherment".encode('ascii')),
+            crypto.X509Extension(
+                "extendedKeyUsage".encode('ascii'),
+                False,
+                "clientAuth,serverAuth".encode('ascii')),
+        ])
+
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(315360000)
+        cert.set_issuer(ca.get_subject())
+        cert.set_pubkey(key)
+        # certificates issued in the same second need unique serials
+        cert.set_serial_number(uuid.uuid4().int >> 64)
+        cert.sign(ca_key, 'sha1')
+        return crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+
+    def issue(self):
+        """
+        Issues and delivers all requested certificates. Raises
+        MultiHostError if delivery failed on any host.
+        """
+        requests, self._requests = self._requests, []
+        if not requests:
+            return
+        config = self.config
+        with open(config['CONFIG_SSL_CACERT_FILE'], 'rt') as fp:
+            ca_cert = fp.read()
+        with open(config['CONFIG_SSL_CACERT_KEY_FILE'], 'rt') as fp:
+            ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM, fp.read())
+        ca = crypto.load_certificate(crypto.FILETYPE_PEM, ca_cert)
+
+        issued, missing, keys = {}, [], []
+        for host, service, ssl_key_file, ssl_cert_file in requests:
+            local_cert_path = os.path.join(
+                self.cert_dir, host + os.path.basename(ssl_cert_file))
+            subject = self._subject(host, service, ca_cert)
+            key = self.store.key(host, service, subject)
+            keys.append(key)
+            entry = self.store.get(key)
+            if (entry is None and os.path.exists(local_cert_path) and
+                    not self.store.issued(host, service)):
+                # certificate issued by older installer, its key is not
+                # known, so it can't be delivered again
+                continue
+            if entry is None and key not in issued:
+                missing.append((key, subject, local_cert_path))
+            issued[key] = entry
+        for (key, subject, local_cert_path), key_pem in zip(
+                missing, generate_keys(len(missing),
+                                       processes=self.processes)):
+            cert_pem = self._sign(key_pem, subject, ca, ca_key)
+            self.store.put(key, key_pem, cert_pem)
+            with open(local_cert_path, 'w') as f:
+                f.write(cert_pem)
+            issued[key] = key_pem, cert_pem
+        if missing:
+            logger.debug('Issued %d SSL certificates.' % len(missing))
+
+        files = utils.SortedDict()
+        for key, (host, service, ssl_key_file, ssl_cert_file) in zip(
+                keys, requests):
+            if key not in issued:
+                continue
+            key_pem, cert_pem = issued[key]
+            host_files = files.setdefault(host, utils.SortedDict())
+            host_files[config['CONFIG_SSL_CACERT']] = ca_cert
+            host_files[ssl_cert_file] = cert_pem
+            host_files[ssl_key_file] = key_pem
+        mask_list = [i[0] for i in issued.values() if i]
+        deliver_files(files, mask_list=mask_list, workers=self.workers)
+
+
+def deliver_files(files, mask_list=None, workers=None):
+    """
+    Makes sure files have given content on hosts, files are given as dict
+    mapping host to dict mapping path to content. All files of a host are
+    written by single script, existing files with the same content are
+    not touched. Temporary files are readable only by their owner, files
+    being replaced keep their mode and owner and new files get mode
+    given by umask of the remote shell. Raises MultiHostError if delivery
+    failed on any host.
+    """
+    hosts = list(files)
+
+    def deliver(host):
+        server = utils.ScriptRunner(host)
+        server.append("mode=$(printf '%o' $(( 0666 & ~0$(umask) )))")
+        server.append('umask 077')
+        for path, content in files[host].iteritems():
+            if PEM_MARKER in content:
+                raise ValueError('Content of %s contains heredoc marker.'
+                                 % path)
+            # leftover of interrupted delivery would keep its mode
+            server.append("rm -f {path}.tmp\n"
+                          "cat > {path}.tmp <<'{marker}'\n{content}\n{marker}"
+                          .format(path=path, content=content.rstrip('\n'),
+                                  marker=PEM_MARKER))
+            server.append(
+                "if cmp -s {path}.tmp {path}; then\n"
+                "    rm -f {path}.tmp\n"
+                "else\n"
+                "    if [ -e {path} ]; then\n"
+                "        chmod --reference={path} {path}.tmp\n"
+                "        chown --reference={path} {path}.tmp\n"
+                "    else\n"
+                "        chmod $mode {path}.tmp\n"
+                "    fi\n"
+                "    mv -f {path}.tmp {path}\n"
+                "fi".format(path=path))
+        server.execute(mask_list=mask_list)
+
+    errors = {}
+    results = utils.parallel_map(deliver, hosts, workers=workers)
+    for host, (result, exc_info) in zip(hosts, results):
+        if exc_info:
+            errors[host] = exc_info[1]
+    if errors:
+        msg = ('Failed to deliver SSL files on %d of %d hosts:\n%s' %
+               (len(errors), len(hosts),
+                '\n'.join('[%s] %s' % (host, errors[host])
+                          for host in hosts if host in errors)))
+        raise MultiHostError(msg, errors=errors)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import logging
+
+from contextlib import closing
+from StringIO import StringIO
+
+from ..installer import basedefs
+from ..installer import utils
+from ..installer.exceptions import MultiHostError
+
+
+# TO-DO: complete logger name when logging will be setup correctly
+logger = logging.getLogger()
+
+# legacy facts are required by cidr_to_ifname, but only Facter 3+ knows
+# the --show-legacy option
+FACTER_CMD = 'facter -p -j --show-legacy 2> /dev/null || facter -p -j'
+
+
+def _normalize(value):
+    # keep values compatible with the old "key => value" output,
+    # structured facts are kept as they are
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    if isinstance(value, list):
+        return [_normalize(i) for i in value]
+    if isinstance(value, dict):
+        return dict((_normalize(k), _normalize(v))
+                    for k, v in value.iteritems())
+    return value
+
+
+def parse_facts(output):
+    """
+    Parses output of facter given as string or utils.OutputBuffer. JSON
+    output is preferred, output in format "key => value" of older Facter
+    versions is parsed as a fallback.
+    """
+    if isinstance(output, basestring):
+        fp = StringIO(output)
+    else:
+        fp = output.open()
+    with closing(fp):
+        try:
+            return _normalize(json.load(fp))
+        except ValueError:
+            fp.seek(0)
+        facts = {}
+        for line in fp:
+            try:
+                key, value = line.split('=>', 1)
+            except ValueError:
+                # this line is probably some warning, so let's skip it
+                continue
+            else:
+                facts[key.strip()] = value.strip()
+        return facts
+
+
+def _cache_path(host):
+    return os.path.join(basedefs.runtime.FACTS_CACHE_DIR, '%s.json' % host)
+
+
+def load_cached_facts(host, ttl=None):
+    """
+    Returns cached facts of given host or None if there are no facts
+    cached or they are older than ttl seconds.
+    """
+    ttl = basedefs.FACTS_CACHE_TTL if ttl is None else ttl
+    try:
+        with open(_cache_path(host)) as fp:
+            cached = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    if time.time() - cached.get('timestamp', 0) > ttl:
+        return None
+    return _normalize(cached['facts'])
+
+
+def store_facts(host, facts):
+    """
+    Stores facts of given host to cache.
+    """
+    if not os.path.isdir(basedefs.runtime.FACTS_CACHE_DIR):
+        os.makedirs(basedefs.runtime.FACTS_CACHE_DIR, 0o700)
+    path = _cache_path(host)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump({'timestamp': time.time(), 'facts': facts}, fp)
+    os.rename(path + '.tmp', path)
+
+
+def discover_hosts(hosts, prepare=None, ttl=None, workers=None):
+    """
+    Discovers facts of all given hosts concurrently. Facts cached less
+    than ttl seconds ago are used instead of running facter. Commands
+    in prepare list are ran on every host in the same ssh session.
+    Returns dict mapping host to dict of its facts.
+    """
+    hosts = sorted(hosts)
+
+    def discover(host):
+        facts = load_cached_facts(host, ttl=ttl)
+        server = utils.ScriptRunner(host)
+        for cmd in prepare or []:
+            server.append(cmd)
+        if facts is None:
+            server.append(FACTER_CMD)
+        if server.script:
+            rc, stdout = server.execute(lazy_output=True)
+        if facts is None:
+            facts = parse_facts(stdout)
+            stdout.close()
+            store_facts(host, facts)
+        else:
+            logger.debug('Using cached facts of host %s.' % host)
+        return facts
+
+    details, errors = {}, {}
+    results = utils.parallel_map(discover, hosts, workers=workers)
+    for host, (facts, exc_info) in zip(hosts, results):
+        if exc_info:
+            errors[host] = exc_info[1]
+        else:
+            details[host] = facts
+    if errors:
+        msg = ('Failed to discover %d of %d hosts:\n%s' %
+               (len(errors), len(hosts),
+                '\n'.join('[%s] %s' % (host, errors[host])
+                          for host in hosts if host in errors)))
+        raise MultiHostError(msg, errors=errors)
+    return details
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Writing of hiera data files.
+"""
+
+import os
+import stat
+import hashlib
+import tempfile
+
+import yaml
+
+from .sorteddict import IndentDumper
+from .sorteddict import UnsortableOrderedDict
+
+
+DUMP_OPTIONS = dict(explicit_start=True, default_flow_style=False,
+                    width=50, indent=4)
+
+# mode of new files, umask is read once as it can be read only by setting
+# it, which would not be safe in threads
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+_FILE_MODE = 0o666 & ~_UMASK
+
+IndentDumper.add_representer(UnsortableOrderedDict,
+                             yaml.representer.SafeRepresenter.represent_dict)
+
+
+def dump(data):
+    """
+    Returns given data serialized to YAML in format of hiera data files.
+    """
+    return yaml.dump(data, Dumper=IndentDumper, **DUMP_OPTIONS)
+
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as fp:
+            digest = hashlib.sha1()
+            for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                digest.update(chunk)
+            return digest.hexdigest()
+    except IOError:
+        return None
+
+
+def write_file(path, data):
+    """
+    Writes given data to hiera file on given path. File is replaced
+    atomically and it is not touched at all when its content would not
+    change, so modification time is kept. Returns True if file has been
+    written.
+    """
+    content = dump(data)
+    if hashlib.sha1(content).hexdigest() == _file_digest(path):
+        return False
+    # unique temporary file, so concurrent writers of the same file
+    # don't clobber each other's temporary file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.%s.' % os.path.basename(path),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(content)
+        if os.path.exists(path):
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        else:
+            os.chmod(tmp_path, _FILE_MODE)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
@@ -13,16 +13,16 @@
 
 import os
 import errno
-import yaml
+import types
+import logging
+import collections
 
-# (TODO) use ruamel replace PyYaml
-# from ruamel import yaml
-from OpenSSL import crypto
-from time import time
 from casaba.installer import basedefs
 from casaba.installer import utils
 from casaba.installer.setup_controller import Controller
-from casaba.modules.sorteddict import UnsortableOrderedDict, IndentDumper
+from casaba.modules import hiera
+from casaba.modules.certificates import CertificateIssuer
+from casaba.modules.certificates import deliver_files
 
 controller = Controller()
 
@@ -34,42 +34,75 @@ HIERA_DEFAULTS_YAML = os.path.join(basedefs.PUPPETDATA_DIR, "defaults.yaml")
 
 
 class ManifestFiles(object):
+    """
+    Builder of puppet manifests. Fragments of every manifest are kept
+    in a list and joined only once when manifests are written.
+    """
     def __init__(self):
         self.filelist = []
-        self.data = {}
+        self._fragments = {}
+        self._sizes = {}
+
+    def _file(self, filename, marker):
+        fragments = self._fragments.get(filename)
+        if fragments is None:
+            # manifest starts as empty string, fragments are separated
+            # by new lines
+            fragments = self._fragments[filename] = collections.deque([''])
+            self._sizes[filename] = 0
+            self.filelist.append((filename, marker))
+        return fragments
 
     # continuous manifest file that have the same marker can be
     # installed in parallel, if on different servers
     def addFile(self, filename, marker, data=''):
-        self.data[filename] = self.data.get(filename, '') + '\n' + data
-        for f, p in self.filelist:
-            if f == filename:
-                return
-
-        self.filelist.append((filename, marker))
+        self._file(filename, marker).append(data)
+        self._sizes[filename] += len(data) + 1
 
     def prependFile(self, filename, marker, data=''):
-        self.data[filename] = data + '\n' + self.data.get(filename, '')
-        for f, p in self.filelist:
-            if f == filename:
-                return
-
-        self.filelist.append((filename, marker))
+        self._file(filename, marker).appendleft(data)
+        self._sizes[filename] += len(data) + 1
 
     def getFiles(self):
         return [f for f in self.filelist]
 
-    def writeManifests(self):
+    def getData(self, filename):
+        """
+        Returns content of given manifest.
+        """
+        return '\n'.join(self._fragments[filename])
+
+    def getStats(self):
+        """
+        Returns list of (filename, size, number of fragments) tuples
+        of all manifests in order they were added.
+        """
+        return [(f, self._sizes[f], len(self._fragments[f]) - 1)
+                for f, m in self.filelist]
+
+    def writeManifests(self, workers=None):
         """
         Write out the manifest data to disk, this should only be called once
         write before the puppet manifests are copied to the various servers
         """
-        os.mkdir(basedefs.PUPPET_MANIFEST_DIR, 0o700)
-        for fname, data in self.data.items():
-            path = os.path.join(basedefs.PUPPET_MANIFEST_DIR, fname)
+        # TO-DO: complete logger name when logging will be setup correctly
+        logger = logging.getLogger()
+        os.mkdir(basedefs.runtime.PUPPET_MANIFEST_DIR, 0o700)
+
+        def write(fname):
+            path = os.path.join(basedefs.runtime.PUPPET_MANIFEST_DIR, fname)
             fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
             with os.fdopen(fd, 'w') as fp:
-                fp.write(data)
+                fp.write(self.getData(fname))
+
+        files = [f for f, m in self.filelist]
+        results = utils.parallel_map(write, files, workers=workers)
+        for fname, size, count in self.getStats():
+            logger.debug('Manifest %s: %d bytes in %d fragments'
+                         % (fname, size, count))
+        for result, exc_info in results:
+            if exc_info:
+                raise exc_info[1]
 manifestfiles = ManifestFiles()
 
 
@@ -101,81 +134,34 @@ def generateHieraDataDir(environment, domain_name):
 
 
 def generateHieraDataFile(hiera_name, data):
-    with open(hiera_name, 'w') as outfile:
-        yaml.add_representer(UnsortableOrderedDict, yaml.representer.SafeRepresenter.represent_dict)
-        IndentDumper.ignore_aliases = lambda self, data: True
-        outfile.write(yaml.dump(data,
-                                Dumper=IndentDumper,
-                                explicit_start=True,
-                                default_flow_style=False,
-                                width=50, indent=4))
+    """
+    Writes hiera data file, file with the same content is not rewritten.
+    """
+    hiera.write_file(hiera_name, data)
 
 
 def generate_ssl_cert(config, host, service, ssl_key_file, ssl_cert_file):
     """
-    Wrapper on top of openssl
+    Wrapper on top of openssl kept for compatibility. Every call issues
+    single certificate: its key is generated in this process and files
+    are delivered by separate ssh session, only reuse of certificates
+    from the persistent store applies. Callers issuing certificates
+    for multiple hosts or services should request them from single
+    certificates.CertificateIssuer, so that keys are generated
+    concurrently and files are delivered to every host at once.
+    """
+    issuer = CertificateIssuer(config)
+    issuer.request(host, service, ssl_key_file, ssl_cert_file)
+    issuer.issue()
+
+
+def deliver_ssl_file(content, path, hosts):
+    """
+    Makes sure given content is in file on given path on all given hosts.
     """
-    # We have to check whether the certificate already exists
-    cert_dir = os.path.join(config['CONFIG_SSL_CERT_DIR'], 'certs')
-    local_cert_name = host + os.path.basename(ssl_cert_file)
-    local_cert_path = os.path.join(cert_dir, local_cert_name)
-    if not os.path.exists(local_cert_path):
-        ca_file = open(config['CONFIG_SSL_CACERT_FILE'], 'rt').read()
-        ca_key_file = open(config['CONFIG_SSL_CACERT_KEY_FILE'], 'rt').read()
-        ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM, ca_key_file)
-        ca = crypto.load_certificate(crypto.FILETYPE_PEM, ca_file)
-
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, 4096)
-        mail = config['CONFIG_SSL_CERT_SUBJECT_MAIL']
-        hostinfo = config['HOST_DETAILS'][host]
-        fqdn = hostinfo['fqdn']
-        cert = crypto.X509()
-        subject = cert.get_subject()
-        subject.C = config['CONFIG_SSL_CERT_SUBJECT_C']
-        subject.ST = config['CONFIG_SSL_CERT_SUBJECT_ST']
-        subject.L = config['CONFIG_SSL_CERT_SUBJECT_L']
-        subject.O = config['CONFIG_SSL_CERT_SUBJECT_O']
-        subject.OU = config['CONFIG_SSL_CERT_SUBJECT_OU']
-        subject.CN = "%s/%s" % (service, fqdn)
-        subject.emailAddress = mail
-
-        cert.add_extensions([
-            crypto.X509Extension(
-                "keyUsage".encode('ascii'),
-                False,
-                "nonRepudiation,digitalSignature,keyEncipherment".encode('ascii')),
-            crypto.X509Extension(
-                "extendedKeyUsage".encode('ascii'),
-                False,
-                "clientAuth,serverAuth".encode('ascii')),
-        ])
-
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(315360000)
-        cert.set_issuer(ca.get_subject())
-        cert.set_pubkey(k)
-        serial = int(time())
-        cert.set_serial_number(serial)
-        cert.sign(ca_key, 'sha1')
-
-        final_cert = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
-        final_key = crypto.dump_privatekey(crypto.FILETYPE_PEM, k)
-        deliver_ssl_file(ca_file, config['CONFIG_SSL_CACERT'], host)
-        deliver_ssl_file(final_cert, ssl_cert_file, host)
-        deliver_ssl_file(final_key, ssl_key_file, host)
-
-        with open(local_cert_path, 'w') as f:
-            f.write(final_cert)
-
-
-def deliver_ssl_file(content, path, host):
-    server = utils.ScriptRunner(host)
-    server.append("grep -- '{content}' {path} || "
-                  "echo '{content}' > {path} ".format(
-                      content=content,
-                      path=path))
-    server.execute()
+    if isinstance(hosts, types.StringTypes):
+        hosts = [hosts]
+    deliver_files(dict((host, {path: content}) for host in hosts))
 
 
 def gethostlist(CONF):
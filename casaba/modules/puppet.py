@@ -27,7 +27,7 @@ re_error = re.compile(
     'err:|Syntax error at|^Duplicate definition:|^Invalid tag|'
     '^No matching value for selector param|^Parameter name failed:|Error:|'
     '^Invalid parameter|^Duplicate declaration:|^Could not find resource|'
-    '^Could not parse for|^/usr/bin/puppet:\d+: .+|.+\(LoadError\)|'
+    '^Could not parse for|^/usr/bin/puppet:\d+: .+|.\(LoadError\)|'
     '^Could not autoload|'
     '^\/usr\/bin\/env\: jruby\: No such file or directory|'
     'failed to execute puppet'
@@ -65,46 +65,95 @@ surrogates = [
 ]
 
 
-def validate_logfile(logpath):
+# precompiled surrogates
+_surrogates = [(re.compile(regex), surrogate)
+               for regex, surrogate in surrogates]
+# prefilters matching superset of lines matched by re_error and re_notice,
+# anchored alternatives are tried only at the start of the line, so most
+# of the lines are rejected by two cheap searches
+_alternatives = re_error.pattern.split('|')
+re_inspect_start = re.compile('|'.join(i[1:] for i in _alternatives
+                                       if i.startswith('^')))
+re_inspect = re.compile('|'.join([i for i in _alternatives
+                                  if not i.startswith('^')] +
+                                 [r'Notify\[casaba_info\]']))
+
+
+class LogAnalyzer(object):
     """
-    Check given Puppet log file for errors and raise PuppetError if there is
-    any error
+    Checks Puppet output for errors and collects casaba_info notices
+    in single pass. Output can be fed line by line while Puppet is still
+    running and PuppetError is raised as soon as the first error appears.
     """
-    manifestpath = os.path.splitext(logpath)[0]
-    manifestfile = os.path.basename(manifestpath)
-    with open(logpath) as logfile:
-        for line in logfile:
-            line = line.strip()
+    def __init__(self, name, logpath=None, validate=True):
+        # name of the applied manifest
+        self.name = name
+        # path to full log referenced in error message
+        self.logpath = logpath
+        # if False errors are not raised
+        self.validate = validate
+        self.messages = []
 
-            if re_error.search(line) is None:
-                continue
+    def feed(self, line):
+        """
+        Analyzes single line of Puppet output.
+        """
+        line = line.strip()
+        if (re_inspect_start.match(line) is None and
+                re_inspect.search(line) is None):
+            return
+
+        match = re_notice.search(line)
+        if match:
+            self.messages.append(match.group('message'))
+
+        if not self.validate or re_error.search(line) is None:
+            return
+
+        error = re_color.sub('', line)  # remove colors
+        if re_ignore.search(line):
+            msg = ('Ignoring expected error during Puppet run %s: %s' %
+                   (self.name, error))
+            logger.debug(msg)
+            return
 
-            error = re_color.sub('', line)  # remove colors
-            if re_ignore.search(line):
-                msg = ('Ignoring expected error during Puppet run %s: %s' %
-                       (manifestfile, error))
-                logger.debug(msg)
+        for regex, surrogate in _surrogates:
+            match = regex.search(error)
+            if match is None:
                 continue
 
-            for regex, surrogate in surrogates:
-                match = re.search(regex, error)
-                if match is None:
-                    continue
+            args = dict(('arg%d' % num, group) for num, group
+                        in enumerate(match.groups(), 1))
+            error = surrogate % args
 
-                args = {}
-                num = 1
-                while True:
-                    try:
-                        args['arg%d' % num] = match.group(num)
-                        num += 1
-                    except IndexError:
-                        break
-                error = surrogate % args
+        message = ('Error appeared during Puppet run: %s\n%s\n'
+                   'You will find full trace in log %s' %
+                   (self.name, error, self.logpath or 'on the node'))
+        raise PuppetError(message)
 
-            message = ('Error appeared during Puppet run: %s\n%s\n'
-                       'You will find full trace in log %s' %
-                       (manifestfile, error, logpath))
-            raise PuppetError(message)
+    def feed_file(self, logpath):
+        """
+        Analyzes all lines of given log file.
+        """
+        with open(logpath) as logfile:
+            for line in logfile:
+                self.feed(line)
+
+
+def _analyze_logfile(logpath, validate):
+    manifestpath = os.path.splitext(logpath)[0]
+    analyzer = LogAnalyzer(os.path.basename(manifestpath), logpath=logpath,
+                           validate=validate)
+    analyzer.feed_file(logpath)
+    return analyzer
+
+
+def validate_logfile(logpath):
+    """
+    Check given Puppet log file for errors and raise PuppetError if there is
+    any error
+    """
+    _analyze_logfile(logpath, validate=True)
 
 
 def scan_logfile(logpath):
@@ -112,10 +161,4 @@ def scan_logfile(logpath):
     Returns list of casaba_info/casaba_warn notices parsed from
     given puppet log file.
     """
-    output = []
-    with open(logpath) as logfile:
-        for line in logfile:
-            match = re_notice.search(line)
-            if match:
-                output.append(match.group('message'))
-    return output
+    return _analyze_logfile(logpath, validate=False).messages
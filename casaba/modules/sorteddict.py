@@ -30,3 +30,6 @@ class UnsortableOrderedDict(OrderedDict):
 class IndentDumper(yaml.Dumper):
     def increase_indent(self, flow=False, indentless=False):
         return super(IndentDumper, self).increase_indent(flow, False)
+
+    def ignore_aliases(self, data):
+        return True
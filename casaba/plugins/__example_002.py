@@ -78,7 +78,7 @@ def initConfig(controller):
          "CONDITION": False},
 
     ]
-    update_params_usage(basedefs.CASABA_DOC, params, sectioned=False)
+    update_params_usage(basedefs.runtime.CASABA_DOC, params, sectioned=False)
     group = {"GROUP_NAME": "xxxx",
              "DESCRIPTION": "Polex xxxx Config parameters",
              "PRE_CONDITION": False,
@@ -92,7 +92,12 @@ def initSequences(controller):
 
     steps = [
         {'title': 'Preparing Xxx entries',
-         'functions': [create_hieradata]}
+         'functions': [create_hieradata],
+         # declared dependencies allow running the step concurrently
+         # with steps which don't touch the same resources
+         'requires': ['CONFIG_XXX', 'CONFIG_ENVIRONMENT',
+                      'CONFIG_DOMAIN_NAME'],
+         'provides': ['hiera:xxx.yaml']}
     ]
     controller.addSequence("Configuring Xxx", [], [], steps)
 
@@ -136,7 +136,7 @@ def initConfig(controller):
          "NEED_CONFIRM": False,
          "CONDITION": False},
     ]
-    update_params_usage(basedefs.casaba_DOC, params, sectioned=False)
+    update_params_usage(basedefs.runtime.CASABA_DOC, params, sectioned=False)
     group = {"GROUP_NAME": "API",
              "DESCRIPTION": "OpenStack API Node Config parameters",
              "PRE_CONDITION": False,
@@ -150,7 +150,17 @@ def initSequences(controller):
 
     steps = [
         {'title': 'Preparing API entries',
-         'functions': [create_hieradata]}
+         'functions': [create_hieradata],
+         'requires': ['CONFIG_CONTROLLER_HOST', 'CONFIG_ENABLE_INSTALL_API',
+                      'CONFIG_CLUSTER_MEMBERS', 'CONFIG_MONITOR_HOST',
+                      'CONFIG_ENABLE_VPN_AGENT', 'CONFIG_ENABLE_FWAAS_AGENT',
+                      'CONFIG_ENABLE_LBAAS_AGENT', 'CONFIG_HORIZON_INSTALL',
+                      'CONFIG_AODH_INSTALL', 'CONFIG_CEILOMETER_INSTALL',
+                      'CONFIG_CINDER_INSTALL', 'CONFIG_GLANCE_INSTALL',
+                      'CONFIG_GNOCCHI_INSTALL', 'CONFIG_HEAT_INSTALL',
+                      'CONFIG_NEUTRON_INSTALL', 'CONFIG_NOVA_INSTALL',
+                      'CONFIG_SWIFT_INSTALL', 'CONFIG_TROVE_INSTALL'],
+         'provides': ['API_GLOBAL_OPTIONS', 'CONFIG_MEMCACHE_SERVERS']}
     ]
     controller.addSequence("Configuring API", [], [], steps)
 
@@ -26,8 +26,10 @@ from casaba.installer import processors
 from casaba.installer import utils
 from casaba.installer import validators
 
+from casaba.modules.common import filtered_hosts
 from casaba.modules.common import is_all_in_one
 from casaba.modules.documentation import update_params_usage
+from casaba.modules.facter import discover_hosts
 
 # ------------- Prescript Casaba Plugin Initialization --------------
 
@@ -522,7 +524,7 @@ def initConfig(controller):
              "CONDITION": False},
         ],
     }
-    update_params_usage(basedefs.CASABA_DOC, params)
+    update_params_usage(basedefs.runtime.CASABA_DOC, params)
 
     groups = [
         {"GROUP_NAME": "GLOBAL",
@@ -542,9 +544,12 @@ def initConfig(controller):
 def initSequences(controller):
     prescript_steps = [
         {'title': 'Preparing Global Parameters Settings',
-         'functions': [deploy_prep]},
+         'functions': [deploy_prep],
+         'resumable': True},
         {'title': 'Preparing Operating System settings',
-         'functions': [preinstall_and_discover]},
+         'functions': [preinstall_and_discover],
+         'resumable': True,
+         'verify': verify_preinstall},
     ]
 
     controller.addSequence("Running pre configuration scripts", [], [],
@@ -591,7 +596,14 @@ def preinstall_and_discover(config, messages):
     if config['CONFIG_REPO']:
         manage_polex_repo(config)
 
-    server = utils.ScriptRunner()
+    # refresh yum metadata on nodes while packages are installed locally,
+    # installer host itself is left out, so that local installation
+    # does not wait for yum lock
+    hosts = filtered_hosts(config)
+    local = utils.local_addresses()
+    utils.package_manager.warm_cache([i for i in hosts if i not in local],
+                                     background=True)
+
     # Step 2 install Puppet and it's dependencies
     if config['CONFIG_REPO']:
 
@@ -599,48 +611,52 @@ def preinstall_and_discover(config, messages):
             deps = list(basedefs.PUPPET_DEPENDENCIES) + list(basedefs.PUPPET_MODULES_DEPS) + list(basedefs.DEVELOP_DEPS)
         else:
             deps = list(basedefs.PUPPET_DEPENDENCIES)
-
-        packages = ' '.join(deps)
-        server.append('timeout 60 yum install -y %s' % packages)
-        # yum does not fail if one of the packages is missing
-        for package in deps:
-            server.append('rpm -q --whatprovides %s' % package)
-        server.execute()
-        server.clear()
-
-    server.append('mkdir -p %s' % basedefs.CASABA_VAR_DIR)
+        utils.package_manager.require(None, deps)
+    utils.package_manager.require(None, ['yum-utils'])
+    # all packages required on installer host are installed in single
+    # yum transaction
+    utils.package_manager.ensure([None], timeout=60)
+    # Facter is installed as Puppet dependency, nodes are checked by single
+    # rpm query each
+    utils.package_manager.require(hosts, basedefs.PUPPET_DEPENDENCIES)
+    utils.package_manager.ensure(hosts)
+
+    prepare = ['mkdir -p %s' % basedefs.CASABA_VAR_DIR]
     # Separately create the tmp directory for this packstack run, this will
     # fail if the directory already exists
     host_dir = os.path.join(basedefs.CASABA_VAR_DIR, uuid.uuid4().hex)
-    server.append('mkdir --mode 0700 %s' % host_dir)
+    prepare.append('mkdir --mode 0700 %s' % host_dir)
     for i in ('modules', 'resources'):
-        server.append('mkdir --mode 0700 %s' % os.path.join(host_dir, i))
-    server.execute()
-    details['tmpdir'] = host_dir
-
-    # discover other host info; Facter is installed as Puppet dependency,
-    # so we let it do the work
-    server.clear()
-    server.append('facter -p')
-    rc, stdout = server.execute()
-    for line in stdout.split('\n'):
-        try:
-            key, value = line.split('=>', 1)
-        except ValueError:
-            # this line is probably some warning, so let's skip it
-            continue
-        else:
-            details[key.strip()] = value.strip()
-    server.clear()
+        prepare.append('mkdir --mode 0700 %s' % os.path.join(host_dir, i))
+
+    # discover other host info on all hosts at once
+    for host, facts in discover_hosts(hosts, prepare=prepare).iteritems():
+        details[host] = dict(facts, tmpdir=host_dir)
     config['HOST_DETAILS'] = details
 
 
-def deploy_prep(config, messages):
-
+def verify_preinstall(config):
+    """
+    Returns True if temporary directories and Puppet created on hosts
+    by journaled run of preinstall_and_discover are still in place,
+    so that the step can be skipped when resuming.
+    """
+    details = config.get('HOST_DETAILS') or {}
+    hosts = filtered_hosts(config)
+    tmpdirs = set(details.get(host, {}).get('tmpdir') for host in hosts)
+    if None in tmpdirs or len(tmpdirs) != 1:
+        return False
+    host_dir = tmpdirs.pop()
     server = utils.ScriptRunner()
-    server.append('rpm -q --whatprovides yum-utils || '
-                  'yum install -y yum-utils')
-    server.execute()
+    for i in ('modules', 'resources'):
+        server.append('test -d %s' % os.path.join(host_dir, i))
+    server.append('rpm -q --whatprovides %s'
+                  % ' '.join(basedefs.PUPPET_DEPENDENCIES))
+    output = server.execute_on(hosts, can_fail=False, log=False)
+    return all(rc == 0 for rc, out, err in output.itervalues())
+
+
+def deploy_prep(config, messages):
 
     # generateHieraDataDir(config['CONFIG_ENVIRONMENT'], config['CONFIG_DOMAIN_NAME'])
 
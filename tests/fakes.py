@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stand-ins for remote nodes used by tests
+"""
+
+import os
+
+from casaba.installer import utils
+from casaba.installer.utils import shell
+from casaba.installer.utils.ssh import SshConnectionPool
+
+
+class LocalSshPool(SshConnectionPool):
+    """
+    Connection pool running "remote" commands on local host, so that
+    code working with nodes can be tested without ssh. Remote paths are
+    local paths.
+    """
+    def __init__(self):
+        super(LocalSshPool, self).__init__()
+        # hosts for which a command has been built
+        self.hosts = []
+        # hosts for which master connection has been requested
+        self.opened = []
+
+    def open(self, host):
+        # there is no master connection, request is only recorded
+        self.opened.append(host)
+        return False
+
+    def ssh_command(self, host, *command):
+        self.hosts.append(host)
+        return ['bash', '-c', ' '.join(command) or 'bash']
+
+    def scp_command(self, host, *paths):
+        self.hosts.append(host)
+        return ['cp'] + list(paths)
+
+    def remote(self, host, path):
+        return path
+
+
+def patch(test, obj, attr, value):
+    """
+    Sets attribute of given object for the duration of given test.
+    """
+    original = getattr(obj, attr)
+    setattr(obj, attr, value)
+    test.addCleanup(setattr, obj, attr, original)
+
+
+def setenv(test, name, value):
+    """
+    Sets environment variable for the duration of given test. Unlike
+    patching of os.environ it is seen by all started processes.
+    """
+    original = os.environ.get(name)
+    os.environ[name] = value
+    if original is None:
+        test.addCleanup(os.environ.pop, name)
+    else:
+        test.addCleanup(os.environ.__setitem__, name, original)
+
+
+def use_ssh_pool(test, pool):
+    """
+    Makes installer use given connection pool in given test.
+    """
+    patch(test, utils, 'ssh_pool', pool)
+    patch(test, shell, 'ssh_pool', pool)
+
+
+def add_executable(directory, name, script):
+    """
+    Creates shell script with given name and content in given directory.
+    """
+    path = os.path.join(directory, name)
+    with open(path, 'w') as fp:
+        fp.write('#!/bin/bash\n%s\n' % script)
+    os.chmod(path, 0o755)
+    return path
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from casaba.installer import basedefs
+from casaba.installer.basedefs import RuntimePaths
+
+
+class RuntimePathsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.base_dir = os.path.join(self.tmpdir, 'casaba')
+        self.runtime = RuntimePaths(base_dir=self.base_dir)
+
+    def test_paths_are_resolved_on_first_access(self):
+        runtime = self.runtime
+        self.assertFalse(runtime.resolved('VAR_DIR'))
+        self.assertFalse(os.path.exists(self.base_dir))
+        # paths not creating directories don't resolve the others
+        self.assertEqual(runtime.PLUGIN_INDEX_FILE,
+                         os.path.join(self.base_dir, 'plugin-index.json'))
+        self.assertFalse(runtime.resolved('VAR_DIR'))
+
+        var_dir = runtime.VAR_DIR
+        self.assertTrue(runtime.resolved('VAR_DIR'))
+        self.assertTrue(runtime.resolved('CASABA_VAR_DIR'))
+        self.assertEqual(stat.S_IMODE(os.stat(self.base_dir).st_mode), 0o700)
+        self.assertEqual(os.path.dirname(var_dir), self.base_dir)
+        self.assertEqual(os.readlink(os.path.join(self.base_dir, 'latest')),
+                         os.path.basename(var_dir))
+        self.assertEqual(runtime.DIR_LOG, var_dir)
+        self.assertEqual(runtime.PUPPET_MANIFEST_DIR,
+                         os.path.join(var_dir, 'manifests'))
+
+    def test_path_is_resolved_only_once(self):
+        results = []
+
+        def resolve():
+            results.append(self.runtime.VAR_DIR)
+
+        threads = [threading.Thread(target=resolve) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(sorted(os.listdir(self.base_dir)),
+                         sorted(['latest', os.path.basename(results[0])]))
+
+    def test_existing_base_dir(self):
+        os.mkdir(self.base_dir)
+        self.assertEqual(self.runtime.CASABA_VAR_DIR, self.base_dir)
+
+    def test_module_has_no_former_constants(self):
+        for name in ('VAR_DIR', 'DIR_LOG', 'PUPPET_MANIFEST_DIR',
+                     'CASABA_DOC'):
+            self.assertFalse(hasattr(basedefs, name))
+        self.assertTrue(isinstance(basedefs.runtime, RuntimePaths))
+
+
+if __name__ == '__main__':
+    unittest.main()
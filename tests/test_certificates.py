@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from . import fakes
+
+try:
+    from casaba.modules import certificates
+except ImportError:
+    # pyOpenSSL is not installed
+    certificates = None
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+@unittest.skipIf(certificates is None, 'pyOpenSSL is not available')
+class DeliverFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='casaba-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        fakes.use_ssh_pool(self, fakes.LocalSshPool())
+        self.addCleanup(os.umask, os.umask(0o022))
+
+    def _path(self, name, content=None, mode=None):
+        path = os.path.join(self.tmpdir, name)
+        if content is not None:
+            with open(path, 'w') as fp:
+                fp.write(content)
+            os.chmod(path, mode)
+        return path
+
+    def test_new_files_get_default_mode(self):
+        path = self._path('cert.pem')
+        certificates.deliver_files({'node1': {path: 'CERT\n'}})
+        with open(path) as fp:
+            self.assertEqual(fp.read(), 'CERT\n')
+        self.assertEqual(_mode(path), 0o644)
+
+    def test_replaced_files_keep_mode(self):
+        key = self._path('key.pem', 'OLD\n', 0o640)
+        stale = self._path('key.pem.tmp', 'STALE\n', 0o666)
+        certificates.deliver_files({'node1': {key: 'NEW\n'}})
+        with open(key) as fp:
+            self.assertEqual(fp.read(), 'NEW\n')
+        self.assertEqual(_mode(key), 0o640)
+        self.assertFalse(os.path.exists(stale))
+
+    def test_unchanged_files_are_not_touched(self):
+        path = self._path('ca.pem', 'CA\n', 0o600)
+        os.utime(path, (1000, 1000))
+        certificates.deliver_files({'node1': {path: 'CA\n'}})
+        self.assertEqual(os.stat(path).st_mtime, 1000)
+        self.assertEqual(os.listdir(self.tmpdir), ['ca.pem'])
+
+    def test_failed_hosts_are_reported(self):
+        path = os.path.join(self.tmpdir, 'missing', 'cert.pem')
+        with self.assertRaises(certificates.MultiHostError) as ctx:
+            certificates.deliver_files({'node1': {path: 'CERT\n'},
+                                        'node2': {path: 'CERT\n'}})
+        self.assertEqual(sorted(ctx.exception.errors), ['node1', 'node2'])
+
+
+@unittest.skipIf(certificates is None, 'pyOpenSSL is not available')
+class CertificateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='casaba-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_store(self):
+        store = certificates.CertificateStore(
+            os.path.join(self.tmpdir, 'store'))
+        key = store.key('node1', 'ssl/nova', {'CN': 'nova'})
+        self.assertIsNone(store.get(key))
+        self.assertFalse(store.issued('node1', 'ssl/nova'))
+        store.put(key, 'KEY', 'CERT')
+        self.assertEqual(store.get(key), ('KEY', 'CERT'))
+        self.assertTrue(store.issued('node1', 'ssl/nova'))
+        self.assertFalse(store.issued('node2', 'ssl/nova'))
+        self.assertEqual(_mode(os.path.join(store.directory,
+                                            key + '.json')), 0o600)
+        self.assertNotEqual(store.key('node1', 'ssl/nova', {'CN': 'x'}), key)
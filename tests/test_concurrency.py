@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from casaba.installer.utils import concurrency
+
+from . import fakes
+
+
+class ParallelMapTest(unittest.TestCase):
+    def test_results_keep_order_of_items(self):
+        def square(item):
+            # later items finish first
+            time.sleep((5 - item) * 0.01)
+            return item * item
+
+        results = concurrency.parallel_map(square, range(5), workers=5)
+        self.assertEqual(results, [(i * i, None) for i in range(5)])
+
+    def test_failure_does_not_stop_other_items(self):
+        def check(item):
+            if item % 2:
+                raise ValueError('odd %d' % item)
+            return item
+
+        results = concurrency.parallel_map(check, range(4), workers=2)
+        self.assertEqual([r for r, e in results], [0, None, 2, None])
+        self.assertEqual([e and str(e[1]) for r, e in results],
+                         [None, 'odd 1', None, 'odd 3'])
+        self.assertIs(results[1][1][0], ValueError)
+
+    def test_number_of_threads_is_bounded(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def work(item):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+
+        concurrency.parallel_map(work, range(12), workers=3)
+        self.assertEqual(state['peak'], 3)
+
+    def test_default_workers(self):
+        fakes.patch(self, concurrency, 'default_workers', 16)
+        concurrency.set_default_workers('1')
+        self.assertEqual(concurrency.default_workers, 1)
+        threads = set()
+        concurrency.parallel_map(
+            lambda item: threads.add(threading.current_thread()), range(3))
+        self.assertEqual(threads, set([threading.current_thread()]))
+        self.assertRaises(ValueError, concurrency.set_default_workers, 0)
+
+    def test_no_items(self):
+        self.assertEqual(concurrency.parallel_map(len, []), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
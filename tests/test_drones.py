@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from casaba.installer import utils
+from casaba.installer.core import drones
+from casaba.installer.core import transfer
+from casaba.installer.core.journal import Journal
+from casaba.installer.exceptions import MultiHostError
+
+from . import fakes
+
+
+# prints the applied manifest as its output, slow manifests take a while
+PUPPET = '''grep -q SLOW "${@: -1}" && sleep 3
+cat "${@: -1}"'''
+
+MANIFEST = ("notice: /Stage[main]/Main/Notify[casaba_info]/message: "
+            "defined 'message' as 'hello'\n"
+            "Notice: Applied catalog\n")
+
+
+class Observer(drones.DroneObserver):
+    def __init__(self):
+        self.calls = []
+
+    def applying(self, drone, recipe):
+        self.calls.append(('applying', os.path.basename(recipe)))
+
+    def checking(self, drone, recipe):
+        pass
+
+    def finished(self, drone, recipe):
+        self.calls.append(('finished', os.path.basename(recipe)))
+
+    def output(self, drone, recipe, line):
+        self.calls.append(('output', line))
+
+
+class PipeDrone(drones.Drone):
+    """
+    Drone applying recipes nowhere, recipe is finished when something
+    is written to its pipe.
+    """
+    # waiting must not depend on polling
+    poll_interval = 60
+
+    def __init__(self, *args, **kwargs):
+        super(PipeDrone, self).__init__(*args, **kwargs)
+        self.pipes = {}
+
+    def _apply(self, recipe):
+        self.pipes[recipe] = os.pipe()
+
+    def finish(self, recipe, delay):
+        """
+        Finishes recipe with given name after delay seconds.
+        """
+        recipe = os.path.join(self.recipe_dir, recipe)
+        timer = threading.Timer(delay, os.write,
+                                args=(self.pipes[recipe][1], 'x'))
+        timer.start()
+        return timer
+
+    def _poll_finished(self, recipes):
+        finished, fds = [], []
+        for recipe in recipes:
+            fd = self.pipes[recipe][0]
+            if utils.wait_readable([fd], 0):
+                finished.append(recipe)
+            else:
+                fds.append(fd)
+        return finished, fds
+
+    def close(self):
+        for pipe in self.pipes.values():
+            for fd in pipe:
+                os.close(fd)
+
+
+class DroneWaitTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='casaba-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.recipe = os.path.join(self.tmpdir, 'test.pp')
+        with open(self.recipe, 'w') as fp:
+            fp.write('notice("test")\n')
+
+    def _drone(self, node):
+        drone = PipeDrone(node, local_tmpdir=self.tmpdir)
+        drone.add_recipe(self.recipe, marker='test')
+        self.addCleanup(drone.close)
+        return drone
+
+    def test_drone_wakes_up_when_recipe_finishes(self):
+        drone = self._drone('node1')
+        drone.start()
+        timer = drone.finish('test.pp', 0.2)
+        started = time.time()
+        drone._wait()
+        timer.join()
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(drone._applied,
+                         set([os.path.join(drone.recipe_dir, 'test.pp')]))
+
+    def test_fleet_waits_for_all_nodes(self):
+        fleet = drones.DroneFleet()
+        for node in ('node1', 'node2', 'node3'):
+            fleet.add_drone(self._drone(node))
+        timers = []
+        run = fleet._run
+
+        def finishing_run(method, *args, **kwargs):
+            run(method, *args, **kwargs)
+            if method == 'start':
+                # recipes finish at different times while fleet waits
+                for idx, drone in enumerate(fleet.drones):
+                    timers.append(drone.finish('test.pp', 0.1 * (idx + 1)))
+
+        fleet._run = finishing_run
+        started = time.time()
+        fleet.apply()
+        for timer in timers:
+            timer.join()
+        self.assertTrue(time.time() - started < 5)
+        for drone in fleet.drones:
+            self.assertEqual(len(drone._applied), 1)
+            self.assertFalse(drone._running)
+
+
+class LogStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='casaba-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        fakes.use_ssh_pool(self, fakes.LocalSshPool())
+
+    def _read_all(self, stream):
+        frames = []
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            received = stream.read(1)
+            if received is None:
+                break
+            frames.extend(received)
+        stream.close()
+        return frames
+
+    def test_running_and_finished_recipes(self):
+        finished = os.path.join(self.tmpdir, 'finished.pp')
+        with open(finished + '.finished', 'w') as fp:
+            fp.write('one\ntwo\nthree with  spaces\n')
+        running = os.path.join(self.tmpdir, 'running.pp')
+        open(running + '.running', 'w').close()
+        # the run is started in background same as by CasabaDrone._apply
+        subprocess.check_call(
+            ['bash', '-c', '( for i in 1 2 3; do echo "line $i" >> '
+             '%(recipe)s.running; sleep 0.1; done; mv %(recipe)s.running '
+             '%(recipe)s.finished ) > /dev/null 2>&1 < /dev/null & '
+             'echo $! > %(recipe)s.pid' % {'recipe': running}])
+
+        # the first line of finished recipe has been already received
+        stream = drones._LogStream('node1', [finished, running],
+                                   {finished: 1})
+        frames = self._read_all(stream)
+        self.assertEqual([i for i in frames if i[0] == finished],
+                         [(finished, 'two'),
+                          (finished, 'three with  spaces'),
+                          (finished, None)])
+        self.assertEqual([i for i in frames if i[0] == running],
+                         [(running, 'line 1'), (running, 'line 2'),
+                          (running, 'line 3'), (running, None)])
+
+    def test_frames_split_across_reads(self):
+        stream = drones._LogStream.__new__(drones._LogStream)
+        stream.recipes = ['a.pp', 'b.pp']
+        stream._buffer = ''
+        stream.proc = subprocess.Popen(
+            ['bash', '-c', 'printf "L 0 hel"; sleep 0.2; '
+             'printf "lo world\\nL 1\\ngarbage\\nL 7 x\\nF 0\\n"'],
+            stdout=subprocess.PIPE)
+        self.assertEqual(self._read_all(stream),
+                         [('a.pp', 'hello world'), ('b.pp', ''),
+                          ('a.pp', None)])
+
+
+class CasabaDroneTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='casaba-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(transfer.pack_cache.clear)
+        fakes.use_ssh_pool(self, fakes.LocalSshPool())
+
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        fakes.add_executable(bindir, 'puppet', PUPPET)
+        fakes.patch(self, os, 'environ', dict(os.environ))
+        os.environ['PATH'] = '%s:%s' % (bindir, os.environ['PATH'])
+
+    def _drone(self, name='node1'):
+        local = os.path.join(self.tmpdir, 'local', name)
+        os.makedirs(local)
+        drone = drones.CasabaDrone(name, local_tmpdir=local)
+        # node directories are placed to test directory
+        node = os.path.join(self.tmpdir, name)
+        drone.resource_dir = os.path.join(node, 'drone')
+        drone.recipe_dir = os.path.join(drone.resource_dir, 'manifests')
+        drone.remote_tmpdir = os.path.join(drone.resource_dir, 'temp')
+        drone.module_dir = os.path.join(drone.resource_dir, 'modules')
+        drone.fact_dir = os.path.join(drone.resource_dir, 'facts')
+        drone.cache_dir = os.path.join(node, 'cache')
+        drone.poll_interval = 0.1
+        drones.Drone.init_node(drone)
+        return drone
+
+    def _source(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def test_transfer_and_log_streaming(self):
+        drone = self._drone()
+        self.assertTrue(drone.transfer_streaming)
+        self.assertTrue(drone.cache_dir)
+        module = os.path.dirname(self._source('src/mymodule/init.pp',
+                                              'class mymodule {}\n'))
+        drone.add_resource(module, 'module')
+        drone.add_recipe(self._source('recipes/node1_test.pp', MANIFEST))
+        observer = Observer()
+        drone.set_observer(observer)
+
+        drone.prepare_node()
+        with open(os.path.join(drone.module_dir, 'mymodule',
+                               'init.pp')) as fp:
+            self.assertEqual(fp.read(), 'class mymodule {}\n')
+        with open(os.path.join(drone.recipe_dir, 'node1_test.pp')) as fp:
+            self.assertEqual(fp.read(), MANIFEST)
+
+        drone.apply()
+        log = drone._recipe_log(os.path.join(drone.recipe_dir,
+                                             'node1_test.pp'))
+        with open(log) as fp:
+            self.assertEqual(fp.read(), MANIFEST)
+        self.assertEqual(drone.messages, ['hello'])
+        self.assertEqual(observer.calls, [
+            ('applying', 'node1_test.pp'),
+            ('output', MANIFEST.splitlines()[0]),
+            ('output', MANIFEST.splitlines()[1]),
+            ('finished', 'node1_test.pp'),
+        ])
+        self.assertIsNone(drone._log_stream)
+
+    def test_unchanged_resources_are_not_sent_again(self):
+        drone = self._drone()
+        module = os.path.dirname(self._source('src/mymodule/init.pp',
+                                              'class mymodule {}\n'))
+        drone.add_resource(module, 'module')
+        drone.prepare_node()
+        stamp = os.path.join(drone.cache_dir, 'DIGEST')
+        os.utime(stamp, (1000, 1000))
+
+        shutil.rmtree(drone.module_dir)
+        drone.prepare_node()
+        self.assertEqual(os.stat(stamp).st_mtime, 1000)
+        self.assertTrue(os.path.exists(
+            os.path.join(drone.module_dir, 'mymodule', 'init.pp')))
+
+    def test_codec_selection(self):
+        drone = self._drone()
+        for codec in ('none', 'gzip'):
+            drone.transfer_codec = codec
+            self.assertEqual(drone._codec(), codec)
+        drone.transfer_codec = None
+        self.assertEqual(drone._codec(), 'none')
+        drone.transfer_codec = 'zstd'
+        fakes.patch(self, drones, 'find_executable',
+                    lambda name: os.path.join('/usr/bin', name))
+        self.assertEqual(drone._codec(), 'zstd')
+        # zstd falls back to gzip if it is not installed
+        fakes.patch(self, drones, 'find_executable', lambda name: None)
+        self.assertEqual(drone._codec(), 'gzip')
+        drone.transfer_codec = 'lz4'
+        self.assertRaises(ValueError, drone._codec)
+
+    def test_streamed_delivery(self):
+        drone = self._drone()
+        codecs = ['none', 'gzip']
+        if drones.find_executable('zstd'):
+            codecs.append('zstd')
+        for codec in codecs:
+            drone.transfer_codec = codec
+            dest = os.path.join(drone.remote_tmpdir, codec)
+
+            def add_members(pack):
+                drones._add_string(pack, 'sub/hello.txt', codec)
+
+            drone._deliver(None, add_members, dest)
+            with open(os.path.join(dest, 'sub', 'hello.txt')) as fp:
+                self.assertEqual(fp.read(), codec)
+        # nothing is packed to local files
+        self.assertEqual(os.listdir(drone.local_tmpdir), [])
+
+    def test_copied_delivery(self):
+        drone = self._drone()
+        drone.transfer_streaming = False
+        dest = os.path.join(drone.remote_tmpdir, 'copied')
+        os.mkdir(dest)
+        drone._deliver(None, lambda pack: drones._add_string(
+            pack, 'hello.txt', 'hello'), dest)
+        with open(os.path.join(dest, 'hello.txt')) as fp:
+            self.assertEqual(fp.read(), 'hello')
+
+    def test_stream_failure(self):
+        drone = self._drone()
+        try:
+            drone._stream('cat > /dev/null; echo broken >&2; exit 3',
+                          lambda pack: drones._add_string(pack, 'a', 'a'))
+        except RuntimeError as ex:
+            self.assertIn('Failed to copy resources to node node1', str(ex))
+            self.assertIn('broken', str(ex))
+        else:
+            self.fail('RuntimeError not raised')
+        # remote side does not have to read whole tarball before failing
+        self.assertRaises(RuntimeError, drone._stream, 'exit 1',
+                          lambda pack: drones._add_string(
+                              pack, 'a', 'a' * 1024 * 1024))
+
+    def _check_shared_packs(self, cache):
+        module = os.path.dirname(self._source('src/mymodule/init.pp',
+                                              'class mymodule {}\n'))
+        packed = []
+        pack = transfer.pack
+
+        def recording_pack(sink, add_members, codec):
+            packed.append(add_members.__name__)
+            return pack(sink, add_members, codec)
+
+        fakes.patch(self, transfer, 'pack', recording_pack)
+        fleet = drones.DroneFleet()
+        for name in ('node1', 'node2', 'node3'):
+            drone = self._drone(name)
+            drone.share_packs = True
+            if not cache:
+                drone.cache_dir = None
+            drone.add_resource(module, 'module')
+            fleet.add_drone(drone)
+        fleet.prepare_nodes()
+        for drone in fleet.drones:
+            self.assertTrue(os.path.exists(
+                os.path.join(drone.module_dir, 'mymodule', 'init.pp')))
+        # recipes are specific for every node, so they are never shared
+        self.assertEqual(packed.count('_add_recipes'), 3)
+        return [i for i in packed if i != '_add_recipes']
+
+    def test_shared_resources_are_packed_once(self):
+        self.assertEqual(self._check_shared_packs(cache=False),
+                         ['_add_resources'])
+
+    def test_shared_delta_is_packed_once(self):
+        # nodes with the same cache content get the same delta
+        self.assertEqual(self._check_shared_packs(cache=True),
+                         ['add_members'])
+
+    def _check_delta(self, streaming):
+        module = os.path.join(self.tmpdir, 'src', 'mymodule')
+        self._source('src/mymodule/a.pp', 'class a {}\n')
+        self._source('src/mymodule/b.pp', 'class b {}\n')
+        drone = self._drone()
+        drone.transfer_streaming = streaming
+        drone.add_resource(module, 'module')
+        drone.prepare_node()
+
+        self._source('src/mymodule/a.pp', 'class a { include c }\n')
+        self._source('src/mymodule/c.pp', 'class c {}\n')
+        os.unlink(os.path.join(module, 'b.pp'))
+        # next run uses new resource directory, but the same node cache
+        shutil.rmtree(drone.local_tmpdir)
+        shutil.rmtree(drone.resource_dir)
+        drone = self._drone()
+        drone.transfer_streaming = streaming
+        drone.add_resource(module, 'module')
+        deltas = []
+        add_delta = drone._add_delta
+
+        def recording_add_delta(pack, manifest, text, changed, removed):
+            deltas.append((changed, removed))
+            add_delta(pack, manifest, text, changed, removed)
+
+        drone._add_delta = recording_add_delta
+        drone.prepare_node()
+        self.assertEqual(deltas, [(['modules/mymodule/a.pp',
+                                    'modules/mymodule/c.pp'],
+                                   ['modules/mymodule/b.pp'])])
+        installed = os.path.join(drone.module_dir, 'mymodule')
+        cached = os.path.join(drone.cache_dir, 'tree', 'modules',
+                              'mymodule')
+        for path in (installed, cached):
+            self.assertEqual(sorted(os.listdir(path)), ['a.pp', 'c.pp'])
+            with open(os.path.join(path, 'a.pp')) as fp:
+                self.assertEqual(fp.read(), 'class a { include c }\n')
+        # resources are hard links to the cache
+        self.assertEqual(os.stat(os.path.join(installed, 'c.pp')).st_ino,
+                         os.stat(os.path.join(cached, 'c.pp')).st_ino)
+        with open(os.path.join(drone.cache_dir, 'DIGEST')) as fp:
+            self.assertEqual(fp.read().strip(), drone._resource_digest)
+        # delta tarball is removed from node
+        self.assertEqual([i for i in os.listdir(drone.remote_tmpdir)
+                          if i.startswith('delta-')], [])
+
+    def test_changed_resources_are_sent_as_delta(self):
+        self._check_delta(streaming=True)
+
+    def test_changed_resources_are_copied_as_delta(self):
+        self._check_delta(streaming=False)
+
+    def test_fleet_bundle_fills_node_cache(self):
+        drone = self._drone()
+        module = os.path.dirname(self._source('src/mymodule/init.pp',
+                                              'class mymodule {}\n'))
+        drone.add_resource(module, 'module')
+        sent = []
+
+        def send(source, target, path, dest):
+            sent.append((source, target))
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.copy(path, dest)
+
+        fleet = drones.DroneFleet([drone], fanout=2, send=send)
+        fleet.bundle_dir = os.path.join(self.tmpdir, 'node1', 'bundles')
+        fleet.prepare_nodes()
+        self.assertEqual(sent, [(None, 'node1')])
+        self.assertTrue(os.path.exists(
+            os.path.join(drone.module_dir, 'mymodule', 'init.pp')))
+        self.assertFalse(os.path.exists(
+            os.path.join(drone.resource_dir, '.casaba-manifest')))
+        self.assertEqual(os.listdir(fleet.bundle_dir), [])
+        with open(os.path.join(drone.cache_dir, 'DIGEST')) as fp:
+            self.assertEqual(fp.read().strip(), drone._resource_digest)
+        self.assertTrue(os.path.exists(
+            os.path.join(drone.cache_dir, 'MANIFEST')))
+
+        # up to date node cache is used instead of sending the bundle
+        shutil.rmtree(drone.module_dir)
+        fleet.prepare_nodes()
+        self.assertEqual(len(sent), 1)
+        self.assertTrue(os.path.exists(
+            os.path.join(drone.module_dir, 'mymodule', 'init.pp')))
+
+    def test_fleet_failure_aborts_other_nodes(self):
+        fleet = drones.DroneFleet()
+        for name in ('node1', 'node2', 'node3'):
+            drone = self._drone(name)
+            content = name == 'node2' and 'Error: broken\n' or 'SLOW\n'
+            drone.add_recipe(self._source('recipes/%s_test.pp' % name,
+                                          content), marker='test')
+            fleet.add_drone(drone)
+        fleet.prepare_nodes()
+
+        started = time.time()
+        try:
+            fleet.apply()
+        except MultiHostError as ex:
+            error = ex
+        else:
+            self.fail('MultiHostError not raised')
+        # slow nodes are not waited for
+        self.assertTrue(time.time() - started < 3)
+        self.assertEqual(sorted(error.errors), ['node2'])
+        self.assertEqual(error.aborted, ['node1', 'node3'])
+        self.assertIn('Failed to apply on 1 of 3 nodes:\n[node2] ',
+                      str(error))
+        self.assertIn('Aborted on 2 nodes because of the failure: '
+                      'node1, node3', str(error))
+
+    def test_journaled_recipe_is_skipped_with_its_messages(self):
+        journal = Journal()
+        journal.open(os.path.join(self.tmpdir, 'journal'))
+        fakes.patch(self, drones, 'journal', journal)
+        drone = self._drone()
+        recipe = self._source('recipes/node1_test.pp', MANIFEST)
+        drone.add_recipe(recipe)
+        drone.prepare_node()
+        drone.apply()
+
+        journal.open(os.path.join(self.tmpdir, 'journal'), resume=True)
+        drone = self._drone_again(drone)
+        drone.add_recipe(recipe)
+        observer = Observer()
+        drone.set_observer(observer)
+        drone.prepare_node()
+        drone.apply()
+        self.assertEqual(drone.messages, ['hello'])
+        self.assertEqual(observer.calls, [('applying', 'node1_test.pp'),
+                                          ('finished', 'node1_test.pp')])
+        log = drone._recipe_log(os.path.join(drone.recipe_dir,
+                                             'node1_test.pp'))
+        with open(log) as fp:
+            self.assertEqual(fp.read(), MANIFEST)
+
+    def _drone_again(self, drone):
+        """
+        Returns new drone for the same node as given drone.
+        """
+        shutil.rmtree(drone.local_tmpdir)
+        shutil.rmtree(os.path.join(self.tmpdir, drone.node))
+        return self._drone(drone.node)
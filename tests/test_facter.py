@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from casaba.installer import basedefs
+from casaba.installer.basedefs import RuntimePaths
+from casaba.installer.exceptions import MultiHostError
+from casaba.installer.utils import OutputBuffer
+from casaba.modules import facter
+
+from . import fakes
+
+
+# prints facts of the host given in variable HOST and records the call,
+# discovery of host named "broken" fails
+FACTER = '''echo $HOST >> "$FACTER_CALLS"
+[ $HOST = broken ] && exit 1
+sleep 0.5
+echo "{\\"hostname\\": \\"$HOST\\", \\"processorcount\\": 2}"'''
+
+
+class NamedPool(fakes.LocalSshPool):
+    """
+    Pool passing name of the host to the command in variable HOST.
+    """
+    def ssh_command(self, host, *command):
+        cmd = super(NamedPool, self).ssh_command(host, *command)
+        return cmd[:-1] + ['export HOST=%s; %s' % (host, cmd[-1])]
+
+
+class ParseFactsTest(unittest.TestCase):
+    def test_json(self):
+        output = json.dumps({'osfamily': u'RedHat', 'is_virtual': True,
+                             'processorcount': 4, 'uptime_days': 1.5,
+                             'networking': {'interfaces': [u'eth0']}})
+        expected = {'osfamily': 'RedHat', 'is_virtual': 'true',
+                    'processorcount': '4', 'uptime_days': '1.5',
+                    'networking': {'interfaces': ['eth0']}}
+        facts = facter.parse_facts(output)
+        self.assertEqual(facts, expected)
+        self.assertTrue(isinstance(facts['osfamily'], str))
+
+        buf = OutputBuffer(spill_limit=10)
+        buf.write(output)
+        self.assertEqual(facter.parse_facts(buf), expected)
+        buf.close()
+
+    def test_legacy_fallback(self):
+        output = ('Warning: could not load fact\n'
+                  'osfamily => RedHat\n'
+                  'ipaddress_eth0 => 192.168.0.2\n'
+                  'sshrsakey => AAAA=>B\n')
+        self.assertEqual(facter.parse_facts(output),
+                         {'osfamily': 'RedHat',
+                          'ipaddress_eth0': '192.168.0.2',
+                          'sshrsakey': 'AAAA=>B'})
+
+
+class FactsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        fakes.patch(self, basedefs, 'runtime', RuntimePaths(self.tmpdir))
+
+    def test_cache_expiry(self):
+        self.assertIsNone(facter.load_cached_facts('node1'))
+        facter.store_facts('node1', {'osfamily': 'RedHat'})
+        self.assertEqual(facter.load_cached_facts('node1', ttl=60),
+                         {'osfamily': 'RedHat'})
+
+        path = os.path.join(self.tmpdir, 'facts', 'node1.json')
+        with open(path) as fp:
+            cached = json.load(fp)
+        cached['timestamp'] = time.time() - 120
+        with open(path, 'w') as fp:
+            json.dump(cached, fp)
+        self.assertIsNone(facter.load_cached_facts('node1', ttl=60))
+        self.assertEqual(facter.load_cached_facts('node1', ttl=600),
+                         {'osfamily': 'RedHat'})
+        fakes.patch(self, basedefs, 'FACTS_CACHE_TTL', 60)
+        self.assertIsNone(facter.load_cached_facts('node1'))
+
+    def test_broken_cache(self):
+        facter.store_facts('node1', {'osfamily': 'RedHat'})
+        with open(os.path.join(self.tmpdir, 'facts', 'node1.json'),
+                  'w') as fp:
+            fp.write('{')
+        self.assertIsNone(facter.load_cached_facts('node1', ttl=60))
+
+
+class DiscoverHostsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        fakes.patch(self, basedefs, 'runtime', RuntimePaths(self.tmpdir))
+        fakes.use_ssh_pool(self, NamedPool())
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        fakes.add_executable(bindir, 'facter', FACTER)
+        fakes.setenv(self, 'PATH', '%s:%s' % (bindir, os.environ['PATH']))
+        self.calls = os.path.join(self.tmpdir, 'calls')
+        fakes.setenv(self, 'FACTER_CALLS', self.calls)
+
+    def called(self):
+        if not os.path.exists(self.calls):
+            return []
+        with open(self.calls) as fp:
+            result = sorted(fp.read().split())
+        os.unlink(self.calls)
+        return result
+
+    def test_discovery(self):
+        hosts = ['node%d' % i for i in range(4)]
+        marker = os.path.join(self.tmpdir, 'prepared')
+        started = time.time()
+        details = facter.discover_hosts(hosts, ttl=60, workers=4,
+                                        prepare=['echo $HOST >> %s' % marker])
+        # hosts are discovered concurrently
+        self.assertTrue(time.time() - started < 1.5)
+        self.assertEqual(details, dict(
+            (i, {'hostname': i, 'processorcount': '2'}) for i in hosts))
+        self.assertEqual(self.called(), hosts)
+
+        # cached facts are used, prepare commands are ran anyway
+        self.assertEqual(facter.discover_hosts(hosts, ttl=60,
+                                               prepare=['true']), details)
+        self.assertEqual(self.called(), [])
+        facter.discover_hosts(hosts[:1], ttl=0)
+        self.assertEqual(self.called(), hosts[:1])
+        with open(marker) as fp:
+            self.assertEqual(sorted(fp.read().split()), hosts)
+
+    def test_failed_hosts(self):
+        try:
+            facter.discover_hosts(['node1', 'broken'], ttl=60)
+        except MultiHostError as ex:
+            error = ex
+        else:
+            self.fail('MultiHostError not raised')
+        self.assertEqual(sorted(error.errors), ['broken'])
+        self.assertIn('Failed to discover 1 of 2 hosts', str(error))
+        # facts of successful hosts are cached
+        self.assertEqual(facter.load_cached_facts('node1', ttl=60),
+                         {'hostname': 'node1', 'processorcount': '2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
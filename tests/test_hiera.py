@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from casaba.modules import hiera
+from casaba.modules.sorteddict import UnsortableOrderedDict
+
+
+class WriteFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'defaults.yaml')
+
+    def read(self):
+        with open(self.path) as fp:
+            return fp.read()
+
+    def test_data_keep_order(self):
+        data = UnsortableOrderedDict([('b', 1), ('a', [1, 2])])
+        self.assertTrue(hiera.write_file(self.path, data))
+        self.assertEqual(self.read(), '---\nb: 1\na:\n    - 1\n    - 2\n')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode),
+                         hiera._FILE_MODE)
+
+    def test_unchanged_file_is_not_touched(self):
+        hiera.write_file(self.path, {'a': 1})
+        os.utime(self.path, (1000, 1000))
+        self.assertFalse(hiera.write_file(self.path, {'a': 1}))
+        self.assertEqual(os.stat(self.path).st_mtime, 1000)
+
+    def test_mode_of_replaced_file_is_kept(self):
+        hiera.write_file(self.path, {'a': 1})
+        os.chmod(self.path, 0o640)
+        self.assertTrue(hiera.write_file(self.path, {'a': 2}))
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+        self.assertEqual(os.listdir(self.tmpdir), ['defaults.yaml'])
+
+    def test_concurrent_writers_of_the_same_file(self):
+        errors = []
+
+        def write(value):
+            try:
+                for i in range(20):
+                    hiera.write_file(self.path, {'value': '%s-%s'
+                                                 % (value, i)})
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.tmpdir), ['defaults.yaml'])
+        self.assertTrue(self.read().startswith('---\nvalue: '))
+
+
+if __name__ == '__main__':
+    unittest.main()
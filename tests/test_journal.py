@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from casaba.installer.core.journal import Journal
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, True)
+        self.directory = os.path.join(self.tmpdir, 'journal')
+
+    def reopen(self, resume=True):
+        journal = Journal()
+        journal.open(self.directory, resume=resume)
+        return journal
+
+    def test_disabled_journal_records_nothing(self):
+        journal = Journal()
+        journal.record_step('step', 'abc', {}, {'A': 1})
+        journal.record_recipe('node', 'key')
+        journal.keep_dir('host', '/var/tmp/x')
+        self.assertFalse(journal.resumable)
+        self.assertEqual(journal.kept_dirs(), {})
+
+    def test_finished_step_is_skipped_only_when_resumed(self):
+        journal = self.reopen(resume=False)
+        config = {'A': 1, 'DIR_LOG': '/tmp/log'}
+        fingerprint = journal.fingerprint(config)
+        journal.record_step('step', fingerprint, {'A': 1}, {'A': 2, 'B': 3},
+                            messages=['done'])
+        self.assertIsNone(journal.finished_step('step', fingerprint))
+
+        journal = self.reopen()
+        config['DIR_LOG'] = '/tmp/other'
+        self.assertEqual(journal.fingerprint(config), fingerprint)
+        entry = journal.finished_step('step', fingerprint)
+        self.assertEqual(entry['changed'], {'A': 2, 'B': 3})
+        self.assertEqual(entry['messages'], ['done'])
+        self.assertIsNone(journal.finished_step('step', 'changed'))
+
+        journal = self.reopen(resume=False)
+        self.assertFalse(journal.resumable)
+        self.assertIsNone(journal.finished_step('step', fingerprint))
+
+    def test_recipe_log_and_messages_are_restored(self):
+        log = os.path.join(self.tmpdir, 'recipe.log')
+        with open(log, 'w') as fp:
+            fp.write('applied\n')
+        journal = self.reopen(resume=False)
+        journal.record_recipe('node', 'key', log, messages=['notice'])
+
+        journal = self.reopen()
+        self.assertTrue(journal.resumable)
+        self.assertTrue(journal.applied_recipe('node', 'key'))
+        self.assertFalse(journal.applied_recipe('other', 'key'))
+        self.assertEqual(journal.recipe_messages('node', 'key'), ['notice'])
+        restored = os.path.join(self.tmpdir, 'restored.log')
+        journal.restore_log('node', 'key', restored)
+        with open(restored) as fp:
+            self.assertEqual(fp.read(), 'applied\n')
+
+    def test_kept_dirs_become_stale_when_not_resumed(self):
+        journal = self.reopen(resume=False)
+        journal.keep_dir('host', '/var/tmp/a')
+        journal.keep_dir('host', '/var/tmp/a')
+
+        journal = self.reopen()
+        self.assertEqual(journal.kept_dirs(), {'host': ['/var/tmp/a']})
+        self.assertEqual(journal.stale_dirs, {})
+
+        journal = self.reopen(resume=False)
+        self.assertEqual(journal.kept_dirs(), {})
+        self.assertEqual(journal.stale_dirs, {'host': ['/var/tmp/a']})
+        journal.forget_dirs()
+        self.assertEqual(self.reopen(resume=False).stale_dirs, {})
+
+    def test_steps_changing_secrets_are_not_journaled(self):
+        journal = Journal()
+        journal.open(self.directory, secret_keys=['CONFIG_PW'],
+                     secret_values=['s3cret', ''])
+        journal.record_step('password', 'a', {}, {'CONFIG_PW': 'x'})
+        journal.record_step('derived', 'b', {}, {'URL': 'db://u:s3cret@h'})
+        journal.record_step('nested', 'c', {}, {'A': {'pw': ['s3cret']}})
+        journal.record_step('message', 'd', {}, {}, messages=['pw s3cret'])
+        journal.record_step('plain', 'e', {}, {'HOST': '10.0.0.1'})
+
+        journal = self.reopen()
+        for name, fingerprint in (('password', 'a'), ('derived', 'b'),
+                                  ('nested', 'c'), ('message', 'd')):
+            self.assertIsNone(journal.finished_step(name, fingerprint))
+        self.assertTrue(journal.finished_step('plain', 'e'))
+        with open(os.path.join(self.directory, 'journal.json')) as fp:
+            self.assertNotIn('s3cret', fp.read())
+
+    def test_journal_is_private(self):
+        log = os.path.join(self.tmpdir, 'recipe.log')
+        with open(log, 'w') as fp:
+            fp.write('applied\n')
+        os.chmod(log, 0o644)
+        journal = self.reopen(resume=False)
+        journal.record_recipe('node', 'key', log)
+        self.assertEqual(self.mode(self.directory), 0o700)
+        self.assertEqual(
+            self.mode(os.path.join(self.directory, 'journal.json')), 0o600)
+        self.assertEqual(self.mode(journal._log_path('node:key')), 0o600)
+
+    def mode(self, path):
+        return stat.S_IMODE(os.stat(path).st_mode)
+
+
+if __name__ == '__main__':
+    unittest.main()
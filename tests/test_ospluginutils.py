@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from casaba.installer import basedefs
+
+from . import fakes
+
+try:
+    from casaba.modules import ospluginutils
+except ImportError:
+    # certificates require pyOpenSSL
+    ospluginutils = None
+
+
+@unittest.skipIf(ospluginutils is None, 'pyOpenSSL is not available')
+class ManifestFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        fakes.patch(self, basedefs, 'runtime',
+                    basedefs.RuntimePaths(os.path.join(self.tmpdir, 'var')))
+        self.manifests = ospluginutils.ManifestFiles()
+
+    def test_fragments_are_joined(self):
+        manifests = self.manifests
+        manifests.addFile('node_a.pp', 'first', 'class a {}')
+        manifests.addFile('node_b.pp', 'second')
+        manifests.addFile('node_a.pp', 'ignored', 'include a')
+        manifests.prependFile('node_a.pp', 'first', '# header')
+        self.assertEqual(manifests.getFiles(), [('node_a.pp', 'first'),
+                                                ('node_b.pp', 'second')])
+        self.assertEqual(manifests.getData('node_a.pp'),
+                         '# header\n\nclass a {}\ninclude a')
+        self.assertEqual(manifests.getData('node_b.pp'), '\n')
+        self.assertEqual(manifests.getStats(),
+                         [('node_a.pp', 30, 3), ('node_b.pp', 1, 1)])
+
+    def test_manifests_are_written(self):
+        names = ['node%02d.pp' % i for i in range(20)]
+        for name in names:
+            self.manifests.addFile(name, 'marker', 'node { "%s": }' % name)
+        self.manifests.writeManifests(workers=4)
+        directory = basedefs.runtime.PUPPET_MANIFEST_DIR
+        self.assertEqual(sorted(os.listdir(directory)), names)
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+        for name in names:
+            path = os.path.join(directory, name)
+            with open(path) as fp:
+                self.assertEqual(fp.read(), '\nnode { "%s": }' % name)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+    def test_manifests_are_written_only_once(self):
+        self.manifests.addFile('node.pp', 'marker', 'data')
+        self.manifests.writeManifests()
+        self.assertRaises(OSError, self.manifests.writeManifests)
+
+
+if __name__ == '__main__':
+    unittest.main()
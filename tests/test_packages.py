@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from casaba.installer.exceptions import MultiHostError
+from casaba.installer.utils import packages
+
+from . import fakes
+
+
+class PackageManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.manager = packages.PackageManager()
+        test = self
+
+        class Runner(object):
+            """
+            Stand-in for ScriptRunner refreshing cache for a while.
+            """
+            def __init__(self, ip=None):
+                pass
+
+            def append(self, line):
+                pass
+
+            def execute_on(self, hosts, **kwargs):
+                time.sleep(0.2)
+                test.record('warmed', tuple(hosts))
+
+        def install(host, pkgs, timeout=None):
+            if host == 'broken':
+                raise RuntimeError('No package %s' % pkgs[0])
+            self.record('install', host, tuple(pkgs))
+            return list(pkgs)
+
+        fakes.patch(self, packages, 'ScriptRunner', Runner)
+        fakes.patch(self, packages, 'local_addresses',
+                    lambda: set(['10.0.0.1', '127.0.0.1']))
+        self.manager._install = install
+
+    def record(self, *event):
+        with self.lock:
+            self.events.append(event)
+
+    def test_local_install_waits_for_warming_of_local_address(self):
+        self.manager.warm_cache(['10.0.0.1', '10.0.0.2'], background=True)
+        self.manager.require(None, ['puppet'])
+        self.manager.ensure([None])
+        self.assertEqual(self.events,
+                         [('warmed', ('10.0.0.1', '10.0.0.2')),
+                          ('install', None, ('puppet',))])
+
+    def test_local_install_does_not_wait_for_other_hosts(self):
+        self.manager.warm_cache(['10.0.0.2'], background=True)
+        self.manager.require(None, ['puppet'])
+        self.manager.ensure([None])
+        self.assertEqual(self.events, [('install', None, ('puppet',))])
+
+        self.manager.require(['10.0.0.2'], ['facter'])
+        self.manager.ensure(['10.0.0.2'])
+        self.assertEqual(self.events[1:],
+                         [('warmed', ('10.0.0.2',)),
+                          ('install', '10.0.0.2', ('facter',))])
+
+    def test_packages_are_installed_once(self):
+        self.manager.require(['a', 'b'], ['puppet', 'facter'])
+        self.manager.require('a', ['puppet'])
+        self.assertEqual(self.manager.ensure(),
+                         {'a': ['puppet', 'facter'],
+                          'b': ['puppet', 'facter']})
+        self.assertEqual(self.manager.ensure(['a']), {'a': []})
+        self.assertEqual(len(self.events), 2)
+
+    def test_failures_of_all_hosts_are_reported(self):
+        self.manager.require(['a', 'broken'], ['puppet'])
+        try:
+            self.manager.ensure()
+        except MultiHostError as ex:
+            self.assertEqual(list(ex.errors), ['broken'])
+            self.assertIn('on 1 of 2 hosts', str(ex))
+        else:
+            self.fail('MultiHostError not raised')
+        self.assertEqual(self.events, [('install', 'a', ('puppet',))])
+
+
+if __name__ == '__main__':
+    unittest.main()
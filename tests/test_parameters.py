@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from casaba.installer.core.parameters import Group
+from casaba.installer.core.parameters import ParameterRegistry
+
+
+def group(name, *params):
+    return Group({'GROUP_NAME': name},
+                 [dict(CONF_NAME=conf, **attrs) for conf, attrs in params])
+
+
+class ParameterRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = ParameterRegistry()
+        self.first = group('FIRST',
+                           ('A', {'MASK_INPUT': True, 'USAGE': 'a'}),
+                           ('B', {'MASK_INPUT': False}))
+        self.second = group('SECOND',
+                            ('C', {'MASK_INPUT': True, 'USAGE': 'a'}))
+        self.registry.add_group(self.first)
+        self.registry.add_group(self.second)
+
+    def names(self, params):
+        return [param.CONF_NAME for param in params]
+
+    def test_get(self):
+        self.assertIs(self.registry.get('C'),
+                      self.second.parameters['C'])
+        self.assertIsNone(self.registry.get('D'))
+        self.assertIs(self.registry.get_group('FIRST'), self.first)
+        self.assertIsNone(self.registry.get_group('THIRD'))
+
+    def test_query_by_indexed_and_other_attributes(self):
+        self.assertEqual(self.names(self.registry.query(MASK_INPUT=True)),
+                         ['A', 'C'])
+        self.assertEqual(self.names(self.registry.query(USAGE='a')),
+                         ['A', 'C'])
+        self.assertEqual(self.names(self.registry.query(MASK_INPUT=True,
+                                                        CONF_NAME='C')),
+                         ['C'])
+        self.assertEqual(self.registry.query(MASK_INPUT=False, USAGE='a'),
+                         [])
+
+    def test_inserted_group_keeps_order(self):
+        inserted = group('INSERTED', ('D', {'MASK_INPUT': True}),
+                         ('A', {'MASK_INPUT': True}))
+        self.registry.add_group(inserted, index=1)
+        self.assertEqual([g.GROUP_NAME for g in self.registry.groups],
+                         ['FIRST', 'INSERTED', 'SECOND'])
+        self.assertEqual(self.names(self.registry.query(MASK_INPUT=True)),
+                         ['A', 'D', 'A', 'C'])
+        # first registered parameter wins when names clash
+        self.assertIs(self.registry.get('A'), self.first.parameters['A'])
+
+        self.registry.add_group(group('FIRST', ('E', {})), index=0)
+        self.assertIs(self.registry.get_group('FIRST'), self.first)
+        self.assertIs(self.registry.get('A'), self.first.parameters['A'])
+        self.assertEqual(self.names(self.registry.query(CONF_NAME='E')),
+                         ['E'])
+
+    def test_unhashable_values(self):
+        self.registry.add_group(group('LIST', ('F', {'CONDITION': [1]})))
+        self.assertEqual(self.names(self.registry.query(CONDITION=[1])),
+                         ['F'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import imp
+import json
+import shutil
+import tempfile
+import unittest
+
+from casaba.installer import plugin_index
+
+
+PLUGIN = '''
+import os
+
+def initConfig(controller):
+    controller.addGroup(
+        {'GROUP_NAME': '%(name)s', 'DESCRIPTION': 'Group %(name)s',
+         'PRE_CONDITION': lambda config: True},
+        [{'CONF_NAME': 'CONFIG_%(name)s', 'CMD_OPTION': '%(name)s-opt',
+          'USAGE': 'Usage of %(name)s', 'USE_DEFAULT': False,
+          'DEFAULT_VALUE': os.environ.get('TEST_DEFAULT', 'x'),
+          'VALIDATORS': [lambda value, options=None: None]}])
+
+def initSequences(controller):
+    pass
+'''
+
+
+class PluginIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='casaba-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.plugins = os.path.join(self.tmpdir, 'plugins')
+        self.modules = os.path.join(self.tmpdir, 'modules')
+        os.mkdir(self.plugins)
+        os.mkdir(self.modules)
+        self.helper = os.path.join(self.modules, 'helper.py')
+        with open(self.helper, 'w') as fp:
+            fp.write('VALUE = 1\n')
+        self.path = os.path.join(self.tmpdir, 'index.json')
+        self.imported = []
+        for name in ('first_000', 'second_010', '_disabled_020'):
+            self._plugin(name)
+
+    def _plugin(self, name):
+        with open(os.path.join(self.plugins, name + '.py'), 'w') as fp:
+            fp.write(PLUGIN % {'name': name.split('_')[0]})
+
+    def _importer(self, name, path):
+        self.imported.append(name)
+        return imp.load_source('casaba_test_%s' % name, path)
+
+    def _load(self):
+        index = plugin_index.PluginIndex(self.plugins, self.path,
+                                         dependencies=[self.modules])
+        return index.load(importer=self._importer)
+
+    def test_registry(self):
+        registry = self._load().registry()
+        self.assertEqual([g.GROUP_NAME for g in registry.groups],
+                         ['first', 'second'])
+        param = registry.get('CONFIG_second')
+        self.assertEqual(param.CMD_OPTION, 'second-opt')
+        self.assertEqual(param.USAGE, 'Usage of second')
+        self.assertIsNone(registry.groups[0].PRE_CONDITION)
+
+    def test_environment_dependent_values_are_not_indexed(self):
+        self._load()
+        with open(self.path) as fp:
+            data = fp.read()
+        self.assertNotIn('DEFAULT_VALUE', data)
+        self.assertIsNone(self._load().registry()
+                          .get('CONFIG_first').DEFAULT_VALUE)
+
+    def test_unchanged_plugins_are_not_imported(self):
+        self._load()
+        self.assertEqual(self.imported, ['first_000', 'second_010'])
+        self._load()
+        self.assertEqual(len(self.imported), 2)
+
+    def test_changed_plugin_is_imported(self):
+        self._load()
+        with open(os.path.join(self.plugins, 'second_010.py'), 'a') as fp:
+            fp.write('# changed\n')
+        self._load()
+        self.assertEqual(self.imported[2:], ['second_010'])
+
+    def test_touched_plugin_is_not_imported(self):
+        self._load()
+        os.utime(os.path.join(self.plugins, 'first_000.py'), (1000, 1000))
+        self._load()
+        self.assertEqual(len(self.imported), 2)
+
+    def test_changed_dependency_drops_index(self):
+        self._load()
+        with open(self.helper, 'a') as fp:
+            fp.write('OTHER = 2\n')
+        os.utime(self.helper, (1000, 1000))
+        self._load()
+        self.assertEqual(self.imported[2:], ['first_000', 'second_010'])
+
+    def test_broken_index_is_rebuilt(self):
+        with open(self.path, 'w') as fp:
+            fp.write('{broken')
+        self._load()
+        with open(self.path) as fp:
+            self.assertEqual(json.load(fp)['version'],
+                             plugin_index.INDEX_VERSION)
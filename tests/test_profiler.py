@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from casaba.installer import utils
+from casaba.installer.utils import shell
+from casaba.installer.utils.profiler import PROFILE_FILE
+from casaba.installer.utils.profiler import Profiler
+from casaba.installer.utils.profiler import TRACE_FILE
+
+from . import fakes
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.profiler = Profiler()
+
+    def test_span(self):
+        with self.profiler.span('script', 'echo', host='node1') as span:
+            span['rc'] = 0
+        try:
+            with self.profiler.span('script', 'false'):
+                raise ValueError('failed')
+        except ValueError:
+            pass
+        spans = self.profiler.spans
+        self.assertEqual([(i['category'], i['name'], i['attrs'])
+                          for i in spans],
+                         [('script', 'echo', {'host': 'node1', 'rc': 0}),
+                          ('script', 'false', {'error': True})])
+        for span in spans:
+            self.assertTrue(span['duration'] >= 0)
+            self.assertEqual(span['thread'],
+                             threading.current_thread().name)
+
+    def test_disabled(self):
+        profiler = Profiler(enabled=False)
+        with profiler.span('script', 'echo'):
+            pass
+        profiler.record('command', 'ls', 0, 1)
+        profiler.count('retries')
+        self.assertEqual(profiler.spans, [])
+        self.assertEqual(profiler.report()['counters'], {})
+
+    def test_report(self):
+        start = self.profiler.started
+        self.profiler.record('command', 'scp', start, start + 2,
+                             host='node1', bytes=100)
+        self.profiler.record('command', 'scp', start + 1, start + 2,
+                             host='node2', bytes=50)
+        self.profiler.record('step', 'discover', start, start + 4)
+        self.profiler.count('retries')
+        self.profiler.count('retries', 2)
+
+        report = self.profiler.report()
+        self.assertEqual(report['by_category']['command'],
+                         {'count': 2, 'total': 3, 'max': 2, 'bytes': 150})
+        self.assertEqual(sorted(report['by_host']), ['node1', 'node2'])
+        self.assertEqual(report['by_host']['node2']['command']['total'], 1)
+        # operations are sorted by total time
+        self.assertEqual([(i['category'], i['name'])
+                          for i in report['by_operation']],
+                         [('step', 'discover'), ('command', 'scp')])
+        self.assertEqual(report['counters'], {'retries': 3})
+        self.assertEqual([i['start'] for i in report['spans']], [0, 1, 0])
+
+    def test_trace(self):
+        start = self.profiler.started
+        self.profiler.record('command', 'scp', start + 1, start + 2,
+                             host='node1')
+        self.profiler.record('step', 'discover', start, start + 4)
+        events = self.profiler.trace()['traceEvents']
+        lanes = dict((i['args']['name'], i['tid']) for i in events
+                     if i['ph'] == 'M')
+        self.assertEqual(sorted(lanes), sorted(
+            ['node1', threading.current_thread().name]))
+        spans = [i for i in events if i['ph'] == 'X']
+        self.assertEqual([(i['name'], i['tid'], i['ts'], i['dur'])
+                          for i in spans],
+                         [('scp', lanes['node1'], 1000000, 1000000),
+                          ('discover',
+                           lanes[threading.current_thread().name],
+                           0, 4000000)])
+
+    def test_save(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with self.profiler.span('step', 'discover'):
+            pass
+        paths = self.profiler.save(tmpdir)
+        self.assertEqual(
+            paths, [os.path.join(tmpdir, PROFILE_FILE),
+                    os.path.join(tmpdir, TRACE_FILE)])
+        with open(paths[0]) as fp:
+            report = json.load(fp)
+        self.assertEqual(report['spans'][0]['name'], 'discover')
+        with open(paths[1]) as fp:
+            trace = json.load(fp)
+        self.assertEqual(len(trace['traceEvents']), 2)
+
+
+class CommandProfilingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        fakes.add_executable(bindir, 'scp', 'true')
+        fakes.setenv(self, 'PATH', '%s:%s' % (bindir, os.environ['PATH']))
+        self.profiler = Profiler()
+        fakes.patch(self, shell, 'profiler', self.profiler)
+        # file named as character of the command in working directory
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, cwd)
+        with open('x', 'w') as fp:
+            fp.write('x' * 10)
+
+    def test_scp_bytes(self):
+        utils.execute(['scp', 'x', 'root@node1:/tmp/x'], log=False)
+        span = self.profiler.spans[-1]
+        self.assertEqual((span['name'], span['attrs']['host']),
+                         ('scp', 'node1'))
+        self.assertEqual(span['attrs']['bytes'], 10)
+
+    def test_string_command_is_not_counted(self):
+        utils.execute('scp y root@node1:/tmp/x', use_shell=True, log=False)
+        span = self.profiler.spans[-1]
+        self.assertEqual(span['name'], 'scp')
+        self.assertEqual(span['attrs']['bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from casaba.installer.exceptions import PuppetError
+from casaba.modules import puppet
+
+
+def old_validate_logfile(logpath):
+    """
+    validate_logfile as it was before LogAnalyzer was introduced.
+    """
+    manifestpath = os.path.splitext(logpath)[0]
+    manifestfile = os.path.basename(manifestpath)
+    with open(logpath) as logfile:
+        for line in logfile:
+            line = line.strip()
+
+            if re.search(OLD_RE_ERROR, line) is None:
+                continue
+
+            error = puppet.re_color.sub('', line)  # remove colors
+            if puppet.re_ignore.search(line):
+                continue
+
+            for regex, surrogate in puppet.surrogates:
+                match = re.search(regex, error)
+                if match is None:
+                    continue
+
+                args = {}
+                num = 1
+                while True:
+                    try:
+                        args['arg%d' % num] = match.group(num)
+                        num += 1
+                    except IndexError:
+                        break
+                error = surrogate % args
+
+            message = ('Error appeared during Puppet run: %s\n%s\n'
+                       'You will find full trace in log %s' %
+                       (manifestfile, error, logpath))
+            raise PuppetError(message)
+
+
+def old_scan_logfile(logpath):
+    """
+    scan_logfile as it was before LogAnalyzer was introduced.
+    """
+    output = []
+    with open(logpath) as logfile:
+        for line in logfile:
+            match = puppet.re_notice.search(line)
+            if match:
+                output.append(match.group('message'))
+    return output
+
+
+OLD_RE_ERROR = (
+    'err:|Syntax error at|^Duplicate definition:|^Invalid tag|'
+    '^No matching value for selector param|^Parameter name failed:|Error:|'
+    '^Invalid parameter|^Duplicate declaration:|^Could not find resource|'
+    '^Could not parse for|^/usr/bin/puppet:\d+: .+|.+\(LoadError\)|'
+    '^Could not autoload|'
+    '^\/usr\/bin\/env\: jruby\: No such file or directory|'
+    'failed to execute puppet'
+)
+
+LINES = [
+    # ordinary output
+    'Notice: Compiled catalog for node1 in environment production',
+    'Info: Applying configuration version 1450000000',
+    'Notice: /Stage[main]/Nova/Package[nova-common]/ensure: created',
+    '   ',
+    '',
+    # one line for every alternative of the error pattern
+    'err: /Stage[main]/Foo: Could not evaluate',
+    'Warning: Syntax error at line 3',
+    'Duplicate definition: Class[Foo] is already defined',
+    '  Duplicate definition: indented is anchored after strip',
+    'Not at start Duplicate definition: foo',
+    'Invalid tag "foo bar"',
+    'No matching value for selector param \'x\'',
+    'Parameter name failed: Invalid name',
+    'Error: Could not start Service[httpd]',
+    '\x1b[1;31mError: colored failure\x1b[0m',
+    'Invalid parameter foo on Class[Bar]',
+    'Duplicate declaration: File[/etc/x] is already declared',
+    'Could not find resource \'Package[x]\' for relationship',
+    'Could not parse for environment production: Syntax',
+    '/usr/bin/puppet:12: warning: something',
+    '/usr/bin/puppet:12: ',
+    'cannot load such file -- json (LoadError)',
+    '(LoadError)',
+    'Could not autoload puppet/type/foo',
+    '/usr/bin/env: jruby: No such file or directory',
+    'Notice: failed to execute puppet',
+    # expected errors which are ignored
+    'Error: Command mysql is missing',
+    'Error: Could not prefetch database_grant provider \'mysql\': '
+    'Execution of \'/usr/bin/mysql\' returned 1: /root/.my.cnf',
+    'Error: Execution of \'/usr/bin/yum -d 0 -e 0 -y install '
+    'swift-plugin-s3\' returned 1',
+    'Error: NetworkManager is not running',
+    # errors replaced by surrogates
+    'Error: /Stage[main]/Sysctl::Value[net.ipv4.ip_forward]/'
+    'Sysctl[net.ipv4.ip_forward]/val: change failed Field \'val\' is '
+    'required',
+    'Error: /Stage[main]/Nova/Package[openstack-nova]/ensure: change from '
+    'absent to present failed: Execution of \'/usr/bin/yum -d 0 -e 0 -y '
+    'install openstack-nova\' returned 1: Error: Nothing to do',
+    'Error: Execution of \'/usr/bin/yum -d 0 -e 0 -y install foo\' '
+    'returned 1: Error: Nothing to do',
+    '/usr/bin/env: jruby: No such file or directory (LoadError)',
+    # notices
+    "notice: /Stage[main]/Main/Notify[casaba_info]/message: "
+    "defined 'message' as 'hello'",
+    "  notice: /Stage[main]/Main/Notify[casaba_info]/message: "
+    "defined 'message' as 'indented'  ",
+    "Notice: /Stage[main]/Main/Notify[casaba_info]/message: "
+    "defined 'message' as 'capital'",
+    "notice: /Stage[main]/Main/Notify[casaba_info]/message: "
+    "defined 'message' as 'Error: in message'",
+]
+
+
+class LogAnalyzerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _log(self, lines, name='node1_test.pp.log'):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fp:
+            fp.write(''.join('%s\n' % i for i in lines))
+        return path
+
+    def _outcome(self, validate, path):
+        try:
+            validate(path)
+        except PuppetError as ex:
+            return str(ex)
+        return None
+
+    def test_validation_matches_old_implementation(self):
+        errors = 0
+        for line in LINES:
+            path = self._log([line])
+            expected = self._outcome(old_validate_logfile, path)
+            self.assertEqual(self._outcome(puppet.validate_logfile, path),
+                             expected, 'Outcome differs for: %r' % line)
+            errors += expected is not None
+        # corpus really exercises errors, ignored errors and clean lines
+        self.assertEqual(errors, 23)
+
+    def test_surrogates(self):
+        path = self._log([LINES[30]])
+        self.assertRaisesRegexp(PuppetError, 'Cannot change value of '
+                                'net.ipv4.ip_forward in /etc/sysctl.conf',
+                                puppet.validate_logfile, path)
+        path = self._log([LINES[31]])
+        self.assertRaisesRegexp(PuppetError, 'Package openstack-nova has '
+                                'not been found in enabled Yum repos',
+                                puppet.validate_logfile, path)
+
+    def test_scan_matches_old_implementation(self):
+        path = self._log(LINES)
+        messages = puppet.scan_logfile(path)
+        self.assertEqual(messages, old_scan_logfile(path))
+        self.assertEqual(messages, ['hello', 'indented', 'Error: in message'])
+
+    def test_messages_are_collected_while_validating(self):
+        analyzer = puppet.LogAnalyzer('test.pp')
+        for line in LINES[:5] + LINES[-4:-1]:
+            analyzer.feed(line)
+        self.assertEqual(analyzer.messages, ['hello', 'indented'])
+
+    def test_early_abort(self):
+        lines = LINES[:5] + ['Error: first', 'Error: second'] + LINES[:5]
+        path = self._log(lines)
+        analyzer = puppet.LogAnalyzer('test.pp', logpath=path)
+        fed = []
+        feed = analyzer.feed
+
+        def recording_feed(line):
+            fed.append(line)
+            feed(line)
+
+        analyzer.feed = recording_feed
+        self.assertRaisesRegexp(PuppetError, 'Error: first\n',
+                                analyzer.feed_file, path)
+        # the rest of the log is not read after the first error
+        self.assertEqual(len(fed), 6)
+        self.assertEqual(fed[-1], 'Error: first\n')
+
+    def test_no_validation(self):
+        analyzer = puppet.LogAnalyzer('test.pp', validate=False)
+        for line in LINES:
+            analyzer.feed(line)
+        self.assertEqual(len(analyzer.messages), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
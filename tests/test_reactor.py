@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import unittest
+
+from casaba.installer.utils.reactor import Reactor
+from casaba.installer.utils.reactor import wait_readable
+
+
+class Sink(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+
+class ReactorTest(unittest.TestCase):
+    def test_commands_run_concurrently(self):
+        reactor = Reactor()
+        jobs = [reactor.spawn(['sleep', '0.3']) for i in range(5)]
+        started = time.time()
+        self.assertTrue(reactor.run())
+        self.assertTrue(time.time() - started < 1.2)
+        self.assertEqual([job.rc for job in jobs], [0] * 5)
+        self.assertTrue(all(job.done for job in jobs))
+
+    def test_limit_queues_commands(self):
+        reactor = Reactor(limit=2)
+        jobs = [reactor.spawn(['sleep', '0.2']) for i in range(4)]
+        reactor.run()
+        starts = sorted(job.started for job in jobs)
+        ends = sorted(job.ended for job in jobs)
+        # third command is started only after one of the first two ended
+        self.assertTrue(starts[2] >= ends[0])
+
+    def test_input_output_and_callback(self):
+        reactor = Reactor()
+        data = 'x' * (1024 * 1024)
+        sink, finished = Sink(), []
+        job = reactor.spawn(['bash', '-c', 'cat; echo err >&2; exit 3'],
+                            input=data, stdout=[sink],
+                            callback=finished.append)
+        reactor.run()
+        self.assertEqual(job.rc, 3)
+        self.assertEqual(job.stdout.getvalue(), data)
+        self.assertEqual(''.join(sink.chunks), data)
+        self.assertEqual(job.stderr.getvalue(), 'err\n')
+        self.assertEqual(finished, [job])
+
+    def test_env_is_passed(self):
+        reactor = Reactor()
+        job = reactor.spawn(['bash', '-c', 'echo $LANG'],
+                            env=dict(os.environ, LANG='C'))
+        reactor.run()
+        self.assertEqual(job.stdout.getvalue(), 'C\n')
+
+    def test_timeout_kills_commands(self):
+        reactor = Reactor()
+        job = reactor.spawn(['sleep', '10'])
+        started = time.time()
+        self.assertFalse(reactor.run(timeout=0.2))
+        self.assertTrue(time.time() - started < 5)
+        self.assertIsNotNone(job.proc.poll())
+
+    def test_watch_and_timers(self):
+        reactor = Reactor()
+        rfd, wfd = os.pipe()
+        self.addCleanup(os.close, rfd)
+        events = []
+
+        def readable(fd, event):
+            events.append(os.read(fd, 10))
+            reactor.unwatch(fd)
+
+        reactor.watch(rfd, readable)
+        reactor.call_later(0.05, lambda: os.write(wfd, 'ping'))
+        reactor.call_later(0.1, lambda: events.append('timer'))
+        reactor.run()
+        os.close(wfd)
+        self.assertEqual(events, ['ping', 'timer'])
+
+    def test_wait_readable(self):
+        rfd, wfd = os.pipe()
+        self.addCleanup(os.close, rfd)
+        self.assertEqual(wait_readable([rfd], timeout=0.05), [])
+        os.write(wfd, 'x')
+        os.close(wfd)
+        self.assertEqual(wait_readable([rfd], timeout=1), [rfd])
+
+    def test_descriptors_above_select_limit(self):
+        # descriptors of the job get numbers select can't handle
+        pipes = []
+        self.addCleanup(lambda: [os.close(fd) for pair in pipes
+                                 for fd in pair])
+        try:
+            while not pipes or pipes[-1][1] < 1100:
+                pipes.append(os.pipe())
+        except OSError:
+            self.skipTest('Not enough file descriptors')
+        reactor = Reactor()
+        job = reactor.spawn(['echo', 'ok'])
+        reactor.run()
+        self.assertEqual(job.stdout.getvalue(), 'ok\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from StringIO import StringIO
+
+from casaba.installer import utils
+from casaba.installer.core import sequences as sequences_module
+from casaba.installer.core.journal import Journal
+from casaba.installer.core.sequences import Sequence
+from casaba.installer.core.sequences import StepScheduler
+from casaba.installer.utils.profiler import Profiler
+
+from . import fakes
+
+
+class Recorder(object):
+    """
+    Creates step functions recording when they run.
+    """
+    def __init__(self, delay=0.1):
+        self.delay = delay
+        self.events = []
+        self._lock = threading.Lock()
+
+    def step(self, name, requires=None, provides=None, error=None):
+        def function(config, messages):
+            with self._lock:
+                self.events.append(('start', name))
+            time.sleep(self.delay)
+            with self._lock:
+                self.events.append(('end', name))
+            if error:
+                raise error
+            messages.append(name)
+        return {'name': name, 'function': function, 'requires': requires,
+                'provides': provides}
+
+    def started(self, name):
+        return self.events.index(('start', name))
+
+    def ended(self, name):
+        return self.events.index(('end', name))
+
+
+class StepSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        fakes.patch(self, sys, 'stdout', StringIO())
+        self.recorder = Recorder()
+
+    def test_independent_steps_run_concurrently(self):
+        rec = self.recorder
+        sequences = [
+            Sequence('first', [rec.step('a', provides=['A']),
+                               rec.step('b', requires=['A'])]),
+            Sequence('second', [rec.step('c', provides=['C'])]),
+        ]
+        messages = []
+        StepScheduler(sequences, workers=4).run(messages=messages)
+        # c does not depend on a, b has to wait for it
+        self.assertTrue(rec.started('c') < rec.ended('a'))
+        self.assertTrue(rec.started('b') > rec.ended('a'))
+        self.assertEqual(sorted(messages), ['a', 'b', 'c'])
+
+    def test_default_runs_steps_one_by_one(self):
+        rec = self.recorder
+        sequences = [Sequence('first', [rec.step('a', provides=['A']),
+                                        rec.step('c', provides=['C'])])]
+        StepScheduler(sequences).run()
+        self.assertEqual(rec.events, [('start', 'a'), ('end', 'a'),
+                                      ('start', 'c'), ('end', 'c')])
+
+    def test_undeclared_step_is_barrier(self):
+        rec = self.recorder
+        sequences = [Sequence('first', [rec.step('a', provides=['A']),
+                                        rec.step('barrier'),
+                                        rec.step('c', provides=['C'])])]
+        StepScheduler(sequences, workers=4).run()
+        self.assertEqual([name for event, name in rec.events],
+                         ['a', 'a', 'barrier', 'barrier', 'c', 'c'])
+
+    def test_dependencies(self):
+        rec = self.recorder
+        sequences = [
+            Sequence('first', [rec.step('a', provides=['A']),
+                               rec.step('b', requires=['A']),
+                               rec.step('c', requires=['A']),
+                               rec.step('d', provides=['A'])]),
+        ]
+        scheduler = StepScheduler(sequences)
+        self.assertEqual(scheduler.dependencies,
+                         [set(), set([0]), set([0]), set([0, 1, 2])])
+
+    def test_sequence_condition(self):
+        rec = self.recorder
+        sequences = [
+            Sequence('set', [rec.step('a', provides=['ENABLED'])]),
+            Sequence('skipped', [rec.step('b', provides=['B'])],
+                     condition='ENABLED', cond_match='y'),
+        ]
+        config = {'ENABLED': 'n'}
+        StepScheduler(sequences, workers=4).run(config=config)
+        self.assertEqual([name for event, name in rec.events], ['a', 'a'])
+
+    def test_failure_stops_scheduling(self):
+        rec = self.recorder
+        sequences = [
+            Sequence('first', [rec.step('a', provides=['A'],
+                                        error=ValueError('broken')),
+                               rec.step('b', requires=['A'])]),
+            Sequence('second', [rec.step('c', provides=['C'])]),
+        ]
+        scheduler = StepScheduler(sequences, workers=4)
+        self.assertRaises(ValueError, scheduler.run)
+        names = set(name for event, name in rec.events)
+        self.assertNotIn('b', names)
+        # running step is finished before the error is raised
+        self.assertIn(('end', 'c'), rec.events)
+
+    def test_sequence_spans(self):
+        rec = self.recorder
+        rec.delay = 0
+        profiler = Profiler()
+        fakes.patch(self, utils, 'profiler', profiler)
+
+        def spans():
+            result = [(i['name'], i['attrs']) for i in profiler.spans
+                      if i['category'] == 'sequence']
+            del profiler._spans[:]
+            return sorted(result)
+
+        def build():
+            return [
+                Sequence('first', [rec.step('a', provides=['A']),
+                                   rec.step('b', requires=['A'])]),
+                Sequence('second', [rec.step('c', provides=['C'])]),
+                Sequence('skipped', [rec.step('d', provides=['D'])],
+                         condition='ENABLED', cond_match='y'),
+            ]
+
+        for sequence in build():
+            sequence.run()
+        expected = spans()
+        self.assertEqual(expected, [('first', {}), ('second', {})])
+        StepScheduler(build(), workers=4).run()
+        self.assertEqual(spans(), expected)
+
+        sequences = build()
+        sequences[0].steps['a'].function = rec.step(
+            'a', error=ValueError('broken'))['function']
+        self.assertRaises(ValueError, StepScheduler(sequences).run)
+        self.assertEqual(spans(), [('first', {'error': True})])
+
+
+class ResumableStepTest(unittest.TestCase):
+    def setUp(self):
+        fakes.patch(self, sys, 'stdout', StringIO())
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.directory = os.path.join(tmpdir, 'journal')
+        self.runs = []
+        self.verified = []
+
+    def sequence(self, verify=None):
+        def function(config, messages):
+            self.runs.append(config['INPUT'])
+            config['TMPDIR'] = '/var/tmp/%d' % len(self.runs)
+
+        step = {'name': 'remote', 'function': function,
+                'requires': ['INPUT'], 'provides': ['TMPDIR'],
+                'resumable': True, 'verify': verify}
+        return Sequence('sequence', [step])
+
+    def resume(self, verify=None, resume=True):
+        journal = Journal()
+        journal.open(self.directory, resume=resume)
+        fakes.patch(self, sequences_module, 'journal', journal)
+        config = {'INPUT': 'a'}
+        self.sequence(verify).run(config=config)
+        return config
+
+    def verify(self, result):
+        def verify(config):
+            self.verified.append(config['TMPDIR'])
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return verify
+
+    def test_step_is_skipped_if_verified(self):
+        self.resume(resume=False)
+        config = self.resume(self.verify(True))
+        self.assertEqual(self.runs, ['a'])
+        self.assertEqual(self.verified, ['/var/tmp/1'])
+        self.assertEqual(config['TMPDIR'], '/var/tmp/1')
+
+    def test_step_is_run_again_if_effects_are_gone(self):
+        self.resume(resume=False)
+        config = self.resume(self.verify(False))
+        self.assertEqual(self.runs, ['a', 'a'])
+        self.assertEqual(config['TMPDIR'], '/var/tmp/2')
+
+    def test_failed_verification_runs_step_again(self):
+        self.resume(resume=False)
+        self.resume(self.verify(RuntimeError('host is down')))
+        self.assertEqual(self.runs, ['a', 'a'])
+
+    def test_verify_is_not_called_for_new_step(self):
+        self.resume(self.verify(True), resume=False)
+        self.assertEqual(self.verified, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
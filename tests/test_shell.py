@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from casaba.installer import utils
+from casaba.installer.exceptions import MultiHostError
+
+from . import fakes
+
+
+class RecordingPool(fakes.LocalSshPool):
+    def __init__(self):
+        super(RecordingPool, self).__init__()
+        # hosts whose master had not been opened when session was built
+        self.unopened = []
+
+    def ssh_command(self, host, *command):
+        if host not in self.opened:
+            self.unopened.append(host)
+        return super(RecordingPool, self).ssh_command(host, *command)
+
+
+class NamedPool(fakes.LocalSshPool):
+    """
+    Pool passing name of the host to the command in variable HOST.
+    """
+    def ssh_command(self, host, *command):
+        cmd = super(NamedPool, self).ssh_command(host, *command)
+        return cmd[:-1] + ['HOST=%s %s' % (host, cmd[-1])]
+
+
+class ExecuteOnTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = RecordingPool()
+        fakes.use_ssh_pool(self, self.pool)
+
+    def test_masters_are_opened_before_sessions(self):
+        hosts = ['host%d' % i for i in range(5)]
+        server = utils.ScriptRunner()
+        server.append('echo ok')
+        output = server.execute_on(hosts, log=False)
+        self.assertEqual(sorted(self.pool.opened), hosts)
+        self.assertEqual(self.pool.unopened, [])
+        self.assertEqual(dict((h, output[h][:2]) for h in hosts),
+                         dict((h, (0, 'ok\n')) for h in hosts))
+
+    def test_failures_of_all_hosts_are_reported(self):
+        fakes.use_ssh_pool(self, NamedPool())
+        hosts = ['host%d' % i for i in range(4)]
+        server = utils.ScriptRunner()
+        server.append('echo "failed on $HOST" >&2')
+        server.append('[ $HOST = host1 ] || [ $HOST = host2 ]')
+        try:
+            server.execute_on(hosts, log=False)
+        except MultiHostError as ex:
+            error = ex
+        else:
+            self.fail('MultiHostError not raised')
+        self.assertEqual(sorted(error.errors), ['host0', 'host3'])
+        msg = str(error)
+        self.assertIn('on 2 of 4 hosts', msg)
+        self.assertIn('[host0] ', msg)
+        self.assertIn('failed on host0', msg)
+        self.assertIn('failed on host3', msg)
+        self.assertNotIn('[host1]', msg)
+
+        output = server.execute_on(hosts, can_fail=False, log=False)
+        self.assertEqual([output[h][0] for h in hosts], [1, 0, 0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
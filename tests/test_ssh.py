@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+import unittest
+
+from casaba.installer.utils.ssh import SshConnectionPool
+
+
+class SlowPool(SshConnectionPool):
+    """
+    Pool whose masters take a while to start.
+    """
+    delay = 0.3
+
+    def __init__(self):
+        super(SlowPool, self).__init__()
+        self.started = []
+        self._started_lock = threading.Lock()
+
+    def _start_master(self, host):
+        time.sleep(self.delay)
+        with self._started_lock:
+            self.started.append(host)
+        return host != 'bad'
+
+
+class SshConnectionPoolTest(unittest.TestCase):
+    def test_open_all_starts_masters_concurrently(self):
+        pool = SlowPool()
+        hosts = ['host%d' % i for i in range(8)] + ['bad']
+        start = time.time()
+        result = pool.open_all(hosts, workers=len(hosts))
+        self.assertLess(time.time() - start, 3 * pool.delay)
+        self.assertEqual(sorted(pool.started), sorted(hosts))
+        self.assertEqual(result, dict((i, i != 'bad') for i in hosts))
+
+    def test_open_all_reuses_masters(self):
+        pool = SlowPool()
+        pool.open_all(['host1', 'host2'])
+        pool.open_all(['host1', 'host2', None, ''])
+        self.assertEqual(sorted(pool.started), ['host1', 'host2'])
+
+    def test_open_all_disabled(self):
+        pool = SlowPool()
+        pool.enabled = False
+        self.assertEqual(pool.open_all(['host1']), {'host1': False})
+        self.assertEqual(pool.started, [])
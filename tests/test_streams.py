@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import subprocess
+import unittest
+
+from casaba.installer.utils import shell
+from casaba.installer.utils import streams
+from casaba.installer.utils.strings import STR_MASK
+from casaba.installer.exceptions import ExecuteRuntimeError
+from casaba.installer.exceptions import MultiHostError
+from casaba.installer.exceptions import ScriptRuntimeError
+
+from . import fakes
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+class LogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.handler = RecordingHandler()
+        logger = logging.getLogger()
+        logger.addHandler(self.handler)
+        self.addCleanup(logger.removeHandler, self.handler)
+        fakes.patch(self, logger, 'level', logging.DEBUG)
+        fakes.patch(self, streams, 'LOG_BATCH_SIZE', 100)
+
+    def test_word_straddling_batch_without_newline_is_masked(self):
+        secret = 'supersecret'
+        writer = streams.LogWriter('STDOUT', [secret])
+        # the secret crosses the batch size in every position
+        for offset in range(len(secret) + 1):
+            data = 'x' * (100 - offset) + secret + 'y' * 50
+            for i in range(0, len(data), 7):
+                writer.write(data[i:i + 7])
+        writer.close()
+        logged = ''.join(self.handler.records)
+        self.assertNotIn('supers', logged)
+        self.assertNotIn('cret', logged)
+        self.assertEqual(logged.count(STR_MASK), len(secret) + 1)
+        self.assertTrue(len(self.handler.records) > 1)
+
+    def test_output_is_logged_by_lines(self):
+        writer = streams.LogWriter('STDOUT')
+        lines = ['line %03d\n' % i for i in range(30)]
+        for line in lines:
+            writer.write(line)
+        writer.close()
+        self.assertTrue(len(self.handler.records) > 1)
+        for record in self.handler.records[:-1]:
+            self.assertTrue(record.endswith('\n'))
+        self.assertIn(''.join(lines).rstrip('\n'),
+                      ''.join(self.handler.records))
+
+
+class PumpTest(unittest.TestCase):
+    def test_input_and_output_bigger_than_pipe_buffer(self):
+        data = ''.join('%06d\n' % i for i in range(100000))
+        proc = subprocess.Popen(['bash', '-c', 'cat; echo done >&2'],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = streams.OutputBuffer(), streams.OutputBuffer()
+        self.assertEqual(streams.pump(proc, input=data, stdout=[out],
+                                      stderr=[err]), 0)
+        self.assertEqual(out.getvalue(), data)
+        self.assertEqual(err.getvalue(), 'done\n')
+
+
+class ExecuteTest(unittest.TestCase):
+    def setUp(self):
+        self.closed = []
+        close = streams.OutputBuffer.close
+
+        def recording_close(buf):
+            self.closed.append(buf)
+            close(buf)
+
+        fakes.patch(self, streams.OutputBuffer, 'close', recording_close)
+
+    def test_buffers_are_closed_when_string_is_returned(self):
+        rc, out = shell.execute(['echo', 'hello'], log=False)
+        self.assertEqual((rc, out), (0, 'hello\n'))
+        self.assertEqual(len(self.closed), 2)
+
+    def test_buffers_are_given_to_error_on_failure(self):
+        try:
+            shell.execute(['bash', '-c', 'echo out; echo err >&2; exit 3'],
+                          log=False, lazy_output=True)
+        except ExecuteRuntimeError as ex:
+            error = ex
+        else:
+            self.fail('ExecuteRuntimeError not raised')
+        self.assertEqual(self.closed, [])
+        self.assertEqual((error.stdout, error.stderr), ('out\n', 'err\n'))
+        self.assertEqual(error.stdout_buffer.getvalue(), 'out\n')
+        self.assertEqual(error.stderr_buffer.getvalue(), 'err\n')
+
+    def test_lazy_output_is_left_open(self):
+        rc, out = shell.execute(['echo', 'hello'], log=False,
+                                lazy_output=True)
+        self.assertEqual(out.getvalue(), 'hello\n')
+        self.assertEqual(len(self.closed), 1)
+        self.assertNotIn(out, self.closed)
+
+
+class FailureOutputTest(unittest.TestCase):
+    # output bigger than tail kept in memory
+    script = ('for i in $(seq 5000); do echo "line $i"; done; '
+              'echo failed >&2; exit 1')
+
+    def check(self, error):
+        self.assertTrue(error.stdout.startswith('[... '))
+        self.assertTrue(error.stdout.endswith('line 5000\n'))
+        self.assertTrue(len(error.stdout) < streams.TAIL_SIZE + 100)
+        self.assertIn(error.stdout[-100:], str(error))
+        output = error.stdout_buffer.getvalue()
+        self.assertEqual(output.splitlines(),
+                         ['line %d' % i for i in range(1, 5001)])
+        # scripts run traced, trace is in stderr too
+        self.assertIn('failed', error.stderr_buffer.getvalue().splitlines())
+
+    def test_execute(self):
+        try:
+            shell.execute(['bash', '-c', self.script], log=False)
+        except ExecuteRuntimeError as ex:
+            self.check(ex)
+        else:
+            self.fail('ExecuteRuntimeError not raised')
+
+    def test_script(self):
+        fakes.use_ssh_pool(self, fakes.LocalSshPool())
+        server = shell.ScriptRunner('node1')
+        server.append(self.script)
+        try:
+            server.execute(log=False)
+        except ScriptRuntimeError as ex:
+            self.check(ex)
+        else:
+            self.fail('ScriptRuntimeError not raised')
+        try:
+            server.execute_on(['node1', 'node2'], log=False)
+        except MultiHostError as ex:
+            self.assertEqual(sorted(ex.errors), ['node1', 'node2'])
+            for error in ex.errors.values():
+                self.check(error)
+        else:
+            self.fail('MultiHostError not raised')
+
+
+if __name__ == '__main__':
+    unittest.main()
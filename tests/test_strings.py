@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from casaba.installer.utils import strings
+from casaba.installer.utils.strings import STR_MASK
+from casaba.installer.utils.strings import Masker
+from casaba.installer.utils.strings import mask_string
+
+
+class MaskerTest(unittest.TestCase):
+    def test_words_are_masked(self):
+        masker = Masker(['secret', 'pass'])
+        self.assertEqual(masker.mask('user pass secret; pass'),
+                         'user %s %s; %s' % ((STR_MASK,) * 3))
+        self.assertEqual(masker.mask(''), '')
+        self.assertEqual(Masker().mask('secret'), 'secret')
+
+    def test_longer_word_takes_precedence(self):
+        masker = Masker(['pass', 'password', 'passw'])
+        self.assertEqual(masker.mask('password passw pass'),
+                         ' '.join([STR_MASK] * 3))
+
+    def test_special_characters(self):
+        masker = Masker(['a.b*', '(x|y)'])
+        self.assertEqual(masker.mask('axb a.b* (x|y) x'),
+                         'axb %s %s x' % (STR_MASK, STR_MASK))
+
+    def test_words_are_transformed(self):
+        masker = Masker(["it's"], [("'", "'\\''")])
+        self.assertEqual(masker.mask("echo 'it'\\''s'"),
+                         "echo '%s'" % STR_MASK)
+
+    def test_update(self):
+        masker = Masker(['one', ''])
+        regex = masker._regex
+        masker.update(['one'])
+        self.assertIs(masker._regex, regex)
+        masker.update(['two'])
+        self.assertEqual(masker.mask('one two'), 'one %s' % STR_MASK)
+        self.assertEqual(masker.longest, 3)
+
+    def test_split_point(self):
+        masker = Masker(['secret'])
+        text = 'abc secret def'
+        self.assertEqual(masker.split_point(text, 2), 2)
+        for idx in range(5, 10):
+            self.assertEqual(masker.split_point(text, idx), 4)
+        self.assertEqual(masker.split_point(text, 10), 10)
+        self.assertEqual(Masker().split_point(text, 6), 6)
+
+    def test_mask_lines(self):
+        masker = Masker(['secret'])
+        self.assertEqual(list(masker.mask_lines(['a secret\n', 'b\n'])),
+                         ['a %s\n' % STR_MASK, 'b\n'])
+
+
+class MaskStringTest(unittest.TestCase):
+    def test_maskers_are_cached(self):
+        strings._maskers.clear()
+        self.assertEqual(mask_string('a secret', ['secret']),
+                         'a %s' % STR_MASK)
+        self.assertEqual(mask_string('secret', ['secret']), STR_MASK)
+        self.assertEqual(len(strings._maskers), 1)
+        self.assertIs(strings.get_masker(['secret']),
+                      strings.get_masker(set(['secret'])))
+
+    def test_cache_is_bounded(self):
+        for i in range(strings._MASKERS_LIMIT + 5):
+            mask_string('value', ['word%d' % i])
+        self.assertTrue(len(strings._maskers) <= strings._MASKERS_LIMIT)
+
+
+if __name__ == '__main__':
+    unittest.main()
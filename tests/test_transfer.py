@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from casaba.installer.core import transfer
+from casaba.installer.exceptions import MultiHostError
+from casaba.installer.utils.ssh import SshConnectionPool
+
+from . import fakes
+
+
+# runs the remote command in directory of the node named in arguments
+SSH = '''host=${@: -2:1}
+[ -n "$NODES" ] || exit 255
+echo "$@" >> "$NODES.log"
+mkdir -p "$NODES/${host#*@}" && cd "$NODES/${host#*@}" && eval "${@: -1}"'''
+
+
+class MemorySend(object):
+    """
+    Stand-in for ssh_send keeping content of nodes in memory.
+    """
+    def __init__(self, failing=(), relays=True):
+        self.failing = failing
+        # whether nodes are able to send the file to each other
+        self.relays = relays
+        self.nodes = {}
+        self.transfers = []
+        self._lock = threading.Lock()
+
+    def __call__(self, source, target, path, dest):
+        with self._lock:
+            self.transfers.append((source, target))
+            if source is None:
+                with open(path) as fp:
+                    content = fp.read()
+            else:
+                # relay has to hold the file already
+                content = self.nodes[source][dest]
+        if target in self.failing or (source and not self.relays):
+            raise RuntimeError('Connection refused')
+        with self._lock:
+            self.nodes.setdefault(target, {})[dest] = content
+
+
+class TreeDistributorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'resources.tar')
+        with open(self.path, 'w') as fp:
+            fp.write('tarball')
+        self.nodes = ['node%02d' % i for i in range(10)]
+
+    def test_distribution_in_waves(self):
+        send = MemorySend()
+        distributor = transfer.TreeDistributor(fanout=2, send=send)
+        waves = []
+        schedule = distributor.schedule
+
+        def recording_schedule(holders, pending):
+            waves.append(schedule(holders, pending))
+            return waves[-1]
+
+        distributor.schedule = recording_schedule
+        distributor.distribute(self.path, 'bundle/res.tar', self.nodes)
+        for node in self.nodes:
+            self.assertEqual(send.nodes[node], {'bundle/res.tar': 'tarball'})
+        self.assertEqual(len(send.transfers), len(self.nodes))
+        # holders grow 1, 3, 9, so 10 nodes get the file in three waves
+        self.assertEqual([len(i) for i in waves], [2, 6, 2])
+        for wave in waves:
+            sources = [s for s, t in wave]
+            for source in sources:
+                self.assertTrue(sources.count(source) <= 2)
+
+    def test_schedule(self):
+        distributor = transfer.TreeDistributor(fanout=2)
+        pending = list(self.nodes)
+        self.assertEqual(distributor.schedule([None], pending),
+                         [(None, 'node00'), (None, 'node01')])
+        self.assertEqual(distributor.schedule([None, 'node00', 'node01'],
+                                              pending),
+                         [(None, 'node02'), (None, 'node03'),
+                          ('node00', 'node04'), ('node00', 'node05'),
+                          ('node01', 'node06'), ('node01', 'node07')])
+        self.assertEqual(pending, ['node08', 'node09'])
+        self.assertRaises(ValueError, transfer.TreeDistributor, fanout=0)
+
+    def test_failed_nodes_are_not_relays(self):
+        send = MemorySend(failing=('node00', 'node05'))
+        distributor = transfer.TreeDistributor(fanout=2, send=send)
+        try:
+            distributor.distribute(self.path, 'res.tar', self.nodes)
+        except MultiHostError as ex:
+            error = ex
+        else:
+            self.fail('MultiHostError not raised')
+        self.assertEqual(sorted(error.errors), ['node00', 'node05'])
+        self.assertIn('to 2 of 10 nodes', str(error))
+        self.assertNotIn('node00', [s for s, t in send.transfers])
+        self.assertNotIn('node05', [s for s, t in send.transfers])
+        self.assertEqual(sorted(send.nodes),
+                         [i for i in self.nodes
+                          if i not in ('node00', 'node05')])
+
+    def test_failed_relay_falls_back_to_installer(self):
+        send = MemorySend(relays=False)
+        distributor = transfer.TreeDistributor(fanout=2, send=send)
+        distributor.distribute(self.path, 'res.tar', self.nodes)
+        for node in self.nodes:
+            self.assertEqual(send.nodes[node], {'res.tar': 'tarball'})
+        # every node got the file from the installer host at last
+        direct = [t for s, t in send.transfers if s is None]
+        self.assertEqual(sorted(direct), self.nodes)
+
+
+class SshSendTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        fakes.add_executable(bindir, 'ssh', SSH)
+        self.nodes = os.path.join(self.tmpdir, 'nodes')
+        fakes.setenv(self, 'PATH', '%s:%s' % (bindir, os.environ['PATH']))
+        fakes.setenv(self, 'NODES', self.nodes)
+        fakes.use_ssh_pool(self, SshConnectionPool(enabled=False))
+        self.path = os.path.join(self.tmpdir, 'resources.tar')
+        with open(self.path, 'w') as fp:
+            fp.write('tarball')
+
+    def read(self, node, dest):
+        with open(os.path.join(self.nodes, node, dest)) as fp:
+            return fp.read()
+
+    def test_send_and_relay(self):
+        nodes = ['node%d' % i for i in range(5)]
+        distributor = transfer.TreeDistributor(fanout=1)
+        distributor.distribute(self.path, 'bundle/res.tar', nodes)
+        for node in nodes:
+            self.assertEqual(self.read(node, 'bundle/res.tar'), 'tarball')
+            self.assertFalse(os.path.exists(
+                os.path.join(self.nodes, node, 'bundle/res.tar.part')))
+        with open(self.nodes + '.log') as fp:
+            calls = fp.read().splitlines()
+        # relays log in by themselves, agent is never forwarded to nodes;
+        # both relays are logged by ssh to source and by ssh to target
+        relays = [i for i in calls if 'BatchMode=yes' in i]
+        self.assertEqual(len(relays), 4)
+        for call in calls:
+            self.assertNotIn('-A', call.split())
+
+    def test_failed_relay(self):
+        os.makedirs(os.path.join(self.nodes, 'node1'))
+        self.assertRaises(RuntimeError, transfer.ssh_send, 'node1', 'node2',
+                          self.path, 'bundle/res.tar')
+
+
+if __name__ == '__main__':
+    unittest.main()
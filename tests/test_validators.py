@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from casaba.installer import validators
+from casaba.installer.exceptions import ParamValidationError
+
+from . import fakes
+
+
+def failing(*failed):
+    """
+    Returns batch validator failing on given hosts.
+    """
+    def check(hosts, workers=None):
+        return dict((host, ParamValidationError('Failed: %s' % host))
+                    for host in hosts if host.strip() in failed)
+    return check
+
+
+class MultiHostValidatorTest(unittest.TestCase):
+    def test_all_failed_hosts_are_reported(self):
+        fakes.patch(self, validators, 'ping_all',
+                    failing('10.0.0.1', '10.0.0.3'))
+        try:
+            validators.validate_multi_ping('10.0.0.1,10.0.0.2,10.0.0.3')
+        except ParamValidationError as ex:
+            msg = str(ex)
+        else:
+            self.fail('ParamValidationError not raised')
+        self.assertIn('on 2 of 3 hosts', msg)
+        self.assertIn('[10.0.0.1] Failed: 10.0.0.1', msg)
+        self.assertIn('[10.0.0.3] Failed: 10.0.0.3', msg)
+        self.assertNotIn('10.0.0.2', msg)
+
+    def test_single_failure_is_raised_as_is(self):
+        error = ParamValidationError('Given host is unreachable')
+        fakes.patch(self, validators, 'ssh_all',
+                    lambda hosts, workers=None: {' 10.0.0.2': error})
+        try:
+            validators.validate_multi_ssh('10.0.0.1, 10.0.0.2')
+        except ParamValidationError as ex:
+            self.assertIs(ex, error)
+        else:
+            self.fail('ParamValidationError not raised')
+
+    def test_no_failure(self):
+        fakes.patch(self, validators, 'ssh_all', failing())
+        validators.validate_multi_ssh('10.0.0.1,10.0.0.2')
+
+
+class DeferredValidationTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def single(self, *failing):
+        def validate(value, options=None):
+            with self.lock:
+                self.calls.append(('single', value, options))
+            if value in failing:
+                raise ParamValidationError('Invalid: %s' % value)
+        return validate
+
+    def batch(self, *failing):
+        def validate(values, workers=None):
+            with self.lock:
+                self.calls.append(('batch', sorted(values)))
+            return dict((i, ParamValidationError('Down: %s' % i))
+                        for i in values if i in failing)
+        check = self.single()
+        check.batch = validate
+        return check
+
+    def test_checks_are_deduplicated(self):
+        validate = self.single('bad')
+        multi = self.single()
+        multi.each = validate
+        deferred = validators.DeferredValidation()
+        deferred.add('FIRST', validate, 'good', ['x'])
+        deferred.add('SECOND', multi, 'good, bad')
+        deferred.add('THIRD', validate, 'bad')
+        errors = deferred.run()
+        self.assertEqual(sorted(self.calls),
+                         [('single', 'bad', []), ('single', 'good', []),
+                          ('single', 'good', ['x'])])
+        self.assertEqual(sorted(name for name, error in errors),
+                         ['SECOND', 'THIRD'])
+        self.assertEqual(set(str(error) for name, error in errors),
+                         set(['Invalid: bad']))
+        # checks are dropped once they are run
+        self.assertEqual(deferred.run(), errors)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_batch_validator_is_called_once(self):
+        validate = self.batch('10.0.0.2')
+        deferred = validators.DeferredValidation()
+        deferred.add('HOSTS', validate, '10.0.0.1')
+        deferred.add('OTHER', validate, '10.0.0.2')
+        deferred.add('SAME', validate, '10.0.0.2')
+        errors = deferred.run(workers=2)
+        self.assertEqual(self.calls,
+                         [('batch', ['10.0.0.1', '10.0.0.2'])])
+        self.assertEqual(sorted(name for name, error in errors),
+                         ['OTHER', 'SAME'])
+
+    def test_unexpected_error_is_raised(self):
+        def broken(value, options=None):
+            raise KeyError(value)
+
+        deferred = validators.DeferredValidation()
+        deferred.add('BROKEN', broken, 'value')
+        self.assertRaises(KeyError, deferred.run)
+
+    def test_fail(self):
+        deferred = validators.DeferredValidation()
+        error = ParamValidationError('wrong')
+        deferred.fail('PARAM', error)
+        self.assertEqual(deferred.run(), [('PARAM', error)])
+
+
+if __name__ == '__main__':
+    unittest.main()
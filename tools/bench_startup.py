@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures import time of installer modules, each import is done
+in fresh interpreter. Exits with non-zero status if median import
+time of any module exceeds given limit.
+
+    python tools/bench_startup.py [-n 10] [--max-ms 300] [module ...]
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+
+
+DEFAULT_MODULES = ('casaba.installer.run_setup',
+                   'casaba.installer.validators',
+                   'casaba.installer.processors')
+
+SNIPPET = ('import time; start = time.time(); import %s; '
+           'print((time.time() - start) * 1000)')
+
+
+def measure(module, runs):
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [i for i in [env.get('PYTHONPATH')] if i])
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    times = []
+    for i in range(runs):
+        proc = subprocess.Popen([sys.executable, '-c', SNIPPET % module],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env)
+        stdout, stderr = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError('Failed to import %s:\n%s' % (module, stderr))
+        times.append(float(stdout.strip().splitlines()[-1]))
+    return sorted(times)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [module ...]')
+    parser.add_option('-n', '--runs', type='int', default=10,
+                      help='number of imports of every module')
+    parser.add_option('--max-ms', type='float', default=None,
+                      help='fail if median import time exceeds this limit')
+    options, modules = parser.parse_args()
+
+    failed = False
+    print('%-40s %10s %10s %10s' % ('module', 'min ms', 'median ms', 'max ms'))
+    for module in modules or DEFAULT_MODULES:
+        times = measure(module, options.runs)
+        median = times[len(times) // 2]
+        print('%-40s %10.1f %10.1f %10.1f'
+              % (module, times[0], median, times[-1]))
+        if options.max_ms is not None and median > options.max_ms:
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())